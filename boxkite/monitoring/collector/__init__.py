@@ -1,6 +1,6 @@
 from .baseline import BaselineMetricCollector
 from .computed import ComputedMetricCollector
-from .feature import FeatureHistogramCollector
+from .feature import FeatureHistogramCollector, StreamingFeatureHistogramCollector
 from .inference import InferenceHistogramCollector
 from .info import InfoMetricCollector
 
@@ -10,4 +10,5 @@ __all__ = [
     "FeatureHistogramCollector",
     "InferenceHistogramCollector",
     "InfoMetricCollector",
+    "StreamingFeatureHistogramCollector",
 ]
@@ -1,7 +1,9 @@
+import os
 from logging import getLogger
 from os.path import exists
-from typing import Optional
+from typing import List, Optional, Tuple
 
+from prometheus_client import Metric
 from prometheus_client.parser import text_fd_to_metric_families
 
 from .type import Collector
@@ -10,6 +12,9 @@ from .type import Collector
 class BaselineMetricCollector(Collector):
     """Collects baseline metrics from a Prometheus file.
 
+    The parsed metrics are kept in memory and only parsed again when the file is replaced or
+    modified, as detected by its inode, size and modification time.
+
     Users may extend this class to fetch baseline metrics from network locations.
     """
 
@@ -22,6 +27,8 @@ class BaselineMetricCollector(Collector):
         :type path: Optional[str], optional
         """
         self.path = path or BaselineMetricCollector.DEFAULT_HISTOGRAM_PATH
+        # Parsed metrics keyed by the file's (inode, size, mtime)
+        self._cache: Optional[Tuple[Tuple[int, int, int], List[Metric]]] = None
         if not exists(self.path):
             getLogger().warn(
                 "\nWarning: baseline metrics missing from artefact directory.\n"
@@ -34,13 +41,25 @@ class BaselineMetricCollector(Collector):
     def describe(self):
         return self.collect()
 
-    def collect(self):
+    def collect(self) -> List[Metric]:
         try:
             with open(self.path, "r") as f:
-                for metric in text_fd_to_metric_families(f):
-                    # Ignore non-baseline metrics
-                    if not metric.name.endswith("_baseline"):
-                        continue
-                    yield metric
+                stat = os.fstat(f.fileno())
+                key = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+                cache = self._cache
+                if cache is None or cache[0] != key:
+                    cache = (key, self._parse(f))
+                    self._cache = cache
         except FileNotFoundError:
+            self._cache = None
             return []
+        return list(cache[1])
+
+    @staticmethod
+    def _parse(f) -> List[Metric]:
+        # Ignore non-baseline metrics
+        return [
+            metric
+            for metric in text_fd_to_metric_families(f)
+            if metric.name.endswith("_baseline")
+        ]
@@ -1,13 +1,130 @@
-from typing import Iterable, List, Mapping, Optional, Set, Tuple, Type
+import os
+from collections import abc, deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from multiprocessing import get_context
+from typing import (
+    Any,
+    Callable,
+    Deque,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Mapping,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    Type,
+    Union,
+)
 
 import numpy as np
 from prometheus_client import Metric
 
-from boxkite.utils.histogram import _remove_nans_and_infs, fast_histogram
+from boxkite.utils.histogram import (
+    _remove_nans_and_infs,
+    fast_histogram,
+    get_sketch_bins,
+    is_discrete,
+)
+from boxkite.utils.sketch import QuantileSketch
 
 from ..frequency import ContinuousVariable, DiscreteVariable, FrequencyMetric, TBin
 from .type import Collector
 
+# A chunk of rows by features, or of feature values by name
+TChunk = Union[np.ndarray, Mapping[str, Any]]
+# Label of the bin counting nan values of discrete features
+NAN_BIN = "nan"
+# Columns of (name, values), a 2-D array, a DataFrame or a path to a .npy or .npz file
+TFeatures = Union[Iterable[Tuple[str, List[float]]], np.ndarray, str, os.PathLike]
+
+
+def feature_columns(
+    data: TFeatures, names: Optional[Sequence[str]] = None
+) -> Iterable[Tuple[str, List[float]]]:
+    """Lists the (name, values) columns of a dataset without copying them.
+
+    - 2-D arrays of rows by features yield strided views of each column, named by `names` or
+      by column index.
+    - `.npy` files hold such a 2-D array and are memory mapped, so columns are only read from
+      disk when sampled.
+    - `.npz` files hold one array per feature, named after the feature. They are loaded one
+      feature at a time, since members of zip archives cannot be memory mapped.
+    - DataFrames, or any mapping of name to values, yield their columns as arrays, which does
+      not copy columns of a numeric dtype. Pandas is not required otherwise.
+    - Any other iterable is assumed to already hold (name, values) columns.
+
+    :param data: The dataset
+    :type data: TFeatures
+    :param names: Names of the columns of a 2-D array or `.npy` file, defaults to None
+    :type names: Optional[Sequence[str]], optional
+    :return: Columns of (name, values), which can be iterated more than once for file and
+        array datasets
+    :rtype: Iterable[Tuple[str, List[float]]]
+    """
+    if isinstance(data, (str, os.PathLike)):
+        path = os.fspath(data)
+        if path.endswith(".npz"):
+            return _NpzColumns(path)
+        data = np.load(path, mmap_mode="r")
+    if isinstance(data, np.ndarray):
+        if data.ndim != 2:
+            raise ValueError(f"Expected a 2-D array of rows, got shape {data.shape}")
+        names = names or [str(i) for i in range(data.shape[1])]
+        if len(names) != data.shape[1]:
+            raise ValueError(
+                f"Expected {data.shape[1]} feature names, got {len(names)}"
+            )
+        return [(name, data[:, i]) for i, name in enumerate(names)]
+    # DataFrames are not mappings but provide the same items
+    if isinstance(data, Mapping) or hasattr(data, "columns"):
+        return [(str(name), np.asarray(val)) for name, val in data.items()]
+    return data
+
+
+class _NpzColumns(abc.Sequence):
+    """Columns of a `.npz` file, each loaded when accessed."""
+
+    def __init__(self, path: str):
+        self.path = path
+        with np.load(path) as npz:
+            self.names: List[str] = npz.files
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def __getitem__(self, i: int) -> Tuple[str, np.ndarray]:
+        name = self.names[i]
+        with np.load(self.path) as npz:
+            return name, npz[name]
+
+
+def ordered_map(
+    submit: Callable[[Any], Callable[[], Any]], items: Iterable[Any], limit: int
+) -> Iterator[Any]:
+    """Submits items to a pool and yields their results in submission order, keeping at most
+    `limit` items in flight so that items are only read from the iterable as workers need them.
+
+    :param submit: Submits an item to the pool and returns a function waiting for its result
+    :type submit: Callable[[Any], Callable[[], Any]]
+    :param items: The items to submit
+    :type items: Iterable[Any]
+    :param limit: Max number of submitted items without a result yielded
+    :type limit: int
+    :yield: The result of each item
+    :rtype: Iterator[Any]
+    """
+    pending: Deque[Callable[[], Any]] = deque()
+    for item in items:
+        pending.append(submit(item))
+        if len(pending) >= limit:
+            yield pending.popleft()()
+    while pending:
+        yield pending.popleft()()
+
 
 class FeatureDistribution:
     """Defines the parsing rules for feature metric."""
@@ -86,25 +203,47 @@ class FeatureHistogramCollector(Collector):
 
     def __init__(
         self,
-        data: Iterable[Tuple[str, List[float]]],
+        data: TFeatures,
         max_samples: int = 100000,
         discrete: Optional[Set[int]] = None,
+        workers: int = 1,
+        processes: bool = False,
+        names: Optional[Sequence[str]] = None,
     ):
         """Builds the collector using the given data and params.
 
+        Data may be given as (name, values) columns, or any of the tabular formats supported by
+        `feature_columns`. Columns of arrays are read through views and sampled before being
+        converted to float64, so float32 datasets are never copied in full.
+
         Passing in a set of indices as the discrete parameter will disable heuristics. Every
         feature not in the discrete set will be treated as a continuous variable.
 
+        Features may be spread over a pool of workers, with only a few columns in flight per
+        worker so that columns are read as they are needed. Threads share the columns directly,
+        and numpy releases the GIL while sorting and counting. Processes are forked with the
+        collector, so that workers read columns of arrays, files and lists by index from memory
+        shared copy-on-write or from disk, instead of unpickling them. Columns of other iterables
+        are pickled. Forking is only available on POSIX platforms.
+
         :param data: Data to build histogram for
-        :type data: Iterable[Tuple[str, List[float]]]
+        :type data: TFeatures
         :param max_samples: Max number of samples used to calculate histogram, defaults to 100000
         :type max_samples: int, optional
         :param discrete: Set of indices of discrete features, defaults to None
         :type discrete: Optional[List[int]], optional
+        :param workers: Number of features processed concurrently, defaults to 1
+        :type workers: int, optional
+        :param processes: Uses a pool of forked processes instead of threads, defaults to False
+        :type processes: bool, optional
+        :param names: Names of the columns of a 2-D array or `.npy` file, defaults to None
+        :type names: Optional[Sequence[str]], optional
         """
-        self.data: Iterable[Tuple[str, List[float]]] = data
+        self.data: Iterable[Tuple[str, List[float]]] = feature_columns(data, names)
         self.max_samples: int = max_samples
         self.discrete: Optional[Set[int]] = discrete
+        self.workers: int = workers
+        self.processes: bool = processes
 
     def describe(self):
         """Implements a noop describe method so that when the collector registry is initialized
@@ -116,33 +255,316 @@ class FeatureHistogramCollector(Collector):
     def collect(self):
         """Calculates histogram bins using numpy and converts to Prometheus metric.
 
+        Metrics are yielded in feature order, whether or not features are spread over workers.
+
         :yield: The converted Prometheus metric for each feature
         :rtype: Metric
         """
-        for i, col in enumerate(self.data):
-            name, val = col
+        if self.workers <= 1:
+            for i, (name, val) in enumerate(self.data):
+                yield self._histogram(i, name, val)
+        elif not self.processes:
+            with ThreadPoolExecutor(
+                max_workers=self.workers, thread_name_prefix="boxkite-histogram"
+            ) as executor:
+                yield from ordered_map(
+                    lambda col: executor.submit(
+                        self._histogram, col[0], *col[1]
+                    ).result,
+                    enumerate(self.data),
+                    limit=2 * self.workers,
+                )
+        else:
+            # Forked workers inherit the collector without pickling it
+            with get_context("fork").Pool(
+                self.workers, initializer=_init_worker, initargs=(self,)
+            ) as pool:
+                if isinstance(self.data, abc.Sequence):
+                    # Workers read each column themselves, from memory shared with the
+                    # collector or from disk
+                    items: Iterable[Any] = ((i,) for i in range(len(self.data)))
+                    func = _histogram_at
+                else:
+                    # Columns of other iterables are only known once read, and are pickled
+                    items = enumerate(self.data)
+                    func = _histogram_of
+                yield from ordered_map(
+                    lambda args: pool.apply_async(func, args).get,
+                    items,
+                    limit=2 * self.workers,
+                )
+
+    def _histogram(self, i: int, name: str, val: List[float]) -> Metric:
+        # Numeric arrays are sampled in place, so that columns are never copied in full
+        val = np.asarray(val)
+        if val.dtype.kind not in "biuf":
             # Assuming data is float. Categorical data should have been one-hot encoded
             # dtype=float will convert None values to np.nan as well
             val = np.asarray(val, dtype=float)
 
-            # Sample without replacement to cap computation to about 3 seconds for 25 features
-            if len(val) > self.max_samples:
-                val = np.random.choice(val, size=self.max_samples, replace=False)
+        # Sample without replacement to cap computation to about 3 seconds for 25 features
+        if len(val) > self.max_samples:
+            val = np.random.choice(val, size=self.max_samples, replace=False)
+        val = val.astype(float, copy=False)
+
+        discrete = None
+        if self.discrete is not None:
+            discrete = i in self.discrete
+        bin_to_count = fast_histogram(val, discrete=discrete)
+
+        # Continuous histogram will always contain the +Inf bin
+        if "+Inf" not in bin_to_count:
+            return FeatureDistribution.as_discrete(
+                index=i, name=name, bin_to_count=bin_to_count
+            )
+        val = _remove_nans_and_infs(val)
+        return FeatureDistribution.as_continuous(
+            index=i, name=name, bin_to_count=bin_to_count, sum_value=np.sum(val)
+        )
+
+
+# Collector of the forked worker process, see FeatureHistogramCollector.collect
+_worker: Optional[FeatureHistogramCollector] = None
+
+
+def _init_worker(collector: FeatureHistogramCollector):
+    global _worker
+    _worker = collector
+    # Forked workers inherit the random state of the parent, and would otherwise sample the
+    # same rows of every column
+    np.random.seed()
 
-            discrete = None
-            if self.discrete is not None:
-                discrete = i in self.discrete
-            bin_to_count = fast_histogram(val, discrete=discrete)
 
-            # Continuous histogram will always contain the +Inf bin
-            if "+Inf" not in bin_to_count:
-                metric = FeatureDistribution.as_discrete(
+def _histogram_at(i: int) -> Metric:
+    name, val = _worker.data[i]
+    return _worker._histogram(i, name, val)
+
+
+def _histogram_of(i: int, col: Tuple[str, List[float]]) -> Metric:
+    return _worker._histogram(i, *col)
+
+
+class StreamingFeatureHistogramCollector(Collector):
+    """Collects metrics related to feature distribution from a dataset streamed in chunks.
+
+    The dataset is read twice. The first pass builds a quantile sketch of each feature, which
+    keeps its exact size, min and max, along with a uniform sample of at most `max_samples`
+    rows. The sample decides whether a feature is discrete, while the bins of continuous
+    features are chosen from the sketch, see get_sketch_bins. The second pass counts every row
+    exactly into those bins. Bins span the exact min and max, so that only nan and infinite
+    values fall in the +Inf bucket, same as FeatureHistogramCollector.
+
+    Chunks may be spread over a pool of worker threads. Each chunk is then sketched and counted
+    separately, and the results are merged in chunk order.
+
+    Peak memory is bounded by the chunk size, the sketch size and the sample size, not by the
+    dataset size.
+    """
+
+    def __init__(
+        self,
+        chunks: Callable[[], Iterable[TChunk]],
+        names: Optional[Sequence[str]] = None,
+        max_samples: int = 1000,
+        discrete: Optional[Set[int]] = None,
+        k: int = 200,
+        workers: int = 1,
+    ):
+        """Builds the collector using the given chunk source and params.
+
+        Each chunk is either a 2-D array of rows by features, or a mapping of feature name to
+        the values of that feature in the chunk.
+
+        :param chunks: Returns a new iterator over the dataset chunks, called once per pass
+        :type chunks: Callable[[], Iterable[TChunk]]
+        :param names: Names of the features in column order, defaults to the keys of the first
+            chunk, which must then be a mapping
+        :type names: Optional[Sequence[str]], optional
+        :param max_samples: Max number of rows sampled to decide whether features are discrete,
+            defaults to 1000 which is the sample size of is_discrete
+        :type max_samples: int, optional
+        :param discrete: Set of indices of discrete features, defaults to None
+        :type discrete: Optional[Set[int]], optional
+        :param k: Size of the quantile sketch of each feature, see QuantileSketch,
+            defaults to 200
+        :type k: int, optional
+        :param workers: Number of chunks processed concurrently, defaults to 1
+        :type workers: int, optional
+        """
+        self.chunks: Callable[[], Iterable[TChunk]] = chunks
+        self.names: Optional[Sequence[str]] = names
+        self.max_samples: int = max_samples
+        self.discrete: Optional[Set[int]] = discrete
+        self.k: int = k
+        self.workers: int = workers
+
+    def describe(self):
+        """Implements a noop describe method, same as FeatureHistogramCollector."""
+        return []
+
+    def _rows(self, chunk: TChunk, names: Optional[Sequence[str]]) -> np.ndarray:
+        if isinstance(chunk, Mapping):
+            return np.column_stack(
+                [np.asarray(chunk[name], dtype=float) for name in names or chunk]
+            )
+        rows = np.asarray(chunk, dtype=float)
+        if rows.ndim != 2:
+            raise ValueError(f"Expected a 2-D chunk of rows, got shape {rows.shape}")
+        return rows
+
+    def _map(
+        self, func: Callable[[np.ndarray], Any]
+    ) -> Iterator[Tuple[List[str], Any]]:
+        """Applies a function to the rows of each chunk, in chunk order.
+
+        :param func: Computes a partial result from the rows of a chunk
+        :type func: Callable[[np.ndarray], Any]
+        :yield: Feature names and the partial result of each chunk
+        :rtype: Iterator[Tuple[List[str], Any]]
+        """
+        names = self.names
+
+        def apply(chunk: TChunk) -> Any:
+            return func(self._rows(chunk, names))
+
+        def chunks() -> Iterator[TChunk]:
+            nonlocal names
+            for chunk in self.chunks():
+                if names is None:
+                    if not isinstance(chunk, Mapping):
+                        raise ValueError(
+                            "Feature names are required for chunks of rows"
+                        )
+                    names = list(chunk)
+                yield chunk
+
+        if self.workers <= 1:
+            for chunk in chunks():
+                yield names, apply(chunk)
+            return
+        with ThreadPoolExecutor(
+            max_workers=self.workers, thread_name_prefix="boxkite-histogram"
+        ) as executor:
+            for result in ordered_map(
+                lambda chunk: executor.submit(apply, chunk).result,
+                chunks(),
+                limit=2 * self.workers,
+            ):
+                yield names, result
+
+    def _summarize(self, rows: np.ndarray) -> Tuple[np.ndarray, np.ndarray, list]:
+        # Random keys of the chunk's sampled rows, see _sample
+        keys = np.random.random_sample(len(rows))
+        keep = np.argsort(keys)[: self.max_samples]
+        sketches = [
+            QuantileSketch(self.k).update(rows[:, i]) for i in range(rows.shape[1])
+        ]
+        return keys[keep], rows[keep], sketches
+
+    def _sample(self) -> Tuple[Sequence[str], np.ndarray, List[QuantileSketch]]:
+        """Merges the sketches of each chunk, and keeps the rows with the smallest random keys,
+        a uniform sample without replacement.
+
+        :return: Feature names, sampled rows and the sketch of each feature
+        :rtype: Tuple[Sequence[str], np.ndarray, List[QuantileSketch]]
+        """
+        names: Optional[Sequence[str]] = None
+        sample: Optional[np.ndarray] = None
+        keys = np.zeros(0)
+        sketches: List[QuantileSketch] = []
+        for names, (chunk_keys, rows, chunk_sketches) in self._map(self._summarize):
+            if sample is None:
+                sample, keys, sketches = rows, chunk_keys, chunk_sketches
+                continue
+            sample = np.concatenate([sample, rows])
+            keys = np.concatenate([keys, chunk_keys])
+            for sketch, other in zip(sketches, chunk_sketches):
+                sketch.merge(other)
+            if len(keys) > self.max_samples:
+                keep = np.argpartition(keys, self.max_samples)[: self.max_samples]
+                sample, keys = sample[keep], keys[keep]
+        if names is None or sample is None:
+            raise ValueError("Cannot collect feature histograms from an empty dataset")
+        return names, sample, sketches
+
+    def _bins(
+        self, index: int, sample: np.ndarray, sketch: QuantileSketch
+    ) -> Optional[List[float]]:
+        """Chooses the bins of a continuous feature, or None for a discrete feature."""
+        val = sample[~np.isnan(sample)]
+        if self.discrete is not None:
+            discrete = index in self.discrete
+        else:
+            discrete = is_discrete(val)
+        if discrete:
+            return None
+        if sketch.size == 0:
+            # Only nan and infinite values, all counted in the +Inf bin
+            return []
+        return get_sketch_bins(sketch)
+
+    def _count(self, plans: List[Optional[List[float]]], rows: np.ndarray):
+        # Bin counts of continuous features include the +Inf bin last
+        counts = [np.zeros(len(bins) + 1) if bins is not None else {} for bins in plans]
+        sums = np.zeros(len(plans))
+        for i, bins in enumerate(plans):
+            val = rows[:, i]
+            if bins is None:
+                _count_discrete(counts[i], val)
+                continue
+            finite = np.isfinite(val)
+            val = val[finite]
+            # Index of the first bin greater than or equal to each value
+            index = np.searchsorted(bins, val, side="left")
+            counts[i] += np.bincount(index, minlength=len(bins) + 1)
+            counts[i][-1] += len(finite) - len(val)
+            sums[i] += np.sum(val)
+        return counts, sums
+
+    def collect(self):
+        """Chooses bins from a sketch of the dataset, then counts every row into them.
+
+        :yield: The converted Prometheus metric for each feature
+        :rtype: Metric
+        """
+        names, sample, sketches = self._sample()
+        plans = [self._bins(i, sample[:, i], sketches[i]) for i in range(len(names))]
+        del sample, sketches
+
+        counts: List[Any] = [
+            np.zeros(len(bins) + 1) if bins is not None else {} for bins in plans
+        ]
+        sums = np.zeros(len(names))
+        for _, (chunk_counts, chunk_sums) in self._map(partial(self._count, plans)):
+            sums += chunk_sums
+            for i, bins in enumerate(plans):
+                if bins is not None:
+                    counts[i] += chunk_counts[i]
+                    continue
+                for k, v in chunk_counts[i].items():
+                    counts[i][k] = counts[i].get(k, 0) + v
+
+        for i, (name, bins) in enumerate(zip(names, plans)):
+            if bins is None:
+                size_nan = counts[i].pop(NAN_BIN, 0)
+                bin_to_count = {str(k): counts[i][k] for k in sorted(counts[i])}
+                if size_nan > 0:
+                    bin_to_count[NAN_BIN] = size_nan
+                yield FeatureDistribution.as_discrete(
                     index=i, name=name, bin_to_count=bin_to_count
                 )
             else:
-                val = _remove_nans_and_infs(val)
-                metric = FeatureDistribution.as_continuous(
-                    index=i, name=name, bin_to_count=bin_to_count, sum_value=np.sum(val)
+                bin_to_count = dict(zip(map(str, bins), counts[i][:-1]))
+                bin_to_count["+Inf"] = counts[i][-1]
+                yield FeatureDistribution.as_continuous(
+                    index=i, name=name, bin_to_count=bin_to_count, sum_value=sums[i]
                 )
 
-            yield metric
+
+def _count_discrete(counts: Dict[Union[float, str], int], val: np.ndarray):
+    # Unique does not work on nan since nan != nan, so they are counted by label
+    nan = np.isnan(val)
+    bins, bin_counts = np.unique(val[~nan], return_counts=True)
+    for k, v in zip(bins.tolist(), bin_counts.tolist()):
+        counts[k] = counts.get(k, 0) + v
+    counts[NAN_BIN] = counts.get(NAN_BIN, 0) + int(nan.sum())
@@ -0,0 +1,283 @@
+import glob
+import json
+import os
+from logging import getLogger
+from threading import Event, Thread
+from typing import Callable, Dict, List, Optional, Tuple
+from weakref import WeakSet
+
+import numpy as np
+from prometheus_client.mmap_dict import MmapedDict
+from prometheus_client.multiprocess import MultiProcessCollector
+
+from .table import SharedFrequencyTable, TUnseen, add_unseen, directory_lock
+
+# Value and write timestamp of a multiprocess file entry, the timestamp is 0 for old clients
+TValue = Tuple[float, float]
+
+# Metric types whose values are summed across processes by MultiProcessCollector
+ARCHIVED_TYPES = ("counter", "histogram", "summary")
+# Gauges aggregated across processes by MultiProcessCollector, with how it combines two values
+ARCHIVED_GAUGES: Dict[str, Callable[[TValue, TValue], TValue]] = {
+    "gauge_min": min,
+    "gauge_max": max,
+    "gauge_mostrecent": lambda a, b: max(a, b, key=lambda v: v[1]),
+}
+# Gauges that only report live processes, see prometheus_client.multiprocess
+LIVE_GAUGES = ("gauge_livesum", "gauge_liveall")
+# Gauges of "all" mode are kept as they are, since each process is exported as a separate
+# series labelled by pid, which would be lost once merged
+
+
+def multiprocess_dir() -> str:
+    """Returns the multiprocess directory configured by the environment."""
+    return os.environ.get("PROMETHEUS_MULTIPROC_DIR", "")
+
+
+def is_alive(pid: int) -> bool:
+    """Checks whether a process exists.
+
+    :param pid: The process id
+    :type pid: int
+    :return: False if the process is known to be dead
+    :rtype: bool
+    """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # The process exists but belongs to another user
+        return True
+    return True
+
+
+def _pid_of(path: str, prefix: str) -> Optional[int]:
+    # Files are named after the process that wrote them, eg. counter_123.db
+    name = os.path.basename(path)[len(prefix) :]
+    try:
+        return int(name.split("_")[0].split(".")[0])
+    except ValueError:
+        return None
+
+
+def _dead(paths: List[str], prefix: str) -> List[str]:
+    dead = []
+    for path in paths:
+        pid = _pid_of(path, prefix)
+        if pid is not None and pid != os.getpid() and not is_alive(pid):
+            dead.append(path)
+    return dead
+
+
+def _replace(path: str, write):
+    # Archives are written aside and renamed, so that they are never read partially written
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        write(f)
+    os.replace(tmp, path)
+
+
+def _archive_values(
+    path: str, prefix: str, combine: Callable[[TValue, TValue], TValue]
+) -> int:
+    dead = _dead(glob.glob(os.path.join(path, f"{prefix}_*.db")), f"{prefix}_")
+    if not dead:
+        return 0
+    archive = os.path.join(path, f"{prefix}_archive.db")
+    totals: Dict[str, TValue] = {}
+    timestamped = False
+    for f in ([archive] if os.path.exists(archive) else []) + dead:
+        # Entries are tuples of key, value, timestamp for recent clients, and position
+        for key, value, *rest in MmapedDict.read_all_values_from_file(f):
+            timestamped = len(rest) > 1
+            entry = (value, rest[0] if timestamped else 0.0)
+            totals[key] = combine(totals[key], entry) if key in totals else entry
+    tmp = archive + ".tmp"
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    values = MmapedDict(tmp)
+    try:
+        for key, (value, timestamp) in totals.items():
+            if timestamped:
+                values.write_value(key, value, timestamp)
+            else:
+                values.write_value(key, value)
+    finally:
+        values.close()
+    os.replace(tmp, archive)
+    for f in dead:
+        os.remove(f)
+    return len(dead)
+
+
+def _compact_values(path: str) -> int:
+    """Merges value files of dead processes into one archive file per metric type."""
+    removed = 0
+    for typ in ARCHIVED_TYPES:
+        removed += _archive_values(
+            path, typ, lambda a, b: (a[0] + b[0], max(a[1], b[1]))
+        )
+    for typ, combine in ARCHIVED_GAUGES.items():
+        removed += _archive_values(path, typ, combine)
+    for typ in LIVE_GAUGES:
+        # Same as prometheus_client.multiprocess.mark_process_dead
+        for f in _dead(glob.glob(os.path.join(path, f"{typ}_*.db")), f"{typ}_"):
+            os.remove(f)
+            removed += 1
+    return removed
+
+
+def _compact_tables(path: str) -> int:
+    """Merges live metric tables of dead processes into one archive table per layout.
+
+    Unseen bins of the archive are kept by label in a separate file rather than in slots, since
+    dead processes may have admitted more distinct bins than the slots can hold.
+    """
+    prefix = SharedFrequencyTable.PREFIX
+    dead = _dead(glob.glob(os.path.join(path, prefix + "*.npy")), prefix)
+    # Tables of different baselines are archived separately
+    layouts: Dict[str, List[Tuple[str, np.ndarray]]] = {}
+    for f in dead:
+        try:
+            data = np.load(f)
+        except (OSError, ValueError):
+            # Truncated by a process that died while starting, nothing to archive
+            data = np.zeros(0)
+        layouts.setdefault(SharedFrequencyTable.layout_of(f), []).append((f, data))
+    for layout, tables in layouts.items():
+        loaded = [(f, data) for f, data in tables if data.size]
+        if layout and loaded:
+            _archive_tables(path, layout, loaded)
+        for f, _ in tables:
+            os.remove(f)
+            labels = f[: -len(".npy")] + ".labels"
+            if os.path.exists(labels):
+                os.remove(labels)
+    return len(dead)
+
+
+def _archive_tables(path: str, layout: str, tables: List[Tuple[str, np.ndarray]]):
+    base = os.path.join(
+        path, f"{SharedFrequencyTable.PREFIX}{SharedFrequencyTable.ARCHIVE}_{layout}"
+    )
+    total = np.zeros(tables[0][1].size, dtype=float)
+    unseen: TUnseen = {}
+    if os.path.exists(base + ".npy"):
+        total += np.load(base + ".npy")
+        for row, key, amount, created in SharedFrequencyTable.read_archived_unseen(
+            base + ".json"
+        ):
+            add_unseen(unseen, row, key, amount, created)
+    for f, data in tables:
+        total += data
+        labels = f[: -len(".npy")] + ".labels"
+        for row, position, key, created in SharedFrequencyTable.read_labels(labels):
+            add_unseen(unseen, row, key, float(data[position]), created)
+    rows = [
+        [row, key, amount, created]
+        for row, bins in unseen.items()
+        for key, (amount, created) in bins.items()
+    ]
+    _replace(base + ".json", lambda f: f.write(json.dumps(rows).encode()))
+    _replace(base + ".npy", lambda f: np.save(f, total))
+
+
+def compact(path: Optional[str] = None, blocking: bool = True) -> int:
+    """Merges the multiprocess files of dead processes into archive files.
+
+    Counters, histograms and summaries of dead processes are summed into one archive file per
+    metric type, which MultiProcessCollector aggregates like any other process. Histogram
+    buckets, counts and sums are all kept as plain counters, so that they remain correct once
+    archived. Min, max and most recent gauges are merged into one archive file per mode,
+    keeping the same value as MultiProcessCollector would. Gauges of "all" mode are left in
+    place, since they are exported by pid. Live gauges of dead processes are removed, same as
+    `mark_process_dead`. Live metric tables are archived by baseline layout.
+
+    This is typically called from the gunicorn `child_exit` hook, or periodically by
+    `Compactor`.
+
+    :param path: The multiprocess directory, defaults to PROMETHEUS_MULTIPROC_DIR
+    :type path: Optional[str], optional
+    :param blocking: Waits for another compaction to finish instead of skipping,
+        defaults to True
+    :type blocking: bool, optional
+    :return: The number of files removed
+    :rtype: int
+    """
+    path = path or multiprocess_dir()
+    with directory_lock(path, exclusive=True, blocking=blocking) as acquired:
+        if not acquired:
+            return 0
+        return _compact_values(path) + _compact_tables(path)
+
+
+class ArchivedMultiProcessCollector(MultiProcessCollector):
+    """Same as MultiProcessCollector, but never reads files while they are being compacted."""
+
+    def collect(self):
+        with directory_lock(self._path):
+            return super().collect()
+
+
+class Compactor:
+    """Periodically compacts the multiprocess directory from a daemon thread.
+
+    The thread is restarted in forked processes, eg. gunicorn workers of a preloaded app, so
+    that compaction keeps running if the parent exits. Python 3.6 has no fork hooks, so the
+    thread must be created after forking there.
+    """
+
+    def __init__(self, interval: float, path: Optional[str] = None):
+        """Starts a daemon thread that compacts files of dead processes.
+
+        Concurrent compactions from several processes are skipped rather than queued.
+
+        :param interval: Seconds between compactions
+        :type interval: float
+        :param path: The multiprocess directory, defaults to PROMETHEUS_MULTIPROC_DIR
+        :type path: Optional[str], optional
+        """
+        if interval <= 0:
+            raise ValueError(f"Compaction interval must be positive: {interval}")
+        self._interval = interval
+        self._path = path or multiprocess_dir()
+        self._start()
+        _compactors.add(self)
+
+    def _start(self):
+        self._closed = Event()
+        self._worker = Thread(
+            target=self._run, name="boxkite-metrics-compaction", daemon=True
+        )
+        self._worker.start()
+
+    def close(self, timeout: Optional[float] = None):
+        """Stops the worker thread.
+
+        :param timeout: Max number of seconds to wait, defaults to None
+        :type timeout: Optional[float], optional
+        """
+        _compactors.discard(self)
+        self._closed.set()
+        self._worker.join(timeout)
+
+    def _run(self):
+        while not self._closed.wait(self._interval):
+            try:
+                compact(self._path, blocking=False)
+            except Exception:
+                getLogger().exception("Failed to compact multiprocess metrics")
+
+
+# Running compactors, restarted in forked processes since threads are not inherited
+_compactors: "WeakSet[Compactor]" = WeakSet()
+
+
+def _restart_compactors():
+    for c in list(_compactors):
+        c._start()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_restart_compactors)
@@ -1,20 +1,214 @@
-from dataclasses import dataclass
-from datetime import datetime
-from typing import List, Union
+import random
+import time
+from datetime import datetime, timezone
+from typing import Any, Iterator, List, Optional, Tuple, Union
 from uuid import UUID
 
+try:
+    _monotonic_ns = time.monotonic_ns
+except AttributeError:  # pragma: no cover
+    # Python 3.6 does not have nanosecond clocks
+    def _monotonic_ns() -> int:
+        return int(time.monotonic() * 1e9)
+
+
+# Offset from the monotonic clock to unix time, sampled once per process
+_EPOCH_OFFSET_NS = int(time.time() * 1e9) - _monotonic_ns()
+
+
+# Version 4 UUID bits, see RFC 4122 section 4.4
+_UUID4_MASK = ~((0xF << 76) | (0x3 << 62)) & ((1 << 128) - 1)
+_UUID4_BITS = (0x4 << 76) | (0x2 << 62)
+
+
+def random_uuid_int() -> int:
+    """Generates a random version 4 UUID as an integer without reading from os.urandom.
+
+    :return: A 128-bit UUID integer
+    :rtype: int
+    """
+    return random.getrandbits(128) & _UUID4_MASK | _UUID4_BITS
+
+
+def format_uuid(value: int) -> str:
+    """Formats a 128-bit integer like str(UUID(int=value)) without building a UUID object.
+
+    :param value: A 128-bit UUID integer
+    :type value: int
+    :return: The canonical hyphenated hex form
+    :rtype: str
+    """
+    h = f"{value:032x}"
+    return f"{h[:8]}-{h[8:12]}-{h[12:16]}-{h[16:20]}-{h[20:]}"
+
+
+# Most predictions in a row share the same second, cached as (second, formatted)
+_last_second = (0, time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(0)))
+
+
+def _format_second(second: int) -> str:
+    global _last_second
+    cached = _last_second
+    if cached[0] != second:
+        cached = (second, time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(second)))
+        _last_second = cached
+    return cached[1]
+
+
+def now_ns() -> int:
+    """Reads the current unix time in nanoseconds from the monotonic clock.
+
+    Timestamps never go backwards within a process, even if the system clock is adjusted.
+
+    :return: Nanoseconds since epoch
+    :rtype: int
+    """
+    return _monotonic_ns() + _EPOCH_OFFSET_NS
+
 
-@dataclass(frozen=True)
 class PredictionContext:
-    entity_id: UUID
-    features: List[float]
-    request_body: str
-    server_id: str
-    # Support categorical output using str
-    output: Union[float, str]
-    created_at: datetime
+    """A single prediction to be logged and observed by live metrics.
+
+    Only the request fields, a nanosecond timestamp and an integer entity id are stored on
+    creation. The entity_id, created_at and prediction_id forms are built on first access and
+    cached, so predictions that are never looked up or exported do not pay for them.
+
+    Arguments are keyword-only, since the positional order of the former dataclass no longer
+    applies. Use to_dict or dict(prediction) in place of dataclasses.asdict.
+    """
+
+    # Fields of the former dataclass, in their original order
+    FIELDS = (
+        "entity_id",
+        "features",
+        "request_body",
+        "server_id",
+        "output",
+        "created_at",
+    )
+
+    __slots__ = (
+        "features",
+        "request_body",
+        "server_id",
+        "output",
+        "timestamp_ns",
+        "_id",
+        "_entity_id",
+        "_created_at",
+        "_prediction_id",
+    )
+
+    def __init__(
+        self,
+        *,
+        features: List[float],
+        request_body: str,
+        server_id: str,
+        # Support categorical output using str
+        output: Union[float, str],
+        entity_id: Optional[Union[UUID, int]] = None,
+        created_at: Optional[datetime] = None,
+        timestamp_ns: Optional[int] = None,
+    ):
+        """Records a prediction, defaulting to a random entity id and the current time.
+
+        :param features: The transformed feature vector
+        :type features: List[float]
+        :param request_body: The body of this prediction request
+        :type request_body: str
+        :param server_id: The model server that made this prediction
+        :type server_id: str
+        :param output: The model output
+        :type output: Union[float, str]
+        :param entity_id: Unique id of this prediction as a UUID or its integer value,
+            defaults to a random UUID
+        :type entity_id: Optional[Union[UUID, int]], optional
+        :param created_at: Time of this prediction, defaults to timestamp_ns
+        :type created_at: Optional[datetime], optional
+        :param timestamp_ns: Unix time of this prediction in nanoseconds, defaults to now
+        :type timestamp_ns: Optional[int], optional
+        """
+        self.features = features
+        self.request_body = request_body
+        self.server_id = server_id
+        self.output = output
+        if entity_id is None:
+            entity_id = random_uuid_int()
+        if isinstance(entity_id, UUID):
+            self._entity_id: Optional[UUID] = entity_id
+            self._id: int = entity_id.int
+        else:
+            self._entity_id = None
+            self._id = entity_id
+        self._created_at = created_at
+        if timestamp_ns is None:
+            timestamp_ns = int(created_at.timestamp() * 1e9) if created_at else now_ns()
+        self.timestamp_ns = timestamp_ns
+        self._prediction_id: Optional[str] = None
+
+    @property
+    def entity_id(self) -> UUID:
+        if self._entity_id is None:
+            self._entity_id = UUID(int=self._id)
+        return self._entity_id
+
+    @property
+    def created_at(self) -> datetime:
+        if self._created_at is None:
+            self._created_at = datetime.fromtimestamp(
+                self.timestamp_ns / 1e9, tz=timezone.utc
+            )
+        return self._created_at
+
+    @property
+    def timestamp(self) -> int:
+        """Unix time of this prediction in whole seconds."""
+        return self.timestamp_ns // 1000000000
 
     @property
     def prediction_id(self) -> str:
-        timestamp = self.created_at.replace(microsecond=0, tzinfo=None)
-        return f"{self.server_id}/{timestamp.isoformat()}/{self.entity_id}"
+        if self._prediction_id is None:
+            timestamp = _format_second(self.timestamp)
+            self._prediction_id = (
+                f"{self.server_id}/{timestamp}/{format_uuid(self._id)}"
+            )
+        return self._prediction_id
+
+    def as_record(self) -> dict:
+        """Converts this prediction to a serializable log record without copying features.
+
+        :return: A dictionary of prediction fields
+        :rtype: dict
+        """
+        return {
+            "entity_id": format_uuid(self._id),
+            "features": self.features,
+            "request_body": self.request_body,
+            "server_id": self.server_id,
+            "output": self.output,
+            "created_at": self.timestamp,
+        }
+
+    def to_dict(self) -> dict:
+        """Converts this prediction to a dictionary, same as dataclasses.asdict used to.
+
+        :return: A dictionary of the fields in FIELDS
+        :rtype: dict
+        """
+        return dict(self)
+
+    def __iter__(self) -> Iterator[Tuple[str, Any]]:
+        for name in self.FIELDS:
+            yield name, getattr(self, name)
+
+    def __repr__(self) -> str:
+        return f"PredictionContext(prediction_id={self.prediction_id!r})"
+
+    def __eq__(self, other: Any) -> bool:
+        if not isinstance(other, PredictionContext):
+            return NotImplemented
+        return self._id == other._id and self.timestamp_ns == other.timestamp_ns
+
+    def __hash__(self) -> int:
+        return hash((self._id, self.timestamp_ns))
@@ -0,0 +1,157 @@
+from typing import Any, List, Optional, Sequence, Set, Tuple
+
+import numpy as np
+from prometheus_client import Metric
+from prometheus_client.samples import Sample
+
+from .table import ContinuousTableVariable, DiscreteTableVariable, TableVariable
+
+
+class DriftScores:
+    """Scores the drift of every live metric from its baseline in one vectorized pass.
+
+    Counts are compared over the columns of the frequency table, where all unseen bins of a
+    discrete metric are pooled in one extra column. Same as the Grafana dashboard, each bin is
+    smoothed by adding one observation before normalizing, so that empty bins do not produce
+    infinite scores.
+
+    - PSI: population stability index, sum((live - baseline) * ln(live / baseline))
+    - KL divergence: sum(live * ln(live / baseline))
+    - KS statistic: max absolute difference of the cumulative distributions, only defined for
+      continuous metrics and computed without smoothing
+
+    Baseline distributions are precomputed once. Scores are cached by row, so each collection
+    only recomputes the metrics whose live counts changed since the previous one.
+    """
+
+    PSI_NAME = "live_metrics_psi"
+    PSI_DOC = "Population stability index of live metrics against their baseline"
+    KL_NAME = "live_metrics_kl_divergence"
+    KL_DOC = "KL divergence of live metrics from their baseline"
+    KS_NAME = "live_metrics_ks_statistic"
+    KS_DOC = (
+        "Kolmogorov-Smirnov statistic of continuous live metrics against their baseline"
+    )
+    # Names of the exported gauge samples
+    SAMPLE_NAMES = frozenset((PSI_NAME, KL_NAME, KS_NAME))
+
+    def __init__(self, metrics: Sequence[TableVariable], width: int):
+        """Precomputes the smoothed baseline distribution of each metric.
+
+        :param metrics: The live metrics bound to a frequency table, in row order
+        :type metrics: Sequence[TableVariable]
+        :param width: Number of columns in the frequency table
+        :type width: int
+        """
+        # Label sets are shared by every collection since samples are never mutated
+        self._labels = [{"metric_name": m.name} for m in metrics]
+        rows = len(metrics)
+        baseline = np.zeros((rows, width + 1))
+        # Valid columns of each row, the last one pools unseen bins of discrete metrics
+        self._mask = np.zeros((rows, width + 1), dtype=bool)
+        for row, m in enumerate(metrics):
+            baseline[row, : m.width] = m.baseline
+            self._mask[row, : m.width] = True
+            self._mask[row, width] = isinstance(m, DiscreteTableVariable)
+        self._discrete = [
+            row for row, m in enumerate(metrics) if isinstance(m, DiscreteTableVariable)
+        ]
+        self._continuous = np.array(
+            [isinstance(m, ContinuousTableVariable) for m in metrics], dtype=bool
+        )
+        self._bins = self._mask.sum(axis=1)
+        self._smoothed_baseline = self._smooth(baseline)
+        self._log_baseline = np.log(self._smoothed_baseline)
+        cumulative = np.cumsum(baseline[:, :width], axis=1)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            self._baseline_cdf = cumulative / cumulative[:, -1:]
+        # Live counts and scores of the previous collection, NaN until first scored
+        self._live = np.full(self._mask.shape, np.nan)
+        self._scores = np.full((3, rows), np.nan)
+
+    def _smooth(self, counts: np.ndarray, rows: Any = slice(None)) -> np.ndarray:
+        mask = self._mask[rows]
+        total = (counts * mask).sum(axis=1) + self._bins[rows]
+        return np.where(mask, (counts + 1) / total[:, None], 1.0)
+
+    def score(
+        self, counts: np.ndarray, unseen: Sequence[float]
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Computes the drift scores of every metric.
+
+        :param counts: The frequency table counts
+        :type counts: np.ndarray
+        :param unseen: Total count of unseen bins by discrete metric, in row order
+        :type unseen: Sequence[float]
+        :return: PSI, KL divergence and KS statistic by row, NaN when undefined
+        :rtype: Tuple[np.ndarray, np.ndarray, np.ndarray]
+        """
+        live = np.zeros(self._mask.shape)
+        live[:, :-1] = counts
+        live[self._discrete, -1] = unseen
+        # Only rows observed since the previous collection are scored again
+        rows = np.flatnonzero((live != self._live).any(axis=1))
+        if rows.size:
+            self._scores[:, rows] = self._score_rows(rows, live[rows])
+            self._live[rows] = live[rows]
+        psi, kl, ks = self._scores.copy()
+        return psi, kl, ks
+
+    def _score_rows(self, rows: np.ndarray, live: np.ndarray) -> np.ndarray:
+        mask = self._mask[rows]
+        total = (live * mask).sum(axis=1)
+        smoothed = self._smooth(live, rows)
+        baseline = self._smoothed_baseline[rows]
+        # Masked columns are 1 in both distributions, so they add nothing to the sums
+        log_ratio = np.log(smoothed) - self._log_baseline[rows]
+        psi = ((smoothed - baseline) * log_ratio).sum(axis=1)
+        kl = (smoothed * log_ratio).sum(axis=1)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            cdf = np.cumsum(live[:, :-1], axis=1) / total[:, None]
+            ks = np.abs(cdf - self._baseline_cdf[rows]).max(axis=1, initial=0.0)
+        ks = np.where(self._continuous[rows], ks, np.nan)
+        # Scores are undefined until the first observation
+        return np.where(total > 0, [psi, kl, ks], np.nan)
+
+    def collect(
+        self,
+        counts: np.ndarray,
+        unseen: Sequence[float],
+        names: Optional[Set[str]] = None,
+    ) -> List[Metric]:
+        """Exports the drift scores as gauges labelled by metric name.
+
+        Metrics without observations, and the KS statistic of discrete metrics, are omitted.
+
+        :param counts: The frequency table counts
+        :type counts: np.ndarray
+        :param unseen: Total count of unseen bins by discrete metric, in row order
+        :type unseen: Sequence[float]
+        :param names: Only exports gauges with these names, defaults to None which exports all
+        :type names: Optional[Set[str]], optional
+        :return: The list of gauges
+        :rtype: List[Metric]
+        """
+        families = [
+            (self.PSI_NAME, self.PSI_DOC),
+            (self.KL_NAME, self.KL_DOC),
+            (self.KS_NAME, self.KS_DOC),
+        ]
+        selected = [names is None or name in names for name, _ in families]
+        if not any(selected):
+            return []
+        metrics: List[Metric] = []
+        for (name, doc), scores, keep in zip(
+            families, self.score(counts, unseen), selected
+        ):
+            if not keep:
+                continue
+            gauge = Metric(name, doc, "gauge")
+            # Same samples as GaugeMetricFamily.add_metric, without validating each one
+            gauge.samples = [
+                Sample(name, labels, value)
+                for labels, value in zip(self._labels, scores.tolist())
+                if value == value
+            ]
+            metrics.append(gauge)
+        return metrics
@@ -1,13 +1,38 @@
+import gzip
 import os
-from typing import Any, Callable, Iterable, List, Mapping, Optional, Tuple
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    Mapping,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+)
 
-from prometheus_client import CollectorRegistry, generate_latest
+from prometheus_client import CollectorRegistry, Metric, generate_latest
 from prometheus_client.exposition import choose_encoder, openmetrics
 from prometheus_client.metrics import MetricWrapperBase
-from prometheus_client.multiprocess import MultiProcessCollector
 
+from .collector.type import Collector
+from .compaction import ArchivedMultiProcessCollector
 from .registry import LiveMetricRegistry
 
+OPEN_METRICS_EOF = b"# EOF\n"
+
+
+class _StaticMetrics:
+    """Adapts a list of metrics to the collector interface expected by encoders."""
+
+    def __init__(self, metrics: Sequence[Metric]):
+        self._metrics = metrics
+
+    def collect(self) -> Sequence[Metric]:
+        return self._metrics
+
 
 class MetricEncoder:
     """Encodes Prometheus metrics from collectors as either a byte string or HTTP response."""
@@ -15,29 +40,58 @@ class MetricEncoder:
     PROMETHEUS = generate_latest
     OPEN_METRICS = openmetrics.generate_latest
 
-    def __init__(self, collectors: Iterable[Any]):
+    DEFAULT_COMPRESSION_LEVEL = 6
+
+    def __init__(
+        self,
+        collectors: Iterable[Any],
+        cache_static: bool = False,
+        compression_level: int = DEFAULT_COMPRESSION_LEVEL,
+    ):
         """Builds a metric encoder using the given list of collectors. A collector is broadly
         defined here as any type that implements the `collect` method.
 
+        When cache_static is enabled, metrics from static collectors, ie. subclasses of
+        Collector, are rendered once per format and reused as byte fragments until the
+        collector returns different metric objects. Only live metrics are rendered on each call.
+        The gzip compressed fragments are cached as well.
+
         :param collectors: The collectors to fetch metrics from
         :type collectors: Iterable[Any]
+        :param cache_static: Caches rendered static metrics, defaults to False
+        :type cache_static: bool, optional
+        :param compression_level: The gzip compression level from 1 (fastest) to 9 (smallest),
+            defaults to 6
+        :type compression_level: int, optional
         """
         self._registry = CollectorRegistry(auto_describe=True)
+        self._cache_static = cache_static
+        # Collectors in registration order, used for rendering with cached fragments
+        self._collectors: List[Any] = []
+        # Rendered static metrics and their positions by sample name, by collector and encoder
+        self._fragments: Dict[
+            Tuple[int, Callable],
+            Tuple[List[Metric], List[bytes], Dict[str, List[int]]],
+        ] = {}
+        self._compression_level = compression_level
+        # Compressed static metrics by collector and encoder, keyed to their fragments
+        self._compressed: Dict[Tuple[int, Callable], Tuple[List[bytes], bytes]] = {}
 
         # Always use a new registry for collecting mmapped files under multiprocess mode
         if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
-            MultiProcessCollector(self._registry)
+            self._collectors.append(ArchivedMultiProcessCollector(self._registry))
             # Do not double register metrics that implement MultiProcessValue
             # See: prometheus_client/values.py#L31
+            # Live metrics are aggregated from their own memory mapped tables instead
             collectors = filter(
-                lambda c: not isinstance(c, LiveMetricRegistry)
-                and not isinstance(c, MetricWrapperBase)
+                lambda c: not isinstance(c, MetricWrapperBase)
                 and hasattr(c, "collect"),
                 collectors,
             )
 
         for c in collectors:
             self._registry.register(c)
+            self._collectors.append(c)
 
     def as_text(
         self, names: Optional[Iterable[str]] = None, encoder: Optional[Callable] = None
@@ -55,10 +109,135 @@ class MetricEncoder:
         :rtype: bytes
         """
         encoder = encoder or MetricEncoder.PROMETHEUS
-        registry = (
-            self._registry.restricted_registry(names) if names else self._registry
-        )
-        return encoder(registry)
+        if self._cache_static and encoder in (
+            MetricEncoder.PROMETHEUS,
+            MetricEncoder.OPEN_METRICS,
+        ):
+            return self._render(names=set(names) if names else None, encoder=encoder)
+        if not names:
+            return encoder(self._registry)
+        names = set(names)
+        metrics: List[Metric] = []
+        for c in self._collectors:
+            metrics += self._collect(c, names=names)
+        return encoder(_StaticMetrics(metrics))
+
+    def as_gzip(
+        self, names: Optional[Iterable[str]] = None, encoder: Optional[Callable] = None
+    ) -> bytes:
+        """Encodes selected metrics in the registry as a gzip compressed byte string.
+
+        With cache_static, the compressed static metrics are reused and joined with freshly
+        compressed live metrics as separate gzip members, which decompress to the same output as
+        `as_text`.
+
+        :param names: Set of metric names to include, defaults to None
+        :type names: Optional[Set[str]], optional
+        :param encoder: The metrics serializer, defaults to None
+        :type encoder: Optional[Callable], optional
+        :return: Compressed serialized metrics
+        :rtype: bytes
+        """
+        encoder = encoder or MetricEncoder.PROMETHEUS
+        if names or not (
+            self._cache_static
+            and encoder in (MetricEncoder.PROMETHEUS, MetricEncoder.OPEN_METRICS)
+        ):
+            return self.compress(self.as_text(names=names, encoder=encoder))
+        members: List[bytes] = []
+        pending: List[bytes] = []
+        for i, c in enumerate(self._collectors):
+            if not isinstance(c, Collector):
+                pending.append(self._render_live(c, names=None, encoder=encoder))
+                continue
+            if pending:
+                members.append(self.compress(b"".join(pending)))
+                pending = []
+            members.append(self._static_gzip(i, c, encoder))
+        if encoder is MetricEncoder.OPEN_METRICS:
+            pending.append(OPEN_METRICS_EOF)
+        if pending:
+            members.append(self.compress(b"".join(pending)))
+        return b"".join(members)
+
+    def compress(self, data: bytes) -> bytes:
+        """Compresses data as a single gzip member using the configured compression level.
+
+        :param data: The uncompressed data
+        :type data: bytes
+        :return: The compressed data
+        :rtype: bytes
+        """
+        return gzip.compress(data, compresslevel=self._compression_level)
+
+    def _static_gzip(
+        self, index: int, collector: Collector, encoder: Callable
+    ) -> bytes:
+        _, fragments, _ = self._static_fragments(index, collector, encoder)
+        key = (index, encoder)
+        cached = self._compressed.get(key)
+        if cached is None or cached[0] is not fragments:
+            cached = (fragments, self.compress(b"".join(fragments)))
+            self._compressed[key] = cached
+        return cached[1]
+
+    @staticmethod
+    def _collect(collector: Any, names: Optional[Set[str]]) -> List[Metric]:
+        # Live metrics registry only converts the selected metrics
+        if names is not None and isinstance(collector, LiveMetricRegistry):
+            collected = collector.collect(names=names)
+        else:
+            collected = collector.collect()
+        metrics = [_restrict(m, names) for m in collected]
+        return [m for m in metrics if m]
+
+    @classmethod
+    def _render_live(
+        cls, collector: Any, names: Optional[Set[str]], encoder: Callable
+    ) -> bytes:
+        return encode_fragment(cls._collect(collector, names), encoder)
+
+    def _render(self, names: Optional[Set[str]], encoder: Callable) -> bytes:
+        parts: List[bytes] = []
+        for i, c in enumerate(self._collectors):
+            if not isinstance(c, Collector):
+                parts.append(self._render_live(c, names=names, encoder=encoder))
+                continue
+            metrics, fragments, index = self._static_fragments(i, c, encoder)
+            if names is None:
+                parts.extend(fragments)
+                continue
+            selected = sorted({p for n in names for p in index.get(n, ())})
+            for p in selected:
+                m, fragment = metrics[p], fragments[p]
+                restricted = _restrict(m, names)
+                if restricted is m:
+                    parts.append(fragment)
+                elif restricted:
+                    parts.append(encode_fragment([restricted], encoder))
+        if encoder is MetricEncoder.OPEN_METRICS:
+            parts.append(OPEN_METRICS_EOF)
+        return b"".join(parts)
+
+    def _static_fragments(
+        self, index: int, collector: Collector, encoder: Callable
+    ) -> Tuple[List[Metric], List[bytes], Dict[str, List[int]]]:
+        metrics = list(collector.collect())
+        key = (index, encoder)
+        cached = self._fragments.get(key)
+        # Static collectors return the same metric objects until their source changes
+        if (
+            cached is None
+            or len(cached[0]) != len(metrics)
+            or any(a is not b for a, b in zip(cached[0], metrics))
+        ):
+            index: Dict[str, List[int]] = {}
+            for p, m in enumerate(metrics):
+                for name in {sample.name for sample in m.samples}:
+                    index.setdefault(name, []).append(p)
+            cached = (metrics, [encode_fragment([m], encoder) for m in metrics], index)
+            self._fragments[key] = cached
+        return cached
 
     def as_http(
         self,
@@ -82,3 +261,78 @@ class MetricEncoder:
         encoder, content_type = choose_encoder(headers.get("Accept"))
         body = self.as_text(names=params.get("name[]"), encoder=encoder)
         return body, content_type
+
+    def as_http_response(
+        self,
+        params: Optional[Mapping[str, List[str]]] = None,
+        headers: Optional[Mapping[str, str]] = None,
+    ) -> Tuple[bytes, Dict[str, str]]:
+        """Encodes all metrics in the registry as a HTTP response with content negotiation.
+
+        Same as `as_http`, but the body is gzip compressed if the Accept-Encoding header allows
+        it. The returned headers must be sent along with the body.
+
+        :param params: The request query params, defaults to None
+        :type params: Optional[Mapping[str, List[str]]], optional
+        :param headers: The HTTP request headers, defaults to None
+        :type headers: Optional[Mapping[str, str]], optional
+        :return: A tuple of response body and response headers
+        :rtype: Tuple[bytes, Dict[str, str]]
+        """
+        params = params or {}
+        headers = headers or {}
+        encoder, content_type = choose_encoder(headers.get("Accept"))
+        names = params.get("name[]")
+        if gzip_accepted(headers.get("Accept-Encoding")):
+            body = self.as_gzip(names=names, encoder=encoder)
+            return body, {"Content-Type": content_type, "Content-Encoding": "gzip"}
+        body = self.as_text(names=names, encoder=encoder)
+        return body, {"Content-Type": content_type}
+
+
+def gzip_accepted(accept_encoding: Optional[str]) -> bool:
+    """Checks whether the Accept-Encoding request header allows a gzip response.
+
+    :param accept_encoding: Value of the Accept-Encoding header
+    :type accept_encoding: Optional[str]
+    :return: True if gzip is accepted
+    :rtype: bool
+    """
+    for coding in (accept_encoding or "").split(","):
+        name, _, params = coding.partition(";")
+        if name.strip().lower() not in ("gzip", "x-gzip"):
+            continue
+        # Explicitly refused with a quality value of 0
+        _, _, quality = params.partition("q=")
+        try:
+            return not quality or float(quality) > 0
+        except ValueError:
+            return True
+    return False
+
+
+def _restrict(metric: Metric, names: Optional[Set[str]]) -> Optional[Metric]:
+    """Keeps only the samples with the given names, same as CollectorRegistry.restricted_registry.
+
+    Returns the metric itself if no sample is filtered out, or None if every sample is.
+    """
+    if names is None:
+        return metric
+    samples = [s for s in metric.samples if s.name in names]
+    if len(samples) == len(metric.samples):
+        return metric if samples else None
+    if not samples:
+        return None
+    restricted = Metric(metric.name, metric.documentation, metric.type)
+    restricted.samples = samples
+    return restricted
+
+
+def encode_fragment(metrics: Sequence[Metric], encoder: Callable) -> bytes:
+    """Renders metrics without the OpenMetrics EOF marker so that fragments can be joined."""
+    if not metrics:
+        return b""
+    output = encoder(_StaticMetrics(metrics))
+    if encoder is MetricEncoder.OPEN_METRICS and output.endswith(OPEN_METRICS_EOF):
+        output = output[: -len(OPEN_METRICS_EOF)]
+    return output
@@ -1,3 +1,4 @@
+from .asyncio_fluentd_exporter import AsyncioFluentdExporter
 from .fluentd_exporter import FluentdExporter
 
-__all__ = ["FluentdExporter"]
+__all__ = ["AsyncioFluentdExporter", "FluentdExporter"]
@@ -0,0 +1,95 @@
+import asyncio
+from logging import getLogger
+from typing import Iterable, List, Optional, Tuple
+
+from .fluentd_exporter import FluentdExporter, fluentd_config, pack_entries
+from .type import LogExporter, PredictionContext
+
+
+class AsyncioFluentdExporter(LogExporter):
+    """Exports prediction contexts to fluentd from the running event loop.
+
+    Unlike FluentdExporter, no sender thread is started. Records emitted during the same event
+    loop tick are buffered and written as a single forward mode message by a task on the loop.
+    Records are dropped when fluentd is unreachable or the buffer is full.
+    """
+
+    def __init__(self, max_buffer: int = 10000, timeout: float = 3.0):
+        """Reads the fluentd address from default Bedrock environment variables.
+
+        :param max_buffer: Max number of records waiting to be sent, defaults to 10000
+        :type max_buffer: int, optional
+        :param timeout: Seconds to wait for connecting to fluentd, defaults to 3.0
+        :type timeout: float, optional
+        """
+        self.tag, self.host, self.port = fluentd_config()
+        self._max_buffer = max_buffer
+        self._timeout = timeout
+        self._entries: List[Tuple[int, dict]] = []
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._task: Optional[asyncio.Future] = None
+        self.dropped = 0
+
+    def emit(self, prediction: PredictionContext):
+        """
+        Buffers the full prediction context to be sent to fluentd by the event loop.
+
+        Must be called from a coroutine or callback running on the event loop.
+
+        :param prediction: The completed prediction
+        :type prediction: PredictionContext
+        """
+        self.emit_batch([prediction])
+
+    def emit_batch(self, predictions: Iterable[PredictionContext]):
+        """
+        Buffers a batch of prediction contexts to be sent to fluentd by the event loop.
+
+        :param predictions: The completed predictions
+        :type predictions: Iterable[PredictionContext]
+        """
+        for p in predictions:
+            if len(self._entries) >= self._max_buffer:
+                self.dropped += 1
+                continue
+            data = FluentdExporter._serialize(p)
+            self._entries.append((data["created_at"], data))
+        if self._entries and self._task is None:
+            self._task = asyncio.ensure_future(self._send_loop())
+
+    async def _connect(self) -> asyncio.StreamWriter:
+        if self._writer is None:
+            _, self._writer = await asyncio.wait_for(
+                asyncio.open_connection(self.host, self.port), self._timeout
+            )
+        return self._writer
+
+    async def _send_loop(self):
+        try:
+            while self._entries:
+                entries, self._entries = self._entries, []
+                # Unserializable records are replaced rather than failing the whole batch
+                packet = pack_entries(self.tag, entries)
+                try:
+                    writer = await self._connect()
+                    writer.write(packet)
+                    await writer.drain()
+                except (OSError, asyncio.TimeoutError) as e:
+                    getLogger().warning(
+                        "Failed to send %d records to fluentd: %s", len(entries), e
+                    )
+                    self.dropped += len(entries)
+                    self._close_writer()
+        finally:
+            self._task = None
+
+    def _close_writer(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    async def aclose(self):
+        """Sends all buffered records and closes the connection to fluentd."""
+        if self._task is not None:
+            await self._task
+        self._close_writer()
@@ -1,6 +1,9 @@
 import os
-from dataclasses import asdict
+import traceback
+from logging import getLogger
+from typing import Iterable, List, Tuple
 
+import msgpack
 from fluent.asyncsender import FluentSender
 
 from .type import LogExporter, PredictionContext
@@ -12,30 +15,94 @@ BEDROCK_FLUENTD_ADDR = "BEDROCK_FLUENTD_ADDR"
 BEDROCK_FLUENTD_PREFIX = "BEDROCK_FLUENTD_PREFIX"
 
 
+def fluentd_config() -> Tuple[str, str, int]:
+    """Reads the fluentd tag and address from default Bedrock environment variables.
+
+    :return: A tuple of tag, host and port
+    :rtype: Tuple[str, str, int]
+    """
+    # Environment variables will be injected by model server chart
+    pod_name = os.environ.get(BEDROCK_POD_NAME, "unknown-pod")
+    endpoint_id = os.environ.get(BEDROCK_ENDPOINT_ID, "unknown-endpoint")
+    fluentd_prefix = os.environ.get(BEDROCK_FLUENTD_PREFIX, "models.predictions")
+
+    fluentd_server = os.environ.get(
+        BEDROCK_FLUENTD_ADDR, "fluentd-logging.core.svc.cluster.local"
+    ).split(":")
+    fluentd_port = int(fluentd_server[1]) if len(fluentd_server) > 1 else 24224
+    return f"{fluentd_prefix}.{endpoint_id}.{pod_name}", fluentd_server[0], fluentd_port
+
+
+def pack_entries(tag: str, entries: List[Tuple[int, dict]], **kwargs) -> bytes:
+    """Packs records as a single forward mode message: [tag, [[time, record], ...]]
+
+    Records that cannot be serialized are logged and replaced by an error record, same as
+    FluentSender.emit_with_time does for a single record.
+    See: https://github.com/fluent/fluentd/wiki/Forward-Protocol-Specification-v1
+
+    :param tag: The fluentd tag of all records
+    :type tag: str
+    :param entries: Pairs of unix time in seconds and record
+    :type entries: List[Tuple[int, dict]]
+    :return: The packed message
+    :rtype: bytes
+    """
+    try:
+        return msgpack.packb((tag, entries), **kwargs)
+    except Exception:
+        pass
+    packable = []
+    for timestamp, record in entries:
+        try:
+            msgpack.packb(record, **kwargs)
+        except Exception as e:
+            getLogger().warning("Failed to serialize record for fluentd: %s", e)
+            record = {
+                "level": "CRITICAL",
+                "message": "Can't output to log",
+                "traceback": traceback.format_exc(),
+            }
+        packable.append((timestamp, record))
+    return msgpack.packb((tag, packable), **kwargs)
+
+
+class ForwardSender(FluentSender):
+    """Async fluentd sender that can also send many records in a single forward mode message."""
+
+    def emit_entries(self, entries: List[Tuple[int, dict]]):
+        """Queues a batch of records to be sent under this sender's tag, see pack_entries.
+
+        :param entries: Pairs of unix time in seconds and record
+        :type entries: List[Tuple[int, dict]]
+        """
+        packet = pack_entries(self.tag, entries, **self.msgpack_kwargs)
+        # Queues the packet for the sender thread, same as emit_with_time after packing. This
+        # hook is only stable within the fluent-logger minor version pinned in setup.py.
+        self._send(packet)
+
+
 class FluentdExporter(LogExporter):
     def __init__(self, **kwargs):
         """Initializes an async fluentd sender using default Bedrock environment variables.
 
         Callers may override kwargs to pass additional configurations to the fluentd sender.
         """
-        # Environment variables will be injected by model server chart
-        pod_name = os.environ.get(BEDROCK_POD_NAME, "unknown-pod")
-        endpoint_id = os.environ.get(BEDROCK_ENDPOINT_ID, "unknown-endpoint")
-        fluentd_prefix = os.environ.get(BEDROCK_FLUENTD_PREFIX, "models.predictions")
-
-        fluentd_server = os.environ.get(
-            BEDROCK_FLUENTD_ADDR, "fluentd-logging.core.svc.cluster.local"
-        ).split(":")
-        fluentd_port = int(fluentd_server[1]) if len(fluentd_server) > 1 else 24224
-
-        self._sender: FluentSender = FluentSender(
-            tag=f"{fluentd_prefix}.{endpoint_id}.{pod_name}",
-            host=fluentd_server[0],
-            port=fluentd_port,
+        tag, host, port = fluentd_config()
+        self._sender: ForwardSender = ForwardSender(
+            tag=tag,
+            host=host,
+            port=port,
             queue_circular=True,
             **kwargs,
         )
 
+    @staticmethod
+    def _serialize(prediction: PredictionContext) -> dict:
+        # fluentd's msgpack version does not yet support serializing datetime, so
+        # created_at is exported as whole seconds since epoch
+        # TODO: Supports bytes type which is not json serializable
+        return prediction.as_record()
+
     def emit(self, prediction: PredictionContext):
         """
         Exports the full prediction context asynchronously to fluentd.
@@ -43,9 +110,19 @@ class FluentdExporter(LogExporter):
         :param prediction: The completed prediction
         :type prediction: PredictionContext
         """
-        data = asdict(prediction)
-        data["entity_id"] = str(prediction.entity_id)
-        # fluentd's msgpack version does not yet support serializing datetime
-        data["created_at"] = int(prediction.created_at.timestamp())
-        # TODO: Supports bytes type which is not json serializable
+        data = self._serialize(prediction)
         self._sender.emit_with_time(label=None, timestamp=data["created_at"], data=data)
+
+    def emit_batch(self, predictions: Iterable[PredictionContext]):
+        """
+        Exports a batch of prediction contexts to fluentd as a single forward mode message.
+
+        :param predictions: The completed predictions
+        :type predictions: Iterable[PredictionContext]
+        """
+        entries = []
+        for p in predictions:
+            data = self._serialize(p)
+            entries.append((data["created_at"], data))
+        if entries:
+            self._sender.emit_entries(entries)
@@ -1,4 +1,5 @@
 from abc import abstractmethod
+from typing import Iterable
 
 from ..context import PredictionContext
 
@@ -18,3 +19,15 @@ class LogExporter:
         :type prediction: PredictionContext
         """
         raise NotImplementedError
+
+    def emit_batch(self, predictions: Iterable[PredictionContext]):
+        """
+        Saves a batch of prediction contexts to an external datastore.
+
+        Subclasses should override this method if their backend supports bulk writes.
+
+        :param predictions: The completed predictions
+        :type predictions: Iterable[PredictionContext]
+        """
+        for p in predictions:
+            self.emit(p)
@@ -0,0 +1,95 @@
+import os
+from abc import ABC, abstractmethod
+from hashlib import blake2b
+from threading import Lock
+from typing import Optional
+
+from .context import now_ns, random_uuid_int
+from .exporter.fluentd_exporter import BEDROCK_POD_NAME
+
+# The constants below are injected as k8s env var when deployed on Bedrock
+BEDROCK_SERVER_ID = "BEDROCK_SERVER_ID"
+
+
+class IdGenerator(ABC):
+    """Generates the entity id of each prediction as a 128-bit UUID integer."""
+
+    @abstractmethod
+    def next_id(self, timestamp_ns: int) -> int:
+        """Generates a new id for a prediction made at the given time.
+
+        :param timestamp_ns: Unix time of the prediction in nanoseconds
+        :type timestamp_ns: int
+        :return: A unique id with valid UUID version and variant bits
+        :rtype: int
+        """
+        raise NotImplementedError
+
+
+class RandomIdGenerator(IdGenerator):
+    """Generates random version 4 UUIDs from the process' pseudo random generator.
+
+    Unlike uuid4, this does not read from os.urandom on every call.
+    """
+
+    def next_id(self, timestamp_ns: int) -> int:
+        return random_uuid_int()
+
+
+class TimeOrderedIdGenerator(IdGenerator):
+    """Generates time ordered ids using the version 7 UUID layout.
+
+    Each id packs the unix time in milliseconds, a per-process counter and a node tag. The
+    node tag is hashed from the server id, pod name, process id and process start time, so that
+    ids are unique across pods and worker processes. The counter is strictly increasing within
+    a process, which keeps ids unique and sorted even when many predictions share the same
+    millisecond or the system clock is adjusted.
+    """
+
+    SEQUENCE_BITS = 26
+    NODE_BITS = 48
+
+    def __init__(self, server_id: Optional[str] = None):
+        """Builds a generator for the current process.
+
+        :param server_id: Identifies the model server, defaults to the BEDROCK_SERVER_ID
+            environment variable
+        :type server_id: Optional[str], optional
+        """
+        self._server_id = server_id or os.environ.get(
+            BEDROCK_SERVER_ID, "unknown-server"
+        )
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._lock = Lock()
+        self._last = 0
+        tag = "/".join(
+            [
+                self._server_id,
+                os.environ.get(BEDROCK_POD_NAME, "unknown-pod"),
+                str(self._pid),
+                str(now_ns()),
+            ]
+        )
+        digest = blake2b(tag.encode(), digest_size=self.NODE_BITS // 8).digest()
+        self.node = int.from_bytes(digest, "big")
+        # Version 7 and RFC 4122 variant bits
+        self._base = 0x7 << 76 | 0x2 << 62 | self.node
+
+    def next_id(self, timestamp_ns: int) -> int:
+        if os.getpid() != self._pid:
+            # Forked workers must not reuse the parent's node tag
+            self._reset()
+        with self._lock:
+            value = max((timestamp_ns // 1000000) << self.SEQUENCE_BITS, self._last + 1)
+            self._last = value
+        millis = value >> self.SEQUENCE_BITS
+        sequence = value & ((1 << self.SEQUENCE_BITS) - 1)
+        return (
+            millis << 80
+            | (sequence >> 14) << 64
+            | (sequence & 0x3FFF) << 48
+            | self._base
+        )
@@ -0,0 +1,259 @@
+import os
+from collections import deque
+from logging import getLogger
+from threading import Condition, Event, Lock, Thread
+from typing import Deque, Iterable, List, Optional, Union
+
+from prometheus_client import Metric
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+from .context import PredictionContext
+from .registry import LiveMetricRegistry
+
+
+class ObservationPipeline:
+    """Updates live metrics from a background thread so that callers never wait on histograms.
+
+    Predictions are appended to a bounded ring buffer and drained in batches by a worker thread,
+    which updates the registry with vectorized `observe_batch` calls. Appending to and popping
+    from a deque are atomic, so the request thread does not acquire any lock unless the buffer
+    is full.
+
+    When the buffer is full, the policy decides what happens to new predictions:
+
+    - DROP_NEWEST: the new prediction is discarded
+    - DROP_OLDEST: the oldest buffered prediction is discarded to make room
+    - BLOCK: the caller waits until the worker frees up space
+
+    The buffer never holds more than its capacity. Batches larger than the capacity are buffered
+    in chunks of at most the capacity with BLOCK, and only their newest predictions are kept
+    with DROP_OLDEST.
+
+    The worker thread does not survive a fork, eg. when gunicorn preloads the app. A forked
+    process starts its own worker and an empty buffer on first use, since predictions buffered
+    before the fork are observed by the parent.
+    """
+
+    DROP_NEWEST = "drop_newest"
+    DROP_OLDEST = "drop_oldest"
+    BLOCK = "block"
+    POLICIES = (DROP_NEWEST, DROP_OLDEST, BLOCK)
+
+    DEFAULT_CAPACITY = 10000
+
+    DEPTH_NAME = "live_metrics_queue_depth"
+    DEPTH_DOC = "Number of predictions waiting to be observed by live metrics"
+    DROPPED_NAME = "live_metrics_dropped"
+    DROPPED_DOC = "Number of predictions dropped before being observed by live metrics"
+
+    def __init__(
+        self,
+        registry: LiveMetricRegistry,
+        capacity: int = DEFAULT_CAPACITY,
+        policy: str = DROP_NEWEST,
+        batch_size: int = 512,
+        interval: float = 0.05,
+    ):
+        """Starts a daemon worker thread that observes predictions on the given registry.
+
+        :param registry: The live metrics to update
+        :type registry: LiveMetricRegistry
+        :param capacity: Max number of buffered predictions, defaults to 10000
+        :type capacity: int, optional
+        :param policy: What to do when the buffer is full, defaults to DROP_NEWEST
+        :type policy: str, optional
+        :param batch_size: Max number of predictions observed at once, defaults to 512
+        :type batch_size: int, optional
+        :param interval: Seconds to wait for new predictions when idle, defaults to 0.05
+        :type interval: float, optional
+        """
+        if policy not in ObservationPipeline.POLICIES:
+            raise ValueError(f"Unsupported policy: {policy}")
+        self._registry = registry
+        self._capacity = capacity
+        self._policy = policy
+        self._batch_size = batch_size
+        self._interval = interval
+        self._closed = False
+        self._fork_lock = Lock()
+        self._start()
+
+    def _start(self):
+        self._pid = os.getpid()
+        # Items are either predictions or flush markers
+        self._queue: Deque[Union[PredictionContext, Event]] = deque()
+        self._dropped = 0
+        self._dropped_lock = Lock()
+        self._space = Condition()
+        self._wakeup = Event()
+        self._worker = Thread(
+            target=self._run, name="boxkite-observation-pipeline", daemon=True
+        )
+        self._worker.start()
+
+    def _check_fork(self):
+        if os.getpid() != self._pid:
+            # Forked processes do not inherit the worker thread
+            with self._fork_lock:
+                if os.getpid() != self._pid:
+                    self._start()
+
+    @property
+    def depth(self) -> int:
+        """Number of predictions waiting in the buffer."""
+        return len(self._queue)
+
+    @property
+    def dropped(self) -> int:
+        """Number of predictions discarded because the buffer was full."""
+        return self._dropped
+
+    def submit(self, prediction: PredictionContext) -> bool:
+        """Buffers a prediction to be observed in the background.
+
+        :param prediction: The new observation
+        :type prediction: PredictionContext
+        :return: False if the prediction was dropped
+        :rtype: bool
+        """
+        if self._closed:
+            raise RuntimeError("Observation pipeline is closed")
+        self._check_fork()
+        if len(self._queue) >= self._capacity:
+            self._make_room(1)
+        if len(self._queue) >= self._capacity:
+            self._count_dropped(1)
+            return False
+        self._queue.append(prediction)
+        return True
+
+    def submit_batch(self, predictions: List[PredictionContext]) -> int:
+        """Buffers a batch of predictions to be observed in the background.
+
+        :param predictions: The new observations
+        :type predictions: List[PredictionContext]
+        :return: Number of predictions that were buffered
+        :rtype: int
+        """
+        if self._closed:
+            raise RuntimeError("Observation pipeline is closed")
+        self._check_fork()
+        size = len(predictions)
+        if self._policy == ObservationPipeline.BLOCK and size > self._capacity > 0:
+            # Waits for room one chunk at a time, so that the buffer stays within capacity
+            return sum(
+                self.submit_batch(predictions[start : start + self._capacity])
+                for start in range(0, size, self._capacity)
+            )
+        if size > self._capacity - len(self._queue):
+            self._make_room(size)
+            free = max(self._capacity - len(self._queue), 0)
+            if size > free:
+                self._count_dropped(size - free)
+                if self._policy == ObservationPipeline.DROP_OLDEST:
+                    predictions = predictions[size - free :]
+                else:
+                    predictions = predictions[:free]
+        self._queue.extend(predictions)
+        return len(predictions)
+
+    def _make_room(self, size: int):
+        """Applies the policy for a full buffer, trying to make room for size predictions."""
+        size = min(size, self._capacity)
+        if self._policy == ObservationPipeline.DROP_OLDEST:
+            evicted = 0
+            while len(self._queue) + size > self._capacity:
+                try:
+                    item = self._queue.popleft()
+                except IndexError:
+                    break
+                if isinstance(item, Event):
+                    # Never drop flush markers
+                    self._queue.appendleft(item)
+                    break
+                evicted += 1
+            self._count_dropped(evicted)
+        elif self._policy == ObservationPipeline.BLOCK:
+            self._wakeup.set()
+            with self._space:
+                while len(self._queue) + size > self._capacity and not self._closed:
+                    self._space.wait(self._interval)
+
+    def _count_dropped(self, count: int):
+        if count > 0:
+            with self._dropped_lock:
+                self._dropped += count
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """Waits until every prediction submitted before this call has been observed.
+
+        :param timeout: Max number of seconds to wait, defaults to None
+        :type timeout: Optional[float], optional
+        :return: False if timed out
+        :rtype: bool
+        """
+        self._check_fork()
+        if not self._worker.is_alive():
+            return self.depth == 0
+        marker = Event()
+        self._queue.append(marker)
+        self._wakeup.set()
+        return marker.wait(timeout)
+
+    def close(self, timeout: Optional[float] = None):
+        """Observes all buffered predictions and stops the worker thread.
+
+        :param timeout: Max number of seconds to wait, defaults to None
+        :type timeout: Optional[float], optional
+        """
+        if self._closed:
+            return
+        self.flush(timeout)
+        self._closed = True
+        self._wakeup.set()
+        self._worker.join(timeout)
+
+    def _run(self):
+        while not self._closed:
+            if self._drain():
+                continue
+            self._wakeup.wait(self._interval)
+            self._wakeup.clear()
+
+    def _drain(self) -> int:
+        batch: List[PredictionContext] = []
+        markers: List[Event] = []
+        while len(batch) < self._batch_size:
+            try:
+                item = self._queue.popleft()
+            except IndexError:
+                break
+            if isinstance(item, Event):
+                # Observe everything before the marker first
+                markers.append(item)
+                break
+            batch.append(item)
+        if batch:
+            self._observe(batch)
+            with self._space:
+                self._space.notify_all()
+        for m in markers:
+            m.set()
+        return len(batch) + len(markers)
+
+    def _observe(self, batch: List[PredictionContext]):
+        try:
+            self._registry.observe_batch(
+                features=[p.features for p in batch],
+                outputs=[p.output for p in batch],
+            )
+        except Exception:
+            getLogger().exception("Failed to observe %d predictions", len(batch))
+
+    def collect(self) -> Iterable[Metric]:
+        yield GaugeMetricFamily(
+            name=self.DEPTH_NAME, documentation=self.DEPTH_DOC, value=self.depth
+        )
+        yield CounterMetricFamily(
+            name=self.DROPPED_NAME, documentation=self.DROPPED_DOC, value=self.dropped
+        )
@@ -1,11 +1,46 @@
-from typing import Iterable, List, MutableMapping, Optional
+import os
+import time
+from typing import (
+    Any,
+    Dict,
+    Iterable,
+    List,
+    Mapping,
+    MutableMapping,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    Type,
+)
 
+import numpy as np
 from prometheus_client import Metric
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+from prometheus_client.utils import INF
 
 from .collector.feature import FeatureDistribution
 from .collector.inference import InferenceDistribution
 from .context import PredictionContext
-from .frequency import FrequencyMetric
+from .drift import DriftScores
+from .sampling import Sampler
+from .table import (
+    ContinuousTableVariable,
+    DiscreteTableVariable,
+    FrequencyTable,
+    SharedFrequencyTable,
+    TableVariable,
+)
+from .window import FrequencyWindow, SharedFrequencyWindow
+
+# Array backed implementations of FeatureDistribution and InferenceDistribution metrics
+TABLE_SUPPORTED: Mapping[str, Type[TableVariable]] = {
+    "histogram": ContinuousTableVariable,
+    "counter": DiscreteTableVariable,
+}
+
+
+DEFAULT_WINDOW_GRANULARITY = 60.0
 
 
 def is_single_value(value):
@@ -19,56 +54,328 @@ def is_single_value(value):
 class LiveMetricRegistry:
     """An immutable collection of live metrics that can be incremented as new observations arrive."""
 
-    def __init__(self, metrics: Iterable[Metric]):
+    OVERFLOW_NAME = "live_metrics_overflow"
+    OVERFLOW_DOC = "Observations of discrete metrics counted in the overflow bin"
+    SAMPLING_RATE_NAME = "live_metrics_sampling_rate"
+    SAMPLING_RATE_DOC = (
+        "Probability of observing a prediction, live metrics are scaled by its inverse"
+    )
+
+    def __init__(
+        self,
+        metrics: Iterable[Metric],
+        max_unseen_bins: int = DiscreteTableVariable.MAX_UNSEEN_BINS,
+        feature_max_unseen_bins: Optional[Mapping[int, int]] = None,
+        sampler: Optional[Sampler] = None,
+        drift_scores: bool = False,
+        window: Optional[float] = None,
+        window_granularity: float = DEFAULT_WINDOW_GRANULARITY,
+    ):
         """Constructs live metrics based on the given baseline metrics.
 
-        Live metrics are implemented using Prometheus ValueClass and may be incremented as new
+        Live metrics are stored in a single FrequencyTable and may be incremented as new
         observations arrive. This is different from static metrics from collectors which don't
-        change over time.
+        change over time. Under multiprocess mode, the table is memory mapped under
+        PROMETHEUS_MULTIPROC_DIR so that it can be aggregated across processes.
 
         Users may export the live metrics current values using the collect method.
 
+        Discrete metrics track values missing from the baseline in new bins, up to a budget of
+        unseen bins per metric. Further unseen values are counted in a shared overflow bin.
+
         :param metrics: The collection of baseline metrics
         :type metrics: Iterable[Metric]
+        :param max_unseen_bins: Max number of unseen bins per discrete metric, defaults to 100
+        :type max_unseen_bins: int, optional
+        :param feature_max_unseen_bins: Overrides max_unseen_bins by feature index,
+            defaults to None
+        :type feature_max_unseen_bins: Optional[Mapping[int, int]], optional
+        :param sampler: Samples observations at high throughput, defaults to None which
+            observes everything
+        :type sampler: Optional[Sampler], optional
+        :param drift_scores: Exports PSI, KL divergence and KS statistic of each live metric
+            against its baseline as gauges, see DriftScores, defaults to False
+        :type drift_scores: bool, optional
+        :param window: Also exports the counts of each live metric over a sliding window of
+            this many seconds, as a gauge histogram or gauge named with a `_window` suffix,
+            defaults to None
+        :type window: Optional[float], optional
+        :param window_granularity: Seconds by which the window slides, defaults to 60
+        :type window_granularity: float, optional
         """
-        self._feature_metrics: MutableMapping[int, FrequencyMetric] = {}
-        self._inference_metric: Optional[FrequencyMetric] = None
+        self._sampler = sampler
+        self._feature_metrics: MutableMapping[int, TableVariable] = {}
+        self._inference_metric: Optional[TableVariable] = None
         for m in metrics:
             if FeatureDistribution.is_supported(m):
                 index = FeatureDistribution.extract_index(m)
-                frequency = FeatureDistribution.SUPPORTED[m.type].load_frequency(m)
+                frequency = TABLE_SUPPORTED[m.type].load_frequency(m)
+                if isinstance(frequency, DiscreteTableVariable):
+                    frequency.max_unseen_bins = (feature_max_unseen_bins or {}).get(
+                        index, max_unseen_bins
+                    )
                 self._feature_metrics[index] = frequency
             elif InferenceDistribution.is_supported(m):
-                self._inference_metric = InferenceDistribution.SUPPORTED[
-                    m.type
-                ].load_frequency(m)
+                self._inference_metric = TABLE_SUPPORTED[m.type].load_frequency(m)
+                if isinstance(self._inference_metric, DiscreteTableVariable):
+                    self._inference_metric.max_unseen_bins = max_unseen_bins
+
+        self._live: List[TableVariable] = list(self._feature_metrics.values())
+        if self._inference_metric:
+            self._live.insert(0, self._inference_metric)
+        # Index of live metrics by exported sample name, for collecting selected metrics
+        self._positions: Dict[str, int] = {
+            name: i for i, m in enumerate(self._live) for name in m.sample_names
+        }
+        if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+            self._table: FrequencyTable = SharedFrequencyTable(
+                metrics=self._live, path=os.environ["PROMETHEUS_MULTIPROC_DIR"]
+            )
+        else:
+            self._table = FrequencyTable(metrics=self._live)
+        self._drift: Optional[DriftScores] = None
+        if drift_scores:
+            self._drift = DriftScores(metrics=self._live, width=self._table.shape[1])
+        self._window: Optional[FrequencyWindow] = None
+        if window is not None and isinstance(self._table, SharedFrequencyTable):
+            self._window = SharedFrequencyWindow(
+                metrics=self._live,
+                table=self._table,
+                length=window,
+                granularity=window_granularity,
+                path=os.environ["PROMETHEUS_MULTIPROC_DIR"],
+            )
+        elif window is not None:
+            self._window = FrequencyWindow(
+                metrics=self._live,
+                table=self._table,
+                length=window,
+                granularity=window_granularity,
+            )
+        if self._window is not None:
+            for i, m in enumerate(self._live):
+                self._positions.update((name, i) for name in m.window_sample_names)
+        # Gather indices for feature vectors by size, see _plan_vector
+        self._vector_plans: MutableMapping[int, tuple] = {}
 
-    def collect(self) -> List[Metric]:
+    def collect(self, names: Optional[Set[str]] = None) -> List[Metric]:
         """Converts live metrics to a static metrics using their current values in the registry.
 
+        :param names: Only converts metrics that export any of these sample names, defaults to
+            None which converts all metrics
+        :type names: Optional[Set[str]], optional
         :return: The list of converted static metrics
         :rtype: List[Metric]
         """
-        metrics = (
-            self._inference_metric.metric.collect() if self._inference_metric else []
+        if names is None:
+            live = self._live
+        else:
+            positions = {self._positions[n] for n in names if n in self._positions}
+            live = [self._live[i] for i in sorted(positions)]
+        with_overflow = names is None or self.OVERFLOW_NAME + "_total" in names
+        with_drift = self._drift is not None and (
+            names is None or not names.isdisjoint(DriftScores.SAMPLE_NAMES)
         )
-        for _, v in self._feature_metrics.items():
-            metrics += v.metric.collect()
+        metrics: List[Metric] = []
+        # Other processes' counts are only read when any table backed metric is selected
+        if live or with_overflow or with_drift:
+            self._table.refresh()
+        for v in live:
+            metrics += v.collect()
+        if self._window is not None:
+            windowed = self._window.collect(live)
+            # Each windowed metric follows its cumulative metric
+            metrics = [m for pair in zip(metrics, windowed) for m in pair]
+        # Only exported after the first overflow to keep the exposition unchanged otherwise
+        overflow = self._discrete_overflow() if with_overflow else []
+        if overflow:
+            counter = CounterMetricFamily(
+                name=self.OVERFLOW_NAME,
+                documentation=self.OVERFLOW_DOC,
+                labels=("metric_name",),
+            )
+            for name, count in overflow:
+                counter.add_metric(labels=[name], value=count)
+            metrics.append(counter)
+        if with_drift:
+            unseen = [
+                sum(count for _, count, _ in self._table.unseen(m.row))
+                for m in self._live
+                if isinstance(m, DiscreteTableVariable)
+            ]
+            metrics += self._drift.collect(
+                counts=self._table.matrix()[0], unseen=unseen, names=names
+            )
+        if self._sampler is not None and (
+            names is None or self.SAMPLING_RATE_NAME in names
+        ):
+            metrics.append(
+                GaugeMetricFamily(
+                    name=self.SAMPLING_RATE_NAME,
+                    documentation=self.SAMPLING_RATE_DOC,
+                    value=self._sampler.rate,
+                )
+            )
         return metrics
 
+    def _discrete_overflow(self) -> List[Tuple[str, float]]:
+        overflow = [
+            (m.name, m.overflow)
+            for m in self._live
+            if isinstance(m, DiscreteTableVariable)
+        ]
+        return [(name, count) for name, count in overflow if count]
+
+    @property
+    def overflow(self) -> float:
+        """Total number of observations counted in the overflow bin of discrete metrics."""
+        return sum(count for _, count in self._discrete_overflow())
+
     def observe(self, prediction: PredictionContext):
         """Updates live metrics in the registry with a new observation.
 
+        When a sampler is configured, the observation may be skipped. Otherwise it is weighted
+        by the inverse of the sampling rate.
+
         :param prediction: The new observation
         :type prediction: PredictionContext
         """
+        if self._window is not None:
+            self._window.tick()
+        if self._sampler is None:
+            self._observe(prediction.features, prediction.output)
+            return
+        if not self._sampler.sample():
+            return
+        start = time.perf_counter()
+        self._observe(
+            prediction.features, prediction.output, weight=1 / self._sampler.rate
+        )
+        self._sampler.record(time.perf_counter() - start)
+
+    def _observe(self, features: Any, output: Any, weight: float = 1):
         # Do nothing if output is individual class probability
-        if self._inference_metric and is_single_value(prediction.output):
-            self._inference_metric.observe(prediction.output)
+        if self._inference_metric and is_single_value(output):
+            self._inference_metric.observe(output, weight=weight)
+        self._observe_features(features, weight=weight)
+
+    def _observe_features(self, features: Any, weight: float = 1):
+        if isinstance(features, np.ndarray):
+            if features.dtype.kind in "biuf":
+                self._observe_vector(features.ravel(), weight=weight)
+                return
+            features = features.tolist()
         # Do nothing if features is not iterable
-        if is_single_value(prediction.features):
+        if is_single_value(features):
             return
-        for i, v in enumerate(prediction.features):
-            # Unflattened tensors are unsupported, ignore
+        if len(features) and not is_single_value(features[0]):
+            # Nested tensors are flattened in row major order
+            try:
+                tensor = np.asarray(features)
+            except ValueError:
+                # Ragged rows cannot be stacked into a tensor
+                tensor = None
+            if tensor is not None and tensor.dtype.kind in "biuf":
+                self._observe_vector(tensor.ravel(), weight=weight)
+                return
+        for i, v in enumerate(features):
+            # Ragged tensors are unsupported, ignore
             if i in self._feature_metrics and is_single_value(v):
-                self._feature_metrics[i].observe(v)
+                self._feature_metrics[i].observe(v, weight=weight)
+
+    def _observe_vector(self, values: np.ndarray, weight: float = 1):
+        """Observes a flat numeric feature vector with a few array operations."""
+        plan = self._vector_plans.get(values.size)
+        if plan is None:
+            plan = self._vector_plans[values.size] = self._plan_vector(values.size)
+        positions, rows, bounds, last, others = plan
+        if positions.size:
+            continuous = values[positions].astype(float, copy=False)
+            nan = np.isnan(continuous)
+            # Same as bisect_left: number of upper bounds strictly below each value
+            index = np.where(nan, last, (continuous[:, None] > bounds).sum(axis=1))
+            # Same as ContinuousVariable: nan and +inf are not added to sum
+            total = np.where(nan | (continuous == INF), 0.0, continuous) * weight
+            with self._table.lock:
+                self._table.counts[rows, index] += weight
+                self._table.sums[rows] += total
+        if others:
+            row = values.tolist()
+            for i, metric in others:
+                metric.observe(row[i], weight=weight)
+
+    def _plan_vector(self, size: int):
+        """Precomputes the gather indices for feature vectors of the given size.
+
+        Continuous table metrics are bucketed together using a matrix of their upper bounds,
+        padded with +Inf. Other metrics are observed one value at a time.
+        """
+        continuous = []
+        others = []
+        for i, metric in self._feature_metrics.items():
+            if i >= size:
+                continue
+            if isinstance(metric, ContinuousTableVariable):
+                continuous.append((i, metric))
+            else:
+                others.append((i, metric))
+        width = max((m.width for _, m in continuous), default=0)
+        bounds = np.full((len(continuous), width), INF)
+        for j, (_, m) in enumerate(continuous):
+            bounds[j, : m.width] = m.bounds
+        return (
+            np.array([i for i, _ in continuous], dtype=int),
+            np.array([m.row for _, m in continuous], dtype=int),
+            bounds,
+            np.array([m.width - 1 for _, m in continuous], dtype=int),
+            others,
+        )
+
+    def observe_batch(self, features: Any, outputs: Sequence[Any]):
+        """Updates live metrics in the registry with a batch of observations.
+
+        Each tracked feature column is counted with a single vectorized update. Nested tensors
+        are flattened per row, while batches that cannot be represented as a numeric array are
+        observed one row at a time.
+
+        :param features: The feature matrix with one row per observation
+        :type features: Any
+        :param outputs: The model output for each row
+        :type outputs: Sequence[Any]
+        """
+        if self._window is not None:
+            self._window.tick()
+        if self._sampler is None:
+            self._observe_batch(features, outputs)
+            return
+        keep = self._sampler.sample_batch(len(features))
+        if not keep.any():
+            return
+        if isinstance(features, np.ndarray):
+            features = features[keep]
+        else:
+            features = [f for f, k in zip(features, keep) if k]
+        if len(outputs):
+            outputs = [o for o, k in zip(outputs, keep) if k]
+        start = time.perf_counter()
+        self._observe_batch(features, outputs, weight=1 / self._sampler.rate)
+        self._sampler.record(time.perf_counter() - start)
+
+    def _observe_batch(self, features: Any, outputs: Sequence[Any], weight: float = 1):
+        if self._inference_metric and all(is_single_value(o) for o in outputs):
+            self._inference_metric.observe_batch(outputs, weight=weight)
+        try:
+            matrix = np.asarray(features)
+        except ValueError:
+            # Ragged rows cannot be stacked into a matrix
+            matrix = None
+        if matrix is not None and matrix.ndim > 2 and matrix.dtype.kind in "biuf":
+            # Nested tensors are flattened in row major order
+            matrix = matrix.reshape(matrix.shape[0], -1)
+        if matrix is None or matrix.ndim != 2 or matrix.dtype.kind not in "biuf":
+            for row in features:
+                self._observe_features(row, weight=weight)
+            return
+        for i, metric in self._feature_metrics.items():
+            if i < matrix.shape[1]:
+                metric.observe_batch(matrix[:, i], weight=weight)
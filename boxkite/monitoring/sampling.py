@@ -0,0 +1,91 @@
+import random
+import time
+
+import numpy as np
+
+
+class Sampler:
+    """Samples observations independently with a fixed probability.
+
+    Live metrics weigh each sampled observation by the inverse of the sampling rate, so that
+    exported counts remain unbiased estimates of the true counts and can be compared against
+    the baseline directly.
+    """
+
+    def __init__(self, rate: float = 1.0):
+        """Builds a sampler that keeps each observation with probability rate.
+
+        :param rate: Probability of keeping an observation, defaults to 1.0
+        :type rate: float, optional
+        """
+        if not 0 < rate <= 1:
+            raise ValueError(f"Sampling rate must be in (0, 1]: {rate}")
+        self.rate: float = rate
+
+    def sample(self) -> bool:
+        """Decides whether to keep a single observation.
+
+        :return: True if the observation should be kept
+        :rtype: bool
+        """
+        return self.rate >= 1 or random.random() < self.rate
+
+    def sample_batch(self, size: int) -> np.ndarray:
+        """Decides whether to keep each observation in a batch.
+
+        :param size: Number of observations in the batch
+        :type size: int
+        :return: Boolean mask of observations to keep
+        :rtype: np.ndarray
+        """
+        if self.rate >= 1:
+            return np.ones(size, dtype=bool)
+        return np.random.random(size) < self.rate
+
+    def record(self, elapsed: float):
+        """Records the time spent observing sampled values. Noop for a fixed rate.
+
+        :param elapsed: Seconds spent observing
+        :type elapsed: float
+        """
+
+
+class AdaptiveSampler(Sampler):
+    """Adjusts the sampling rate so that observing takes a bounded share of CPU time.
+
+    At the end of each interval, the rate is scaled by the ratio between the budget and the
+    fraction of wall time spent observing during that interval. Updates are not synchronized
+    across threads, which may slightly skew the measured time but never the exported counts.
+    """
+
+    def __init__(
+        self, budget: float = 0.01, min_rate: float = 0.001, interval: float = 1.0
+    ):
+        """Builds a sampler that starts by keeping every observation.
+
+        :param budget: Max fraction of wall time spent observing, defaults to 0.01
+        :type budget: float, optional
+        :param min_rate: Lower bound of the sampling rate, defaults to 0.001
+        :type min_rate: float, optional
+        :param interval: Seconds between rate adjustments, defaults to 1.0
+        :type interval: float, optional
+        """
+        super().__init__(rate=1.0)
+        self._budget = budget
+        self._min_rate = min_rate
+        self._interval = interval
+        self._busy = 0.0
+        self._start = time.perf_counter()
+
+    def record(self, elapsed: float):
+        self._busy += elapsed
+        now = time.perf_counter()
+        window = now - self._start
+        if window < self._interval:
+            return
+        usage = self._busy / window
+        # Time spent observing is proportional to the sampling rate
+        rate = self.rate * self._budget / usage if usage > 0 else 1.0
+        self.rate = min(1.0, max(self._min_rate, rate))
+        self._busy = 0.0
+        self._start = now
@@ -0,0 +1,98 @@
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from logging import getLogger
+from socketserver import ThreadingMixIn
+from threading import Thread
+from typing import Callable, Dict, List, Mapping, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+
+# Renders a http response body and headers from query params and request headers
+TExport = Callable[
+    [Optional[Mapping[str, List[str]]], Optional[Mapping[str, str]]],
+    Tuple[bytes, Dict[str, str]],
+]
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    """Same as http.server.ThreadingHTTPServer, which is not available on Python 3.6."""
+
+    daemon_threads = True
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    # Keeps connections alive between scrapes
+    protocol_version = "HTTP/1.1"
+    export: TExport
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path not in MetricsServer.PATHS:
+            self._respond(404, b"Not Found\n", {"Content-Type": "text/plain"})
+            return
+        try:
+            body, headers = self.export(parse_qs(url.query), self.headers)
+        except Exception:
+            getLogger().exception("Failed to export metrics")
+            self._respond(
+                500, b"Internal Server Error\n", {"Content-Type": "text/plain"}
+            )
+            return
+        self._respond(200, body, headers)
+
+    def _respond(self, status: int, body: bytes, headers: Mapping[str, str]):
+        self.send_response(status)
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes are too frequent to be logged
+        pass
+
+
+class MetricsServer:
+    """Serves exported metrics over HTTP from its own threads and port.
+
+    Scrapes are handled by a dedicated thread per connection, so that they never occupy the
+    workers serving predictions. Connections are kept alive between scrapes.
+    """
+
+    PATHS = ("/", "/metrics")
+
+    def __init__(self, export: TExport, port: int, addr: str = ""):
+        """Binds the server socket and starts serving from a daemon thread.
+
+        :param export: Renders the response body and headers, eg.
+            ModelMonitoringService.export_http_response
+        :type export: Callable
+        :param port: The port to listen on, 0 to pick any free port
+        :type port: int
+        :param addr: The address to listen on, defaults to all interfaces
+        :type addr: str, optional
+        """
+        handler = type(
+            "MetricsHandler", (_MetricsHandler,), {"export": staticmethod(export)}
+        )
+        self._server = _ThreadingHTTPServer((addr, port), handler)
+        self._thread = Thread(
+            target=self._server.serve_forever,
+            name="boxkite-metrics-server",
+            daemon=True,
+        )
+        self._thread.start()
+
+    @property
+    def port(self) -> int:
+        """The port the server is listening on."""
+        return self._server.server_address[1]
+
+    def close(self, timeout: Optional[float] = None):
+        """Stops accepting new connections and closes the server socket.
+
+        :param timeout: Max number of seconds to wait, defaults to None
+        :type timeout: Optional[float], optional
+        """
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join(timeout)
@@ -1,7 +1,21 @@
+import asyncio
 import os
-from datetime import datetime, timezone
-from typing import Iterable, List, Mapping, Optional, Tuple
-from uuid import uuid4
+from concurrent.futures import Executor
+from functools import partial
+from logging import getLogger
+from typing import (
+    Any,
+    Dict,
+    List,
+    Mapping,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    Union,
+)
+
+import numpy as np
 
 from .collector import (
     BaselineMetricCollector,
@@ -9,15 +23,26 @@ from .collector import (
     InferenceHistogramCollector,
     InfoMetricCollector,
 )
+from .collector.feature import TFeatures
 from .collector.type import Collector
-from .context import PredictionContext
+from .compaction import Compactor, multiprocess_dir
+from .context import PredictionContext, now_ns
 from .encoder import MetricEncoder
-from .exporter import FluentdExporter
+from .exporter import AsyncioFluentdExporter, FluentdExporter
 from .exporter.type import LogExporter
-from .registry import LiveMetricRegistry
+from .identifier import BEDROCK_SERVER_ID, IdGenerator, TimeOrderedIdGenerator
+from .pipeline import ObservationPipeline
+from .registry import DEFAULT_WINDOW_GRANULARITY, LiveMetricRegistry
+from .sampling import Sampler
+from .server import MetricsServer
+from .snapshot import SnapshotCache
+from .table import DiscreteTableVariable
 
-# The constants below are injected as k8s env var when deployed on Bedrock
-BEDROCK_SERVER_ID = "BEDROCK_SERVER_ID"
+try:
+    _running_loop = asyncio.get_running_loop
+except AttributeError:  # pragma: no cover
+    # Python 3.6 only has the loop of the current thread, which is the running one in coroutines
+    _running_loop = asyncio.get_event_loop
 
 
 class ModelMonitoringService:
@@ -27,23 +52,188 @@ class ModelMonitoringService:
         self,
         log_exporter: Optional[LogExporter] = None,
         baseline_collector: Optional[BaselineMetricCollector] = None,
+        max_unseen_bins: int = DiscreteTableVariable.MAX_UNSEEN_BINS,
+        feature_max_unseen_bins: Optional[Mapping[int, int]] = None,
+        observe_in_background: bool = False,
+        queue_capacity: int = ObservationPipeline.DEFAULT_CAPACITY,
+        queue_policy: str = ObservationPipeline.DROP_NEWEST,
+        metrics_sampler: Optional[Sampler] = None,
+        log_sampler: Optional[Sampler] = None,
+        id_generator: Optional[IdGenerator] = None,
+        snapshot_ttl: Optional[float] = None,
+        compression_level: int = MetricEncoder.DEFAULT_COMPRESSION_LEVEL,
+        metrics_port: Optional[int] = None,
+        metrics_addr: str = "",
+        compaction_interval: Optional[float] = None,
+        drift_scores: bool = False,
+        window: Optional[float] = None,
+        window_granularity: float = DEFAULT_WINDOW_GRANULARITY,
     ):
+        """Initializes live metrics from the baseline and an exporter for prediction logs.
+
+        :param log_exporter: Exporter for prediction contexts, defaults to FluentdExporter
+        :type log_exporter: Optional[LogExporter], optional
+        :param baseline_collector: Source of baseline metrics, defaults to
+            BaselineMetricCollector
+        :type baseline_collector: Optional[BaselineMetricCollector], optional
+        :param max_unseen_bins: Max number of bins for values of a discrete feature that are
+            missing from the baseline, defaults to 100
+        :type max_unseen_bins: int, optional
+        :param feature_max_unseen_bins: Overrides max_unseen_bins by feature index,
+            defaults to None
+        :type feature_max_unseen_bins: Optional[Mapping[int, int]], optional
+        :param observe_in_background: Updates live metrics from a background thread instead of
+            the calling thread, defaults to False
+        :type observe_in_background: bool, optional
+        :param queue_capacity: Max number of predictions waiting to be observed in background,
+            defaults to 10000
+        :type queue_capacity: int, optional
+        :param queue_policy: What to do when the background queue is full, one of
+            "drop_newest", "drop_oldest" or "block", defaults to "drop_newest"
+        :type queue_policy: str, optional
+        :param metrics_sampler: Samples predictions observed by live metrics, which are scaled
+            by the inverse sampling rate, defaults to None which observes everything
+        :type metrics_sampler: Optional[Sampler], optional
+        :param log_sampler: Samples prediction contexts sent to the log exporter, defaults to
+            None which exports everything
+        :type log_sampler: Optional[Sampler], optional
+        :param id_generator: Generates the entity id of each prediction, defaults to
+            TimeOrderedIdGenerator
+        :type id_generator: Optional[IdGenerator], optional
+        :param snapshot_ttl: Serves exported metrics from a snapshot that is re-rendered in
+            background once older than this many seconds, defaults to None which renders
+            metrics on every export
+        :type snapshot_ttl: Optional[float], optional
+        :param compression_level: The gzip compression level of exported metrics from 1
+            (fastest) to 9 (smallest), defaults to 6
+        :type compression_level: int, optional
+        :param metrics_port: Serves metrics on this port from a separate thread, so that scrapes
+            do not occupy the prediction workers, defaults to None which does not start a server.
+            Under multiprocess mode, only one process should set this.
+        :type metrics_port: Optional[int], optional
+        :param metrics_addr: The address of the metrics server, defaults to all interfaces
+        :type metrics_addr: str, optional
+        :param compaction_interval: Under multiprocess mode, merges the metric files of dead
+            worker processes into archive files every this many seconds, defaults to None which
+            never compacts
+        :type compaction_interval: Optional[float], optional
+        :param drift_scores: Exports PSI, KL divergence and KS statistic of each feature and
+            inference against its baseline as gauges, defaults to False
+        :type drift_scores: bool, optional
+        :param window: Also exports live metrics over a sliding window of this many seconds,
+            with a `_window` suffix, defaults to None
+        :type window: Optional[float], optional
+        :param window_granularity: Seconds by which the window slides, defaults to 60
+        :type window_granularity: float, optional
+        """
         self._server_id = os.environ.get(BEDROCK_SERVER_ID, "unknown-server")
+        self._id_generator = id_generator or TimeOrderedIdGenerator(
+            server_id=self._server_id
+        )
         self._log_exporter = log_exporter or FluentdExporter()
         self._baseline_collector = baseline_collector or BaselineMetricCollector()
+        baseline = list(self._baseline_collector.collect())
         self._live_metrics = LiveMetricRegistry(
-            metrics=self._baseline_collector.collect()
-        )
-        self._info_collector = InfoMetricCollector(
-            metric=self._baseline_collector.collect()
+            metrics=baseline,
+            max_unseen_bins=max_unseen_bins,
+            feature_max_unseen_bins=feature_max_unseen_bins,
+            sampler=metrics_sampler,
+            drift_scores=drift_scores,
+            window=window,
+            window_granularity=window_granularity,
         )
+        self._log_sampler = log_sampler
+        self._info_collector = InfoMetricCollector(metric=baseline)
+        collectors = [
+            self._baseline_collector,
+            self._live_metrics,
+            self._info_collector,
+        ]
+        self._pipeline: Optional[ObservationPipeline] = None
+        if observe_in_background:
+            self._pipeline = ObservationPipeline(
+                registry=self._live_metrics,
+                capacity=queue_capacity,
+                policy=queue_policy,
+            )
+            collectors.append(self._pipeline)
         self._metric_encoder = MetricEncoder(
-            collectors=[
-                self._baseline_collector,
-                self._live_metrics,
-                self._info_collector,
-            ]
+            collectors=collectors,
+            cache_static=True,
+            compression_level=compression_level,
         )
+        self._snapshot: Optional[SnapshotCache] = None
+        if snapshot_ttl is not None:
+            self._snapshot = SnapshotCache(
+                encoder=self._metric_encoder, ttl=snapshot_ttl
+            )
+        self.metrics_server: Optional[MetricsServer] = None
+        if metrics_port is not None:
+            self.metrics_server = MetricsServer(
+                export=self.export_http_response, port=metrics_port, addr=metrics_addr
+            )
+        self._compactor: Optional[Compactor] = None
+        if compaction_interval is not None and multiprocess_dir():
+            self._compactor = Compactor(interval=compaction_interval)
+
+    def _make_prediction(
+        self,
+        request_body: str,
+        features: List[float],
+        output: Any,
+        timestamp_ns: Optional[int] = None,
+    ) -> PredictionContext:
+        if timestamp_ns is None:
+            timestamp_ns = now_ns()
+        return PredictionContext(
+            request_body=request_body,
+            features=features,
+            output=output,
+            entity_id=self._id_generator.next_id(timestamp_ns),
+            server_id=self._server_id,
+            timestamp_ns=timestamp_ns,
+        )
+
+    def _make_predictions(
+        self,
+        request_body: Union[str, Sequence[str]],
+        features: Any,
+        output: Sequence[Any],
+    ) -> Tuple[List[PredictionContext], Sequence[Any]]:
+        rows = features.tolist() if isinstance(features, np.ndarray) else features
+        outputs = output.tolist() if isinstance(output, np.ndarray) else output
+        if len(rows) != len(outputs):
+            raise ValueError(
+                f"Expected one output per row, got {len(outputs)} outputs for {len(rows)} rows"
+            )
+        bodies = (
+            [request_body] * len(rows)
+            if isinstance(request_body, (str, bytes))
+            else request_body
+        )
+        if len(bodies) != len(rows):
+            raise ValueError(
+                f"Expected one request body per row, got {len(bodies)} bodies for {len(rows)} rows"
+            )
+        timestamp_ns = now_ns()
+        preds = [
+            self._make_prediction(
+                request_body=body, features=row, output=out, timestamp_ns=timestamp_ns
+            )
+            for body, row, out in zip(bodies, rows, outputs)
+        ]
+        return preds, outputs
+
+    def _emit(self, pred: PredictionContext):
+        if self._log_sampler is None or self._log_sampler.sample():
+            self._log_exporter.emit(pred)
+
+    def _emit_batch(self, preds: List[PredictionContext]):
+        if self._log_sampler is not None:
+            keep = self._log_sampler.sample_batch(len(preds))
+            preds = [p for p, k in zip(preds, keep) if k]
+        if preds:
+            self._log_exporter.emit_batch(preds)
 
     def log_prediction(
         self, request_body: str, features: List[float], output: float
@@ -60,18 +250,74 @@ class ModelMonitoringService:
         :return: A prediction id that can be used for lookup
         :rtype: str
         """
-        pred = PredictionContext(
-            request_body=request_body,
-            features=features,
-            output=output,
-            entity_id=uuid4(),
-            server_id=self._server_id,
-            created_at=datetime.now(tz=timezone.utc),
+        pred = self._make_prediction(
+            request_body=request_body, features=features, output=output
         )
-        self._log_exporter.emit(pred)
-        self._live_metrics.observe(pred)
+        self._emit(pred)
+        if self._pipeline:
+            self._pipeline.submit(pred)
+        else:
+            self._live_metrics.observe(pred)
         return pred.prediction_id
 
+    def log_predictions(
+        self,
+        request_body: Union[str, Sequence[str]],
+        features: Any,
+        output: Sequence[Any],
+    ) -> List[str]:
+        """
+        Stores the prediction contexts of a mini-batch asynchronously in the background.
+
+        Live metrics are updated once for the whole batch and all prediction contexts are
+        exported together, which is much cheaper than calling `log_prediction` for each row.
+
+        :param request_body: The body of this prediction request, or one body per row
+        :type request_body: Union[str, Sequence[str]]
+        :param features: The transformed feature matrix with one row per prediction
+        :type features: Any
+        :param output: The model output for each row
+        :type output: Sequence[Any]
+        :return: A prediction id for each row that can be used for lookup
+        :rtype: List[str]
+        """
+        preds, outputs = self._make_predictions(
+            request_body=request_body, features=features, output=output
+        )
+        self._emit_batch(preds)
+        if self._pipeline:
+            self._pipeline.submit_batch(preds)
+        else:
+            self._live_metrics.observe_batch(features=features, outputs=outputs)
+        return [p.prediction_id for p in preds]
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """Waits until live metrics have observed every prediction logged before this call.
+
+        Only needed when observing in background, eg. before exporting metrics in tests.
+
+        :param timeout: Max number of seconds to wait, defaults to None
+        :type timeout: Optional[float], optional
+        :return: False if timed out
+        :rtype: bool
+        """
+        return self._pipeline.flush(timeout) if self._pipeline else True
+
+    def close(self, timeout: Optional[float] = None):
+        """Observes all pending predictions and stops any background thread.
+
+        :param timeout: Max number of seconds to wait, defaults to None
+        :type timeout: Optional[float], optional
+        """
+        if self._pipeline:
+            self._pipeline.close(timeout)
+        if self.metrics_server:
+            self.metrics_server.close(timeout)
+        if self._snapshot:
+            self._snapshot.close(timeout)
+        if self._compactor:
+            self._compactor.close(timeout)
+
     def export_http(
         self,
         params: Optional[Mapping[str, List[str]]] = None,
@@ -79,6 +325,8 @@ class ModelMonitoringService:
     ) -> Tuple[bytes, str]:
         """Exports the current Prometheus metrics from registry as a http response.
 
+        When snapshot_ttl is set, returns the last rendered snapshot of metrics instead.
+
         :param params: The request query params used to filter metrics, defaults to None
         :type params: Optional[Mapping[str, List[str]]], optional
         :param headers: The HTTP request headers used to specify exposition format,
@@ -87,29 +335,255 @@ class ModelMonitoringService:
         :return: A tuple of body and content_type
         :rtype: Tuple[bytes, str]
         """
+        if self._snapshot:
+            return self._snapshot.as_http(params=params, headers=headers)
         return self._metric_encoder.as_http(params=params, headers=headers)
 
+    def export_http_response(
+        self,
+        params: Optional[Mapping[str, List[str]]] = None,
+        headers: Optional[Mapping[str, str]] = None,
+    ) -> Tuple[bytes, Dict[str, str]]:
+        """Exports the current Prometheus metrics from registry as a http response, compressed
+        with gzip when the Accept-Encoding header allows it.
+
+        :param params: The request query params used to filter metrics, defaults to None
+        :type params: Optional[Mapping[str, List[str]]], optional
+        :param headers: The HTTP request headers used to specify exposition format and
+            content encoding, defaults to uncompressed Prometheus format
+        :type headers: Optional[Mapping[str, str]], optional
+        :return: A tuple of body and response headers, including Content-Type and
+            Content-Encoding
+        :rtype: Tuple[bytes, Dict[str, str]]
+        """
+        if self._snapshot:
+            return self._snapshot.as_http_response(params=params, headers=headers)
+        return self._metric_encoder.as_http_response(params=params, headers=headers)
+
     @classmethod
     def export_text(
         cls,
-        features: Iterable[Tuple[str, List[float]]],
+        features: Union[TFeatures, Collector],
         inference: Optional[List[float]] = None,
         path: Optional[str] = None,
+        workers: int = 1,
+        names: Optional[Sequence[str]] = None,
+        processes: bool = False,
     ):
         """
         Computes histogram on the input dataset and stores it to a file at specified path.
 
-        :param features: Iterable columns of (name, values)
-        :type features: Iterable[Tuple[str, List[float]]]
+        :param features: Iterable columns of (name, values), a 2-D array of rows, a DataFrame,
+            a path to a `.npy` or `.npz` file, or a feature collector such as
+            StreamingFeatureHistogramCollector for datasets that do not fit in memory
+        :type features: Union[TFeatures, Collector]
         :param inference: List of inference results, defaults to None
         :type inference: Optional[List[float]], optional
         :param path: Path to baseline histogram file, defaults to "/artefact/histogram.prom"
         :type path: Optional[str], optional
+        :param workers: Number of threads or processes computing feature histograms,
+            defaults to 1
+        :type workers: int, optional
+        :param names: Names of the columns of a 2-D array or `.npy` file, defaults to the
+            column indices
+        :type names: Optional[Sequence[str]], optional
+        :param processes: Computes feature histograms in a pool of forked processes instead of
+            threads, which avoids contention on the GIL for non-numeric columns. Only
+            available on POSIX platforms, defaults to False
+        :type processes: bool, optional
         """
-        collectors: List[Collector] = [FeatureHistogramCollector(data=features)]
+        if not isinstance(features, Collector):
+            features = FeatureHistogramCollector(
+                data=features, workers=workers, processes=processes, names=names
+            )
+        collectors: List[Collector] = [features]
         if inference is not None:
             collectors.append(InferenceHistogramCollector(data=inference))
         encoder = MetricEncoder(collectors=collectors)
         path = path or BaselineMetricCollector.DEFAULT_HISTOGRAM_PATH
         with open(path, "wb") as f:
             f.write(encoder.as_text())
+
+
+class AsyncModelMonitoringService(ModelMonitoringService):
+    """Model monitoring for servers running on an asyncio event loop, such as ASGI frameworks.
+
+    Predictions logged during the same event loop tick are observed together with a single
+    vectorized update. Both the update and rendering metrics run in an executor to keep the
+    event loop free.
+    Prediction contexts are sent by AsyncioFluentdExporter by default, which does not start a
+    sender thread.
+    """
+
+    def __init__(
+        self,
+        log_exporter: Optional[LogExporter] = None,
+        baseline_collector: Optional[BaselineMetricCollector] = None,
+        executor: Optional[Executor] = None,
+        **kwargs,
+    ):
+        """Initializes the service with an exporter that runs on the event loop.
+
+        :param log_exporter: Exporter for prediction contexts, defaults to AsyncioFluentdExporter
+        :type log_exporter: Optional[LogExporter], optional
+        :param baseline_collector: Source of baseline metrics, defaults to
+            BaselineMetricCollector
+        :type baseline_collector: Optional[BaselineMetricCollector], optional
+        :param executor: Executor for observing and rendering metrics, defaults to the loop's
+            default executor
+        :type executor: Optional[Executor], optional
+        """
+        super().__init__(
+            log_exporter=log_exporter or AsyncioFluentdExporter(),
+            baseline_collector=baseline_collector,
+            **kwargs,
+        )
+        self._executor = executor
+        self._pending: List[PredictionContext] = []
+        # Batches being observed in the executor
+        self._observing: Set[asyncio.Future] = set()
+
+    async def alog_prediction(
+        self, request_body: str, features: List[float], output: float
+    ) -> str:
+        """
+        Stores the prediction context without blocking the event loop.
+
+        :param request_body: The body of this prediction request
+        :type request_body: str
+        :param features: The transformed feature vector
+        :type features: List[float]
+        :param output: The model output
+        :type output: float
+        :return: A prediction id that can be used for lookup
+        :rtype: str
+        """
+        pred = self._make_prediction(
+            request_body=request_body, features=features, output=output
+        )
+        self._emit(pred)
+        self._observe_soon([pred])
+        return pred.prediction_id
+
+    async def alog_predictions(
+        self,
+        request_body: Union[str, Sequence[str]],
+        features: Any,
+        output: Sequence[Any],
+    ) -> List[str]:
+        """
+        Stores the prediction contexts of a mini-batch without blocking the event loop.
+
+        :param request_body: The body of this prediction request, or one body per row
+        :type request_body: Union[str, Sequence[str]]
+        :param features: The transformed feature matrix with one row per prediction
+        :type features: Any
+        :param output: The model output for each row
+        :type output: Sequence[Any]
+        :return: A prediction id for each row that can be used for lookup
+        :rtype: List[str]
+        """
+        preds, _ = self._make_predictions(
+            request_body=request_body, features=features, output=output
+        )
+        self._emit_batch(preds)
+        self._observe_soon(preds)
+        return [p.prediction_id for p in preds]
+
+    def _observe_soon(self, preds: List[PredictionContext]):
+        if not self._pending:
+            _running_loop().call_soon(self._observe_pending)
+        self._pending.extend(preds)
+
+    def _observe_pending(self):
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+        if self._pipeline:
+            self._pipeline.submit_batch(batch)
+            return
+        future = _running_loop().run_in_executor(
+            self._executor,
+            partial(
+                self._live_metrics.observe_batch,
+                features=[p.features for p in batch],
+                outputs=[p.output for p in batch],
+            ),
+        )
+        self._observing.add(future)
+        future.add_done_callback(self._observed)
+
+    def _observed(self, future: asyncio.Future):
+        self._observing.discard(future)
+        if not future.cancelled() and future.exception() is not None:
+            getLogger().error(
+                "Failed to observe predictions", exc_info=future.exception()
+            )
+
+    async def _observe_all(self):
+        # Include predictions logged earlier in the current tick
+        self._observe_pending()
+        if self._observing:
+            await asyncio.wait(list(self._observing))
+
+    async def aexport_http(
+        self,
+        params: Optional[Mapping[str, List[str]]] = None,
+        headers: Optional[Mapping[str, str]] = None,
+    ) -> Tuple[bytes, str]:
+        """Exports the current Prometheus metrics from registry as a http response.
+
+        Rendering runs in the executor so that the event loop can keep serving predictions.
+
+        :param params: The request query params used to filter metrics, defaults to None
+        :type params: Optional[Mapping[str, List[str]]], optional
+        :param headers: The HTTP request headers used to specify exposition format,
+            defaults to Prometheus but also supports OpenMetrics
+        :type headers: Optional[Mapping[str, str]], optional
+        :return: A tuple of body and content_type
+        :rtype: Tuple[bytes, str]
+        """
+        await self._observe_all()
+        return await _running_loop().run_in_executor(
+            self._executor, partial(self.export_http, params=params, headers=headers)
+        )
+
+    async def aexport_http_response(
+        self,
+        params: Optional[Mapping[str, List[str]]] = None,
+        headers: Optional[Mapping[str, str]] = None,
+    ) -> Tuple[bytes, Dict[str, str]]:
+        """Exports the current Prometheus metrics from registry as a http response, compressed
+        with gzip when the Accept-Encoding header allows it.
+
+        Rendering and compression run in the executor.
+
+        :param params: The request query params used to filter metrics, defaults to None
+        :type params: Optional[Mapping[str, List[str]]], optional
+        :param headers: The HTTP request headers used to specify exposition format and
+            content encoding, defaults to uncompressed Prometheus format
+        :type headers: Optional[Mapping[str, str]], optional
+        :return: A tuple of body and response headers
+        :rtype: Tuple[bytes, Dict[str, str]]
+        """
+        await self._observe_all()
+        return await _running_loop().run_in_executor(
+            self._executor,
+            partial(self.export_http_response, params=params, headers=headers),
+        )
+
+    async def aclose(self):
+        """Observes all pending predictions and sends buffered prediction contexts."""
+        await self._observe_all()
+        if self._pipeline:
+            await _running_loop().run_in_executor(self._executor, self._pipeline.close)
+        if self.metrics_server:
+            await _running_loop().run_in_executor(
+                self._executor, self.metrics_server.close
+            )
+        if self._snapshot:
+            await _running_loop().run_in_executor(self._executor, self._snapshot.close)
+        if self._compactor:
+            await _running_loop().run_in_executor(self._executor, self._compactor.close)
+        if isinstance(self._log_exporter, AsyncioFluentdExporter):
+            await self._log_exporter.aclose()
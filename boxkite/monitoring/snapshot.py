@@ -0,0 +1,211 @@
+import os
+import time
+from collections import OrderedDict
+from logging import getLogger
+from threading import Event, Lock, Thread
+from typing import Callable, Dict, List, Mapping, Optional, Set, Tuple
+
+from prometheus_client.core import GaugeMetricFamily
+from prometheus_client.exposition import choose_encoder
+
+from .encoder import OPEN_METRICS_EOF, MetricEncoder, encode_fragment, gzip_accepted
+
+# A snapshot is identified by its encoder and selected metric names
+TKey = Tuple[Callable, Optional[Tuple[str, ...]]]
+
+
+class SnapshotCache:
+    """Serves rendered metrics from memory and re-renders them in the background once stale.
+
+    The first request for a given format and selection of metric names is rendered
+    synchronously. Later requests always return the last completed snapshot immediately, and
+    schedule a re-render on a worker thread when the snapshot is older than the TTL, ie.
+    stale-while-revalidate. Snapshots that are no longer requested are not re-rendered.
+
+    Each response includes a gauge with the age of the snapshot in seconds, so that operators
+    can tell how old the exported data is.
+
+    A forked process, eg. a gunicorn worker of a preloaded app, drops the snapshots of its
+    parent and starts its own worker thread on first use.
+    """
+
+    AGE_NAME = "metrics_snapshot_age_seconds"
+    AGE_DOC = "Seconds since the exported metrics were rendered"
+
+    DEFAULT_MAX_SNAPSHOTS = 16
+
+    def __init__(
+        self,
+        encoder: MetricEncoder,
+        ttl: float,
+        max_snapshots: int = DEFAULT_MAX_SNAPSHOTS,
+    ):
+        """Starts a daemon worker thread that re-renders stale snapshots.
+
+        :param encoder: Renders the metrics
+        :type encoder: MetricEncoder
+        :param ttl: Seconds before a snapshot is re-rendered
+        :type ttl: float
+        :param max_snapshots: Max number of snapshots kept in memory, least recently used
+            snapshots are evicted first, defaults to 16
+        :type max_snapshots: int, optional
+        """
+        if ttl <= 0:
+            raise ValueError(f"Snapshot TTL must be positive: {ttl}")
+        self._encoder = encoder
+        self._ttl = ttl
+        self._max_snapshots = max_snapshots
+        self._closed = False
+        self._fork_lock = Lock()
+        self._start()
+
+    def _start(self):
+        self._pid = os.getpid()
+        # Rendered body and monotonic time when rendering started
+        self._snapshots: "OrderedDict[TKey, Tuple[bytes, float]]" = OrderedDict()
+        self._lock = Lock()
+        self._stale: Set[TKey] = set()
+        # Compressed snapshot without the OpenMetrics EOF, keyed to the uncompressed body
+        self._compressed: Dict[TKey, Tuple[bytes, bytes]] = {}
+        self._wakeup = Event()
+        self._worker = Thread(
+            target=self._run, name="boxkite-metrics-snapshot", daemon=True
+        )
+        self._worker.start()
+
+    def as_http(
+        self,
+        params: Optional[Mapping[str, List[str]]] = None,
+        headers: Optional[Mapping[str, str]] = None,
+    ) -> Tuple[bytes, str]:
+        """Returns the last snapshot of metrics as a HTTP response, same as MetricEncoder.as_http.
+
+        :param params: The request query params, defaults to None
+        :type params: Optional[Mapping[str, List[str]]], optional
+        :param headers: The HTTP request headers, defaults to None
+        :type headers: Optional[Mapping[str, str]], optional
+        :return: A tuple of response body and content type
+        :rtype: Tuple[bytes, str]
+        """
+        key, content_type = self._negotiate(params, headers)
+        return self._with_age(self._get(key), key), content_type
+
+    def as_http_response(
+        self,
+        params: Optional[Mapping[str, List[str]]] = None,
+        headers: Optional[Mapping[str, str]] = None,
+    ) -> Tuple[bytes, Dict[str, str]]:
+        """Returns the last snapshot of metrics as a HTTP response with content negotiation,
+        same as MetricEncoder.as_http_response.
+
+        The compressed snapshot is cached until the next re-render.
+
+        :param params: The request query params, defaults to None
+        :type params: Optional[Mapping[str, List[str]]], optional
+        :param headers: The HTTP request headers, defaults to None
+        :type headers: Optional[Mapping[str, str]], optional
+        :return: A tuple of response body and response headers
+        :rtype: Tuple[bytes, Dict[str, str]]
+        """
+        key, content_type = self._negotiate(params, headers)
+        snapshot = self._get(key)
+        if not gzip_accepted((headers or {}).get("Accept-Encoding")):
+            return self._with_age(snapshot, key), {"Content-Type": content_type}
+        body = snapshot[0]
+        cached = self._compressed.get(key)
+        if cached is None or cached[0] is not body:
+            head = body[: -len(OPEN_METRICS_EOF)] if self._has_eof(body) else body
+            cached = (body, self._encoder.compress(head))
+            self._compressed[key] = cached
+        # The age gauge and EOF are appended as a separate gzip member
+        tail = self._with_age((b"", snapshot[1]), key)
+        if self._has_eof(body):
+            tail += OPEN_METRICS_EOF
+        return cached[1] + self._encoder.compress(tail), {
+            "Content-Type": content_type,
+            "Content-Encoding": "gzip",
+        }
+
+    @staticmethod
+    def _has_eof(body: bytes) -> bool:
+        return body.endswith(OPEN_METRICS_EOF)
+
+    @staticmethod
+    def _negotiate(
+        params: Optional[Mapping[str, List[str]]],
+        headers: Optional[Mapping[str, str]],
+    ) -> Tuple[TKey, str]:
+        params = params or {}
+        headers = headers or {}
+        encoder, content_type = choose_encoder(headers.get("Accept"))
+        names = params.get("name[]")
+        return (encoder, tuple(sorted(set(names))) if names else None), content_type
+
+    def _get(self, key: TKey) -> Tuple[bytes, float]:
+        if os.getpid() != self._pid:
+            # Forked processes do not inherit the worker thread, and export their own metrics
+            with self._fork_lock:
+                if os.getpid() != self._pid:
+                    self._start()
+        with self._lock:
+            snapshot = self._snapshots.get(key)
+            if snapshot is not None:
+                self._snapshots.move_to_end(key)
+        if snapshot is None:
+            snapshot = self._render(key)
+        elif time.monotonic() - snapshot[1] >= self._ttl:
+            with self._lock:
+                self._stale.add(key)
+            self._wakeup.set()
+        return snapshot
+
+    def _render(self, key: TKey) -> Tuple[bytes, float]:
+        encoder, names = key
+        start = time.monotonic()
+        snapshot = (self._encoder.as_text(names=names, encoder=encoder), start)
+        with self._lock:
+            self._snapshots[key] = snapshot
+            self._snapshots.move_to_end(key)
+            while len(self._snapshots) > self._max_snapshots:
+                evicted, _ = self._snapshots.popitem(last=False)
+                self._compressed.pop(evicted, None)
+        return snapshot
+
+    def _with_age(self, snapshot: Tuple[bytes, float], key: TKey) -> bytes:
+        encoder, names = key
+        body, rendered_at = snapshot
+        if names and self.AGE_NAME not in names:
+            return body
+        age = GaugeMetricFamily(
+            name=self.AGE_NAME,
+            documentation=self.AGE_DOC,
+            value=time.monotonic() - rendered_at,
+        )
+        fragment = encode_fragment([age], encoder)
+        if self._has_eof(body):
+            return body[: -len(OPEN_METRICS_EOF)] + fragment + OPEN_METRICS_EOF
+        return body + fragment
+
+    def close(self, timeout: Optional[float] = None):
+        """Stops the worker thread.
+
+        :param timeout: Max number of seconds to wait, defaults to None
+        :type timeout: Optional[float], optional
+        """
+        self._closed = True
+        self._wakeup.set()
+        self._worker.join(timeout)
+
+    def _run(self):
+        while not self._closed:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            with self._lock:
+                stale, self._stale = self._stale, set()
+            for key in stale:
+                if self._closed:
+                    return
+                try:
+                    self._render(key)
+                except Exception:
+                    getLogger().exception("Failed to render metrics snapshot")
@@ -0,0 +1,814 @@
+import glob
+import hashlib
+import itertools
+import json
+import math
+import os
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from threading import Lock
+from typing import Dict, List, Mapping, Optional, Sequence, Set, Tuple
+
+import numpy as np
+from prometheus_client import Metric
+from prometheus_client.utils import INF, floatToGoString
+
+from .frequency import ContinuousVariable, DiscreteVariable, FrequencyMetric, TBin
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    # Multiprocess mode is only supported on Unix, same as prometheus_client
+    fcntl = None
+
+# Serializes compaction of the multiprocess directory with scrapes reading it
+LOCK_FILE = "boxkite_compact.lock"
+
+# Count and creation time of unseen bins by row and label
+TUnseen = Dict[int, Dict[str, List[float]]]
+
+
+def add_unseen(unseen: TUnseen, row: int, key: str, amount: float, created: float):
+    """Adds to the count of an unseen bin, keeping the earliest creation time.
+
+    :param unseen: Unseen bins by row and label
+    :type unseen: TUnseen
+    :param row: Index of the row
+    :type row: int
+    :param key: Label of the unseen bin
+    :type key: str
+    :param amount: The amount to add
+    :type amount: float
+    :param created: When the bin was first observed
+    :type created: float
+    """
+    bins = unseen.setdefault(row, {})
+    if key in bins:
+        bins[key][0] += amount
+        bins[key][1] = min(bins[key][1], created)
+    else:
+        bins[key] = [amount, created]
+
+
+@contextmanager
+def directory_lock(path: str, exclusive: bool = False, blocking: bool = True):
+    """Locks the multiprocess directory across processes.
+
+    Readers hold a shared lock while compaction holds an exclusive lock, so that files are
+    never counted both before and after being archived.
+
+    :param path: The multiprocess directory
+    :type path: str
+    :param exclusive: Acquires an exclusive lock instead of a shared one, defaults to False
+    :type exclusive: bool, optional
+    :param blocking: Waits for the lock, defaults to True
+    :type blocking: bool, optional
+    :return: A context manager yielding whether the lock was acquired
+    """
+    with open(os.path.join(path, LOCK_FILE), "a") as f:
+        if fcntl is None:
+            yield True
+            return
+        flags = fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+        try:
+            fcntl.flock(f, flags if blocking else flags | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class FrequencyTable:
+    """A contiguous matrix of bin counts shared by every live metric in a registry.
+
+    Each frequency metric owns one row of the matrix and each of its bins owns one column, so
+    that observations only increment an array element instead of a Prometheus value object.
+    Rows are padded with zeros up to the widest metric. Counts of discrete values missing from
+    the baseline are kept by row in the order they are first observed.
+    """
+
+    def __init__(self, metrics: Sequence["TableVariable"]):
+        """Allocates the count matrix and binds each metric to a row.
+
+        :param metrics: The live metrics to store in this table
+        :type metrics: Sequence[TableVariable]
+        """
+        width = max((m.width for m in metrics), default=0)
+        self.shape: Tuple[int, int] = (len(metrics), width)
+        self._allocate()
+        for row, m in enumerate(metrics):
+            m.bind(table=self, row=row)
+
+    def _allocate(self):
+        rows, width = self.shape
+        self.counts: np.ndarray = np.zeros((rows, width), dtype=float)
+        self.sums: np.ndarray = np.zeros(rows, dtype=float)
+        self._unseen: TUnseen = {}
+        self._lock = Lock()
+
+    @property
+    def lock(self) -> Lock:
+        """Must be held while reading or writing the table."""
+        return self._lock
+
+    def inc_unseen(self, row: int, key: str, amount: float):
+        """Increments the count of a bin missing from the baseline, must hold the lock.
+
+        :param row: Index of the row
+        :type row: int
+        :param key: Label of the unseen bin
+        :type key: str
+        :param amount: The amount to increment by
+        :type amount: float
+        """
+        add_unseen(self._unseen, row, key, amount, time.time())
+
+    def refresh(self):
+        """Prepares the table for collecting its metrics, called once before each collection."""
+
+    def matrix(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Copies the current counts and sums of every row.
+
+        :return: A tuple of the count matrix and row sums
+        :rtype: Tuple[np.ndarray, np.ndarray]
+        """
+        with self.lock:
+            return self.counts.copy(), self.sums.copy()
+
+    def snapshot(self, row: int):
+        """Copies the current counts and sum of a single row.
+
+        :param row: Index of the row
+        :type row: int
+        :return: A tuple of bin counts and sum
+        :rtype: Tuple[np.ndarray, float]
+        """
+        with self.lock:
+            return self.counts[row].copy(), float(self.sums[row])
+
+    def unseen(self, row: int) -> List[Tuple[str, float, float]]:
+        """Copies the counts of unseen bins of a single row, in the order they were observed.
+
+        :param row: Index of the row
+        :type row: int
+        :return: A list of bin labels, counts and creation times
+        :rtype: List[Tuple[str, float, float]]
+        """
+        with self.lock:
+            return self._ordered(self._unseen.get(row, {}))
+
+    @staticmethod
+    def _ordered(bins: Mapping[str, List[float]]) -> List[Tuple[str, float, float]]:
+        ordered = [(key, count, created) for key, (count, created) in bins.items()]
+        # Stable sort keeps the insertion order of bins created at the same time
+        ordered.sort(key=lambda b: b[2])
+        return ordered
+
+
+class SharedFrequencyTable(FrequencyTable):
+    """A FrequencyTable stored in a memory mapped file that is aggregated across processes.
+
+    Each worker process writes to its own file in the multiprocess directory, so that
+    observations remain plain array increments without any cross-process locking. The file
+    layout is fixed by the baseline: the count matrix, the sum of each row and a slot for each
+    unseen bin that discrete metrics may track. Labels of unseen bins are appended to a sidecar
+    file as they are admitted. Tables of dead processes may be merged into an archive table, see
+    `boxkite.monitoring.compaction`.
+
+    Collecting metrics sums the files of every worker with the same layout in one vectorized
+    pass, similar to prometheus_client.multiprocess.MultiProcessCollector.
+    """
+
+    PREFIX = "boxkite_live_"
+    ARCHIVE = "archive"
+
+    # Distinguishes tables created by the same process
+    _instances = itertools.count()
+    _fork_lock = Lock()
+
+    def __init__(self, metrics: Sequence["TableVariable"], path: str):
+        """Allocates a memory mapped table for this process under the given directory.
+
+        :param metrics: The live metrics to store in this table
+        :type metrics: Sequence[TableVariable]
+        :param path: The multiprocess directory, usually PROMETHEUS_MULTIPROC_DIR
+        :type path: str
+        """
+        self._path = path
+        # Offset and number of unseen bin slots by row of discrete metrics
+        self._slots: Dict[int, Tuple[int, int]] = {}
+        offset = 0
+        for row, m in enumerate(metrics):
+            if isinstance(m, DiscreteTableVariable):
+                self._slots[row] = (offset, m.max_unseen_bins + 1)
+                offset += m.max_unseen_bins + 1
+        self._slot_count = offset
+        # Tables of different baselines may have the same shape, so files are named after a
+        # digest of the bins and unseen slots of each row
+        layout = [
+            [m.name, m.bin_labels, self._slots.get(row, (0, 0))[1]]
+            for row, m in enumerate(metrics)
+        ]
+        self.layout: str = hashlib.sha1(json.dumps(layout).encode()).hexdigest()[:16]
+        self._merged: Optional[tuple] = None
+        super().__init__(metrics)
+
+    def _allocate(self):
+        rows, width = self.shape
+        self._pid = os.getpid()
+        # Pids are reused by recycled workers, whose files must not truncate those of a dead
+        # process that were not compacted yet
+        token = os.urandom(4).hex()
+        name = f"{self.PREFIX}{self._pid}_{self.layout}_{token}_{next(self._instances)}"
+        self._file = os.path.join(self._path, name + ".npy")
+        self._labels_file = os.path.join(self._path, name + ".labels")
+        self._size = rows * (width + 1) + self._slot_count
+        self._data = np.lib.format.open_memmap(
+            self._file, mode="w+", dtype=float, shape=(self._size,)
+        )
+        self.counts, self.sums, self._slot_counts = self._split(self._data)
+        # Slot of each admitted unseen bin by row
+        self._slot_index: Dict[int, Dict[str, int]] = {}
+        self._labels = open(self._labels_file, "w")
+        self._lock = Lock()
+
+    def _split(self, data: np.ndarray):
+        rows, width = self.shape
+        matrix = data[: rows * (width + 1)].reshape(rows, width + 1)
+        return matrix[:, :width], matrix[:, width], data[rows * (width + 1) :]
+
+    @property
+    def lock(self) -> Lock:
+        if os.getpid() != self._pid:
+            # Forked workers must not write to the parent's file
+            with self._fork_lock:
+                if os.getpid() != self._pid:
+                    self._allocate()
+        return self._lock
+
+    def inc_unseen(self, row: int, key: str, amount: float):
+        index = self._slot_index.setdefault(row, {})
+        slot = index.get(key)
+        if slot is None:
+            offset, size = self._slots[row]
+            # Unseen bins are bounded by max_unseen_bins and the overflow bin
+            slot = offset + min(len(index), size - 1)
+            index[key] = slot
+            # The label is written before any count so that scrapes never miss it
+            position = self._data.size - self._slot_count + slot
+            self._labels.write(json.dumps([row, position, key, time.time()]) + "\n")
+            self._labels.flush()
+        self._slot_counts[slot] += amount
+
+    def refresh(self):
+        total = np.zeros(self._size, dtype=float)
+        unseen: TUnseen = {}
+        with directory_lock(self._path):
+            for path in glob.glob(os.path.join(self._path, self.PREFIX + "*.npy")):
+                # Skip tables of other baselines
+                if self.layout_of(path) != self.layout:
+                    continue
+                try:
+                    data = np.load(path, mmap_mode="r")
+                except (OSError, ValueError):
+                    # Files may be truncated while their process is starting
+                    continue
+                if data.shape != total.shape:
+                    continue
+                total += data
+                base = path[: -len(".npy")]
+                for row, position, key, created in self.read_labels(base + ".labels"):
+                    add_unseen(unseen, row, key, float(data[position]), created)
+                for row, key, amount, created in self.read_archived_unseen(
+                    base + ".json"
+                ):
+                    add_unseen(unseen, row, key, amount, created)
+        counts, sums, _ = self._split(total)
+        self._merged = (counts, sums, unseen)
+
+    @classmethod
+    def layout_of(cls, path: str) -> str:
+        """Parses the layout digest from the name of a table file or an archive table.
+
+        :param path: The table file
+        :type path: str
+        :return: The layout digest, empty if the name has none
+        :rtype: str
+        """
+        # Files are named {pid}_{layout}_{token}_{n} or archive_{layout} after the prefix
+        parts = os.path.basename(path)[len(cls.PREFIX) :].split(".")[0].split("_")
+        return parts[1] if len(parts) > 1 else ""
+
+    @staticmethod
+    def read_labels(path: str) -> List[Tuple[int, int, str, float]]:
+        """Reads the row, position in the table file, label and creation time of each unseen
+        bin admitted by a process.
+
+        :param path: The sidecar file of a table
+        :type path: str
+        :return: A list of rows, positions, labels and creation times
+        :rtype: List[Tuple[int, int, str, float]]
+        """
+        labels = []
+        try:
+            with open(path) as f:
+                for line in f:
+                    try:
+                        row, position, key, created = json.loads(line)
+                    except ValueError:
+                        # Skip a partially written line
+                        continue
+                    labels.append((row, position, key, created))
+        except OSError:
+            pass
+        return labels
+
+    @staticmethod
+    def read_archived_unseen(path: str) -> List[Tuple[int, str, float, float]]:
+        """Reads the row, label, count and creation time of each unseen bin of an archive table.
+
+        :param path: The unseen bins file of an archive table
+        :type path: str
+        :return: A list of rows, labels, counts and creation times
+        :rtype: List[Tuple[int, str, float, float]]
+        """
+        try:
+            with open(path) as f:
+                return [tuple(b) for b in json.load(f)]
+        except OSError:
+            return []
+
+    def matrix(self) -> Tuple[np.ndarray, np.ndarray]:
+        if self._merged is None:
+            self.refresh()
+        counts, sums, _ = self._merged
+        return counts.copy(), sums.copy()
+
+    def snapshot(self, row: int):
+        if self._merged is None:
+            self.refresh()
+        counts, sums, _ = self._merged
+        return counts[row].copy(), float(sums[row])
+
+    def unseen(self, row: int) -> List[Tuple[str, float, float]]:
+        if self._merged is None:
+            self.refresh()
+        # Bins admitted later never displace earlier ones from the budget once aggregated
+        return self._ordered(self._merged[2].get(row, {}))
+
+
+def _to_float(value: Optional[TBin]) -> float:
+    """Converts a single observation to float, mapping None and unparseable values to nan."""
+    if type(value) is float:
+        return value
+    if value is None:
+        return math.nan
+    try:
+        return float(value)
+    except (ValueError, TypeError):
+        # TypeError should not be possible with type checking but handling just in case
+        return math.nan
+
+
+class TableVariable(FrequencyMetric):
+    """Base type for frequency metrics whose counts are stored in a FrequencyTable.
+
+    The Prometheus metric is only materialized when `collect` is called.
+    """
+
+    WINDOW_SUFFIX = "_window"
+    # Suffixes of the sample names exported by collect
+    SAMPLE_SUFFIXES: Tuple[str, ...] = ()
+
+    name: str
+    documentation: str
+    width: int
+    # Baseline count of each column
+    baseline: np.ndarray
+    _table: Optional[FrequencyTable] = None
+    _row: int = -1
+
+    def bind(self, table: FrequencyTable, row: int):
+        """Assigns a row of the frequency table to this metric.
+
+        :param table: The table allocated by the registry
+        :type table: FrequencyTable
+        :param row: Index of the row owned by this metric
+        :type row: int
+        """
+        self._table = table
+        self._row = row
+
+    @property
+    def row(self) -> int:
+        """Index of the frequency table row owned by this metric."""
+        return self._row
+
+    def observe(
+        self,
+        value: Optional[TBin],
+        labels: Optional[Mapping[str, str]] = None,
+        weight: float = 1,
+    ):
+        """Adds a new observation to the frequency table by incrementing the appropriate bin.
+
+        :param value: The observed value
+        :type value: Union[str, float, int, None]
+        :param labels: Must be empty, since table rows have no labels, defaults to None
+        :type labels: Optional[Mapping[str, str]], optional
+        :param weight: Amount to increment the bin by, eg. the inverse of the sampling rate,
+            defaults to 1
+        :type weight: float, optional
+        """
+        raise NotImplementedError
+
+    def observe_batch(self, values: Sequence[Optional[TBin]], weight: float = 1):
+        """Adds a batch of observations to the frequency table.
+
+        :param values: The observed values
+        :type values: Sequence[Union[str, float, int, None]]
+        :param weight: Amount to increment the bin by for each value, defaults to 1
+        :type weight: float, optional
+        """
+        for v in values:
+            self.observe(v, weight=weight)
+
+    def collect(self) -> List[Metric]:
+        """Converts the live metric to a static metric using the current table counts.
+
+        :return: The converted static metrics
+        :rtype: List[Metric]
+        """
+        raise NotImplementedError
+
+    @property
+    def bin_labels(self) -> List[str]:
+        """Label of the bin stored in each column of the table row."""
+        raise NotImplementedError
+
+    @property
+    def sample_names(self) -> List[str]:
+        """Names of the samples exported by collect, used for selecting metrics by name."""
+        return [self.name + suffix for suffix in self.SAMPLE_SUFFIXES]
+
+    @property
+    def window_sample_names(self) -> Tuple[str, ...]:
+        """Names of the samples exported by `collect_window`."""
+        raise NotImplementedError
+
+    def collect_window(
+        self, counts: np.ndarray, total: float, unseen: Mapping[str, float]
+    ) -> Metric:
+        """Converts the counts observed over a sliding window to a static metric.
+
+        :param counts: Counts of each column observed within the window
+        :type counts: np.ndarray
+        :param total: Sum of values observed within the window
+        :type total: float
+        :param unseen: Counts of each unseen bin observed within the window
+        :type unseen: Mapping[str, float]
+        :return: The converted metric
+        :rtype: Metric
+        """
+        raise NotImplementedError
+
+    @property
+    def _window_documentation(self) -> str:
+        return (
+            "Sliding window of "
+            + self.documentation[:1].lower()
+            + self.documentation[1:]
+        )
+
+    @staticmethod
+    def _check_labels(labels: Optional[Mapping[str, str]]):
+        if labels:
+            raise ValueError("Incorrect label names")
+
+
+class ContinuousTableVariable(TableVariable, ContinuousVariable):
+    """Array backed implementation of ContinuousVariable."""
+
+    SAMPLE_SUFFIXES = ("_bucket", "_count", "_sum", "_created")
+
+    def __init__(self, metric: Metric):
+        self.name, self.documentation = (
+            self._get_serving_name_and_documentation_from_baseline(metric)
+        )
+        self._upper_bounds: List[float] = self.parse_bounds(metric)
+        self.bounds: np.ndarray = np.array(self._upper_bounds)
+        self._bucket_labels: List[str] = [
+            floatToGoString(b) for b in self._upper_bounds
+        ]
+        self.width = self.bounds.size
+        cumulative = [
+            sample.value for sample in metric.samples if sample.name.endswith("_bucket")
+        ]
+        # The +Inf bucket may be implied by the baseline
+        cumulative += cumulative[-1:] * (self.width - len(cumulative))
+        self.baseline = np.diff(np.array(cumulative, dtype=float), prepend=0.0)
+        self.created = time.time()
+
+    @staticmethod
+    def parse_bounds(metric: Metric) -> List[float]:
+        """Parses the upper bound of each bucket from a baseline histogram.
+
+        Validation follows prometheus_client.Histogram, including the trailing +Inf bucket.
+
+        :param metric: The baseline histogram
+        :type metric: Metric
+        :return: Upper bound of each bucket in ascending order
+        :rtype: List[float]
+        """
+        bounds = [
+            float(sample.labels[ContinuousVariable.BIN_LABEL])
+            for sample in metric.samples
+            if sample.name.endswith("_bucket")
+        ]
+        if bounds != sorted(bounds):
+            raise ValueError("Buckets not in sorted order")
+        if not bounds or bounds[-1] != INF:
+            bounds.append(INF)
+        if len(bounds) < 2:
+            raise ValueError("Must have at least two buckets")
+        return bounds
+
+    @property
+    def bin_labels(self) -> List[str]:
+        return self._bucket_labels
+
+    def locate(self, value: float) -> int:
+        """Finds the bucket of a single value using binary search over the upper bounds.
+
+        NaN and +Inf are located in the +Inf bucket while -Inf is located in the first bucket.
+
+        :param value: The observed value
+        :type value: float
+        :return: Index of the bucket
+        :rtype: int
+        """
+        # NaN does not equal to itself!
+        if value != value:
+            return len(self._upper_bounds) - 1
+        return bisect_left(self._upper_bounds, value)
+
+    def locate_batch(self, values: np.ndarray) -> np.ndarray:
+        """Finds the bucket of each value in an array, equivalent to calling `locate` on each.
+
+        :param values: The observed values
+        :type values: np.ndarray
+        :return: Index of the bucket for each value
+        :rtype: np.ndarray
+        """
+        # NaN is sorted after +Inf, ie. one past the last bucket
+        index = np.searchsorted(self.bounds, values, side="left")
+        return np.minimum(index, len(self._upper_bounds) - 1)
+
+    def observe(
+        self,
+        value: Optional[TBin],
+        labels: Optional[Mapping[str, str]] = None,
+        weight: float = 1,
+    ):
+        self._check_labels(labels)
+        value = _to_float(value)
+        index = self.locate(value)
+        # Same as ContinuousVariable: nan and +inf are not added to sum
+        total = value if value == value and value != INF else 0.0
+        with self._table.lock:
+            self._table.counts[self._row, index] += weight
+            self._table.sums[self._row] += total * weight
+
+    def observe_batch(self, values: Sequence[Optional[TBin]], weight: float = 1):
+        try:
+            values = np.asarray(values, dtype=float)
+        except (ValueError, TypeError):
+            return TableVariable.observe_batch(self, values, weight=weight)
+        counts = np.bincount(self.locate_batch(values), minlength=self.width) * weight
+        total = float(np.sum(values[~np.isnan(values) & (values != INF)])) * weight
+        with self._table.lock:
+            self._table.counts[self._row, : self.width] += counts
+            self._table.sums[self._row] += total
+
+    def collect(self) -> List[Metric]:
+        counts, total = self._table.snapshot(self._row)
+        metric = Metric(self.name, self.documentation, "histogram")
+        acc = 0.0
+        for label, count in zip(self._bucket_labels, counts[: self.width]):
+            acc += float(count)
+            metric.add_sample(self.name + "_bucket", {"le": label}, acc)
+        metric.add_sample(self.name + "_count", {}, acc)
+        # Prometheus histogram does not export sum when there are negative buckets
+        if self.bounds[0] >= 0:
+            metric.add_sample(self.name + "_sum", {}, total)
+        metric.add_sample(self.name + "_created", {}, self.created)
+        return [metric]
+
+    @property
+    def window_sample_names(self) -> Tuple[str, ...]:
+        name = self.name + self.WINDOW_SUFFIX
+        return (name + "_bucket", name + "_gcount", name + "_gsum")
+
+    def collect_window(
+        self, counts: np.ndarray, total: float, unseen: Mapping[str, float]
+    ) -> Metric:
+        name = self.name + self.WINDOW_SUFFIX
+        metric = Metric(name, self._window_documentation, "gaugehistogram")
+        acc = 0.0
+        for label, count in zip(self._bucket_labels, counts[: self.width]):
+            acc += float(count)
+            metric.add_sample(name + "_bucket", {"le": label}, acc)
+        metric.add_sample(name + "_gcount", {}, acc)
+        if self.bounds[0] >= 0:
+            metric.add_sample(name + "_gsum", {}, total)
+        return metric
+
+
+class DiscreteTableVariable(TableVariable, DiscreteVariable):
+    """Array backed implementation of DiscreteVariable.
+
+    Bins from the baseline are stored in the frequency table columns while values missing from
+    the baseline are counted as unseen bins of the table in the order they are first observed,
+    up to `max_unseen_bins` of them. Further unseen values are counted in the shared `OTHER_BIN`
+    to bound the number of series.
+    """
+
+    SAMPLE_SUFFIXES = ("_total", "_created")
+    OTHER_BIN = "__other__"
+    MAX_UNSEEN_BINS = 100
+
+    def __init__(self, metric: Metric):
+        self.name, self.documentation = (
+            self._get_serving_name_and_documentation_from_baseline(metric)
+        )
+        self._columns: Dict[str, int] = {}
+        # Maps observed values to the column of their bin
+        self._bins: Dict[TBin, int] = {}
+        for sample in metric.samples:
+            label = sample.labels[DiscreteVariable.BIN_LABEL]
+            if label not in self._columns:
+                self._columns[label] = len(self._columns)
+                for key in self.bin_keys(label):
+                    self._bins[key] = self._columns[label]
+        self._admitted_keys: Set[str] = set()
+        self.max_unseen_bins: int = self.MAX_UNSEEN_BINS
+        self._admitted = 0
+        self.width = len(self._columns)
+        self.baseline = np.zeros(self.width)
+        for sample in metric.samples:
+            if sample.name.endswith("_total"):
+                label = sample.labels[DiscreteVariable.BIN_LABEL]
+                self.baseline[self._columns[label]] += sample.value
+        self.created = time.time()
+
+    @property
+    def bin_labels(self) -> List[str]:
+        return list(self._columns)
+
+    @staticmethod
+    def bin_keys(label: str) -> List[TBin]:
+        """Lists the observed values that are counted in the bin with the given label.
+
+        Besides the label itself, numeric bins may be looked up by their float value (or an equal
+        int value) as long as it formats back to the same label.
+
+        :param label: The bin label
+        :type label: str
+        :return: Hashable keys of the bin
+        :rtype: List[Union[str, float, int]]
+        """
+        keys: List[TBin] = [label]
+        try:
+            value = float(label)
+        except ValueError:
+            return keys
+        # NaN can never be looked up since it does not equal to itself
+        if value == value and str(value) == label:
+            keys.append(value)
+        return keys
+
+    def _lookup(self, value: Optional[TBin]) -> Optional[int]:
+        try:
+            column = self._bins.get(value)
+        except TypeError:
+            # Unhashable value
+            return None
+        if column is None and value != value:
+            column = self._bins.get("nan")
+        return column
+
+    def _inc_unseen(self, key: str, amount: float):
+        # Must be called while holding the table lock
+        if key not in self._admitted_keys:
+            if self._admitted >= self.max_unseen_bins:
+                key = self.OTHER_BIN
+            else:
+                self._admitted += 1
+            self._admitted_keys.add(key)
+        self._table.inc_unseen(self._row, key, amount)
+
+    def _unseen_bins(self) -> Tuple[List[Tuple[str, float, float]], float]:
+        """Returns the unseen bins within budget followed by the overflow bin, if any, and the
+        overflow count."""
+        bins: List[Tuple[str, float, float]] = []
+        overflow, overflow_created = 0.0, math.inf
+        for key, count, created in self._table.unseen(self._row):
+            # Bins admitted by other processes may exceed the budget once aggregated
+            if key == self.OTHER_BIN or len(bins) >= self.max_unseen_bins:
+                overflow += count
+                overflow_created = min(overflow_created, created)
+            else:
+                bins.append((key, count, created))
+        if overflow_created != math.inf:
+            bins.append((self.OTHER_BIN, overflow, overflow_created))
+        return bins, overflow
+
+    @property
+    def overflow(self) -> float:
+        """Number of observations counted in the overflow bin."""
+        return self._unseen_bins()[1]
+
+    def observe(
+        self,
+        value: Optional[TBin],
+        labels: Optional[Mapping[str, str]] = None,
+        weight: float = 1,
+    ):
+        self._check_labels(labels)
+        column = self._lookup(value)
+        if column is not None:
+            with self._table.lock:
+                self._table.counts[self._row, column] += weight
+            return
+        if isinstance(value, int):
+            value = float(value)
+        with self._table.lock:
+            self._inc_unseen(str(value), weight)
+
+    def observe_batch(self, values: Sequence[Optional[TBin]], weight: float = 1):
+        values = np.asarray(values)
+        if values.dtype.kind not in "biuf":
+            # Non-numeric categories are counted one at a time
+            return TableVariable.observe_batch(self, values.tolist(), weight=weight)
+        values = values.astype(float, copy=False)
+        nan = np.isnan(values)
+        present = np.flatnonzero(~nan)
+        bins, first, counts = np.unique(
+            values[present], return_index=True, return_counts=True
+        )
+        groups = list(zip(present[first].tolist(), bins.tolist(), counts.tolist()))
+        if nan.any():
+            groups.append((int(np.argmax(nan)), math.nan, int(nan.sum())))
+        # Unseen bins are admitted in order of first occurrence, same as observing one by one
+        groups.sort(key=lambda g: g[0])
+        with self._table.lock:
+            for _, value, count in groups:
+                column = self._lookup(value)
+                if column is None:
+                    self._inc_unseen(str(value), count * weight)
+                else:
+                    self._table.counts[self._row, column] += count * weight
+
+    def collect(self) -> List[Metric]:
+        counts, _ = self._table.snapshot(self._row)
+        unseen, _ = self._unseen_bins()
+        metric = Metric(self.name, self.documentation, "counter")
+        for key, column in self._columns.items():
+            self._add_samples(metric, key, float(counts[column]), self.created)
+        for key, count, created in unseen:
+            self._add_samples(metric, key, count, created)
+        return [metric]
+
+    def unseen_counts(self) -> Dict[str, float]:
+        """Counts of each unseen bin as exported, including the overflow bin.
+
+        :return: Counts by bin label
+        :rtype: Dict[str, float]
+        """
+        return {key: count for key, count, _ in self._unseen_bins()[0]}
+
+    @property
+    def window_sample_names(self) -> Tuple[str, ...]:
+        return (self.name + self.WINDOW_SUFFIX,)
+
+    def collect_window(
+        self, counts: np.ndarray, total: float, unseen: Mapping[str, float]
+    ) -> Metric:
+        name = self.name + self.WINDOW_SUFFIX
+        metric = Metric(name, self._window_documentation, "gauge")
+        for key, column in self._columns.items():
+            metric.add_sample(
+                name, {DiscreteVariable.BIN_LABEL: key}, float(counts[column])
+            )
+        for key, count in unseen.items():
+            metric.add_sample(name, {DiscreteVariable.BIN_LABEL: key}, count)
+        return metric
+
+    def _add_samples(self, metric: Metric, key: str, count: float, created: float):
+        labels = {DiscreteVariable.BIN_LABEL: key}
+        metric.add_sample(self.name + "_total", labels, count)
+        metric.add_sample(self.name + "_created", labels, created)
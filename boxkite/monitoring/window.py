@@ -0,0 +1,234 @@
+import glob
+import json
+import math
+import os
+import time
+from threading import Lock
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from prometheus_client import Metric
+
+from .table import (
+    DiscreteTableVariable,
+    FrequencyTable,
+    SharedFrequencyTable,
+    TableVariable,
+)
+
+# Cumulative counts, sums and unseen bin counts by row at a point in time
+TSnapshot = Tuple[np.ndarray, np.ndarray, Dict[int, Dict[str, float]]]
+
+
+class FrequencyWindow:
+    """Counts of live metrics over a sliding time window.
+
+    The window is divided into slots of a fixed granularity, kept in a ring. The first time the
+    window is touched within a slot, the cumulative counts of the frequency table are copied into
+    that slot. Counts over the window are then the difference between the current counts and the
+    oldest slot of the ring, so observations only pay for a clock check.
+
+    Since observations always touch the window first, a slot that was never touched had no
+    observations, and the next touched slot holds the same counts. The window therefore covers
+    between `length - granularity` and `length` seconds of observations.
+    """
+
+    def __init__(
+        self,
+        metrics: Sequence[TableVariable],
+        table: FrequencyTable,
+        length: float,
+        granularity: float,
+    ):
+        """Allocates the ring of slots, starting from the current counts.
+
+        :param metrics: The live metrics bound to the table, in row order
+        :type metrics: Sequence[TableVariable]
+        :param table: The frequency table of the live metrics
+        :type table: FrequencyTable
+        :param length: Length of the window in seconds
+        :type length: float
+        :param granularity: Length of each slot in seconds
+        :type granularity: float
+        """
+        if length <= 0 or granularity <= 0:
+            raise ValueError(
+                f"Window length and granularity must be positive: {length}, {granularity}"
+            )
+        self._metrics = metrics
+        self._table = table
+        self._granularity = granularity
+        self._slots = max(1, math.ceil(length / granularity))
+        # Slot number and snapshot taken in it, by position in the ring
+        self._ring: List[Optional[Tuple[int, TSnapshot]]] = [None] * self._slots
+        self._lock = Lock()
+        self._next = 0.0
+        self.tick()
+
+    def tick(self):
+        """Copies the current counts into the ring when entering a new slot."""
+        now = time.monotonic()
+        if now < self._next:
+            return
+        with self._lock:
+            if now < self._next:
+                return
+            slot = int(now // self._granularity)
+            if not self._stored(slot):
+                self._table.refresh()
+                self._store(slot, self._snapshot())
+            self._next = (slot + 1) * self._granularity
+
+    def _stored(self, slot: int) -> bool:
+        # Ticks only happen once per slot in a single process
+        return False
+
+    def _store(self, slot: int, snapshot: TSnapshot):
+        self._ring[slot % self._slots] = (slot, snapshot)
+
+    def _start(self, oldest: int) -> Optional[TSnapshot]:
+        # The earliest slot within the window, see class docstring
+        entries = [entry for entry in self._ring if entry and entry[0] >= oldest]
+        if not entries:
+            return None
+        return min(entries, key=lambda entry: entry[0])[1]
+
+    def _snapshot(self) -> TSnapshot:
+        counts, sums = self._table.matrix()
+        unseen = {
+            row: m.unseen_counts()
+            for row, m in enumerate(self._metrics)
+            if isinstance(m, DiscreteTableVariable)
+        }
+        return counts, sums, unseen
+
+    def counts(self) -> TSnapshot:
+        """Computes the counts observed within the window, from the table's last refresh.
+
+        :return: Counts, sums and unseen bin counts by row
+        :rtype: TSnapshot
+        """
+        self.tick()
+        counts, sums, unseen = self._snapshot()
+        with self._lock:
+            oldest = int(time.monotonic() // self._granularity) - self._slots + 1
+            start = self._start(oldest)
+        if start is None:
+            # The slot just ended without observations
+            start = (counts, sums, unseen)
+        start_counts, start_sums, start_unseen = start
+        window_unseen = {
+            row: {
+                key: count - start_unseen.get(row, {}).get(key, 0.0)
+                for key, count in bins.items()
+            }
+            for row, bins in unseen.items()
+        }
+        return counts - start_counts, sums - start_sums, window_unseen
+
+    def collect(self, metrics: Sequence[TableVariable]) -> List[Metric]:
+        """Converts the counts of the given metrics over the window to static metrics.
+
+        :param metrics: The live metrics to convert
+        :type metrics: Sequence[TableVariable]
+        :return: One metric per live metric
+        :rtype: List[Metric]
+        """
+        counts, sums, unseen = self.counts()
+        return [
+            m.collect_window(counts[m.row], float(sums[m.row]), unseen.get(m.row, {}))
+            for m in metrics
+        ]
+
+
+class SharedFrequencyWindow(FrequencyWindow):
+    """A sliding window whose ring of slots is shared by every process in multiprocess mode.
+
+    Each process of a multiprocess server aggregates the tables of all processes, so a slot is
+    only stored once, by the first process that enters it, in a file under the multiprocess
+    directory. Every process then reads the same ring, whether or not it received observations
+    recently, and reports the same counts over the window. Slots are keyed by the monotonic
+    clock, which is shared by processes on the same host.
+    """
+
+    PREFIX = "boxkite_window_"
+
+    def __init__(
+        self,
+        metrics: Sequence[TableVariable],
+        table: SharedFrequencyTable,
+        length: float,
+        granularity: float,
+        path: str,
+    ):
+        """Shares the ring of slots through files under the given directory.
+
+        :param metrics: The live metrics bound to the table, in row order
+        :type metrics: Sequence[TableVariable]
+        :param table: The frequency table of the live metrics
+        :type table: SharedFrequencyTable
+        :param length: Length of the window in seconds
+        :type length: float
+        :param granularity: Length of each slot in seconds
+        :type granularity: float
+        :param path: The multiprocess directory, usually PROMETHEUS_MULTIPROC_DIR
+        :type path: str
+        """
+        # Windows of different baselines are stored separately, same as archive tables
+        self._base = os.path.join(path, f"{self.PREFIX}{table.layout}_")
+        super().__init__(metrics, table, length, granularity)
+
+    def _file(self, slot: int) -> str:
+        return f"{self._base}{slot}.npz"
+
+    def _stored(self, slot: int) -> bool:
+        return os.path.exists(self._file(slot))
+
+    def _store(self, slot: int, snapshot: TSnapshot):
+        counts, sums, unseen = snapshot
+        tmp = f"{self._base}{os.getpid()}_{os.urandom(4).hex()}.tmp"
+        with open(tmp, "wb") as f:
+            np.savez(f, counts=counts, sums=sums, unseen=np.array(json.dumps(unseen)))
+        try:
+            # Linking never replaces the slot stored by another process in the meantime
+            os.link(tmp, self._file(slot))
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(tmp)
+        for other, path in self._files():
+            if other <= slot - self._slots:
+                _remove(path)
+
+    def _files(self) -> List[Tuple[int, str]]:
+        files = []
+        for path in glob.glob(self._base + "*.npz"):
+            try:
+                files.append((int(path[len(self._base) : -len(".npz")]), path))
+            except ValueError:
+                continue
+        return sorted(files)
+
+    def _start(self, oldest: int) -> Optional[TSnapshot]:
+        for slot, path in self._files():
+            if slot < oldest:
+                continue
+            try:
+                with np.load(path) as data:
+                    unseen = json.loads(str(data["unseen"]))
+                    return (
+                        data["counts"],
+                        data["sums"],
+                        {int(row): bins for row, bins in unseen.items()},
+                    )
+            except (OSError, ValueError, KeyError):
+                # Removed or expired by another process
+                continue
+        return None
+
+
+def _remove(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
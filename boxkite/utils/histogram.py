@@ -1,7 +1,9 @@
-from typing import List, Mapping, Optional
+from typing import Callable, List, Mapping, Optional, Sequence
 
 import numpy as np
 
+from .sketch import QuantileSketch
+
 
 def _remove_nans_and_infs(val: np.ndarray):
     return val[~np.isnan(val) & ~np.isinf(val)]
@@ -34,16 +36,53 @@ def get_bins(val: List[float]) -> List[float]:
     """
     r_min = np.min(val)
     r_max = np.max(val)
-    min_bins = 2
-    max_bins = 50
     # Calculate bin width using either Freedman-Diaconis or Sturges estimator
     bin_edges = np.histogram_bin_edges(val, bins="auto")
+    return _clamp_bins(bin_edges, r_min, r_max, lambda: np.percentile(val, [75, 25]))
+
+
+def get_sketch_bins(sketch: QuantileSketch) -> List[float]:
+    """Calculates the same bins as get_bins from a quantile sketch of the values.
+
+    The bin width estimators and outlier handling only depend on the size, range and quartiles
+    of the values. Range and size are exact, while quartiles are within the rank error of the
+    sketch, so sketches can be built over partitions of a dataset and merged before choosing
+    bins.
+
+    :param sketch: Sketch of the finite values, must not be empty
+    :type sketch: QuantileSketch
+    :return: Upper bound of each bin (at least 2 bins)
+    :rtype: List[float]
+    """
+    if sketch.size == 0:
+        raise ValueError("Cannot calculate bins from an empty sketch")
+    r_min = sketch.min
+    r_max = sketch.max
+    q75, q25 = sketch.quantiles([0.75, 0.25])
+    # Same as np.histogram_bin_edges with bins="auto"
+    sturges = (r_max - r_min) / (np.log2(sketch.size) + 1.0)
+    fd = 2.0 * (q75 - q25) * sketch.size ** (-1.0 / 3.0)
+    width = min(fd, sturges) if fd else sturges
+    first, last = (r_min - 0.5, r_max + 0.5) if r_min == r_max else (r_min, r_max)
+    count = int(np.ceil((last - first) / width)) if width else 1
+    bin_edges = np.linspace(first, last, count + 1)
+    return _clamp_bins(bin_edges, r_min, r_max, lambda: (q75, q25))
+
+
+def _clamp_bins(
+    bin_edges: np.ndarray,
+    r_min: float,
+    r_max: float,
+    quartiles: Callable[[], Sequence[float]],
+) -> List[float]:
+    min_bins = 2
+    max_bins = 50
     if len(bin_edges) < min_bins:
         return list(np.linspace(start=r_min, stop=r_max, num=min_bins))
     elif len(bin_edges) <= max_bins:
         return list(bin_edges)
     # Clamp to max_bins by estimating a good bin range to be more robust to outliers
-    q75, q25 = np.percentile(val, [75, 25])
+    q75, q25 = quartiles()
     iqr = q75 - q25
     width = 2 * iqr / max_bins
     start = max((q75 + q25) / 2 - iqr, r_min)
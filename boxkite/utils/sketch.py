@@ -0,0 +1,130 @@
+from typing import List, Sequence
+
+import numpy as np
+
+
+class QuantileSketch:
+    """KLL sketch of the quantiles of a stream of values, in bounded memory.
+
+    Values are kept in a stack of compactors, where items at level h stand for 2^h values. When a
+    compactor exceeds its capacity, it is sorted and every other item, starting from a random
+    offset, is promoted to the next level. Capacities shrink geometrically towards the bottom,
+    so the sketch holds about 3k items regardless of the number of values.
+
+    Sketches built over separate partitions of a dataset can be merged, with the same error bound
+    as a single sketch over the whole dataset. The normalized rank error of a quantile is about
+    `rank_error` with high probability, 1.3% for the default k of 200.
+
+    Only finite values are sketched. The exact count, min and max are kept alongside.
+    """
+
+    # Ratio of capacities between consecutive levels
+    DECAY = 2 / 3
+
+    def __init__(self, k: int = 200):
+        """Creates an empty sketch.
+
+        :param k: Capacity of the top compactor, trading memory for accuracy, defaults to 200
+        :type k: int, optional
+        """
+        if k < 2:
+            raise ValueError(f"Sketch capacity must be at least 2: {k}")
+        self.k = k
+        self.size = 0
+        self.min = np.inf
+        self.max = -np.inf
+        self._levels: List[np.ndarray] = [np.zeros(0)]
+
+    @property
+    def rank_error(self) -> float:
+        """Approximate normalized rank error of quantiles at 99% confidence, as measured for
+        the KLL sketch of Apache DataSketches.
+        """
+        return 2.296 / self.k**0.9723
+
+    def _capacity(self, level: int) -> int:
+        depth = len(self._levels) - level - 1
+        return max(2, int(np.ceil(self.k * self.DECAY**depth)))
+
+    def update(self, val: Sequence[float]) -> "QuantileSketch":
+        """Adds a batch of values to the sketch, ignoring nan and infinite values.
+
+        :param val: Array of values
+        :type val: Sequence[float]
+        :return: This sketch
+        :rtype: QuantileSketch
+        """
+        val = np.asarray(val, dtype=float)
+        val = val[np.isfinite(val)]
+        if len(val) == 0:
+            return self
+        self.size += len(val)
+        self.min = min(self.min, np.min(val))
+        self.max = max(self.max, np.max(val))
+        self._levels[0] = np.concatenate([self._levels[0], val])
+        self._compress()
+        return self
+
+    def merge(self, other: "QuantileSketch") -> "QuantileSketch":
+        """Adds the values summarized by another sketch, eg. built over another partition.
+
+        :param other: The sketch to merge, left unchanged
+        :type other: QuantileSketch
+        :return: This sketch
+        :rtype: QuantileSketch
+        """
+        if other.size == 0:
+            return self
+        self.size += other.size
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        while len(self._levels) < len(other._levels):
+            self._levels.append(np.zeros(0))
+        for level, items in enumerate(other._levels):
+            self._levels[level] = np.concatenate([self._levels[level], items])
+        self._compress()
+        return self
+
+    def _compress(self):
+        level = 0
+        while level < len(self._levels):
+            items = self._levels[level]
+            if len(items) <= self._capacity(level):
+                level += 1
+                continue
+            if level + 1 == len(self._levels):
+                # Capacities of lower levels shrink, so they are checked again
+                self._levels.append(np.zeros(0))
+            items = np.sort(items)
+            # Pairs up an even number of items, the remaining one stays at this level
+            paired = len(items) - len(items) % 2
+            offset = np.random.randint(2)
+            self._levels[level] = items[paired:]
+            self._levels[level + 1] = np.concatenate(
+                [self._levels[level + 1], items[offset:paired:2]]
+            )
+            level = 0
+
+    def quantiles(self, q: Sequence[float]) -> np.ndarray:
+        """Estimates the values at the given quantiles.
+
+        :param q: Quantiles between 0 and 1
+        :type q: Sequence[float]
+        :return: Estimated value of each quantile, nan if the sketch is empty
+        :rtype: np.ndarray
+        """
+        q = np.asarray(q, dtype=float)
+        if self.size == 0:
+            return np.full(q.shape, np.nan)
+        items = np.concatenate(self._levels)
+        weights = np.concatenate(
+            [np.full(len(level), 2.0**h) for h, level in enumerate(self._levels)]
+        )
+        order = np.argsort(items, kind="stable")
+        cumulative = np.cumsum(weights[order])
+        index = np.searchsorted(cumulative, q * cumulative[-1], side="left")
+        estimates = items[order][np.clip(index, 0, len(items) - 1)]
+        # The extremes are known exactly, even when compaction dropped them
+        estimates = np.where(q <= 0, self.min, estimates)
+        estimates = np.where(q >= 1, self.max, estimates)
+        return np.clip(estimates, self.min, self.max)
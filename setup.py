@@ -24,6 +24,7 @@ setuptools.setup(
     ],
     python_requires=">=3.6",
     install_requires=[
+        # ForwardSender extends the sender internals of this minor version
         "fluent-logger>=0.10.0,<0.11",
         "prometheus_client>=0.10.1,<0.12",
         "numpy>=1.16,<2",
@@ -0,0 +1,11 @@
+import pytest
+
+from boxkite.monitoring.collector.feature import FeatureDistribution
+
+
+@pytest.fixture
+def discrete_baseline():
+    """Baseline of a discrete feature with two bins, shared by live metric tests."""
+    return FeatureDistribution.as_discrete(
+        index=0, name="first", bin_to_count={"0.0": 5, "1.0": 3}
+    )
@@ -0,0 +1,90 @@
+import os
+import time
+from tempfile import NamedTemporaryFile
+
+from prometheus_client.mmap_dict import MmapedDict, mmap_key
+
+from boxkite.monitoring.collector import BaselineMetricCollector
+from boxkite.monitoring.compaction import compact
+from boxkite.monitoring.encoder import MetricEncoder
+from boxkite.monitoring.registry import LiveMetricRegistry
+from boxkite.monitoring.service import ModelMonitoringService
+from tests.test_serving import BASELINE_HISTOGRAM, SAMPLE_SERVING_DATA
+
+
+def test_compact_dead_workers(monkeypatch, tmp_path, discrete_baseline):
+    monkeypatch.setenv("PROMETHEUS_MULTIPROC_DIR", str(tmp_path))
+    baseline = [discrete_baseline]
+    registry = LiveMetricRegistry(metrics=baseline)
+    encoder = MetricEncoder([registry])
+    for value in [0, 2]:
+        pid = os.fork()
+        if pid == 0:
+            # A worker recording a histogram and a live metric before exiting
+            worker = LiveMetricRegistry(metrics=baseline)
+            worker.observe_batch(features=[[value], [3]], outputs=[])
+            values = MmapedDict(str(tmp_path / f"histogram_{os.getpid()}.db"))
+            for name, count in [("latency_bucket", 1.0), ("latency_count", 1.0)]:
+                labels = ["le"] if name.endswith("bucket") else []
+                key = mmap_key("latency", name, labels, ["+Inf"] if labels else [])
+                values.write_value(key, count)
+            values.close()
+            # And gauges of each mode aggregated across processes
+            for mode in ["min", "max", "all"]:
+                values = MmapedDict(str(tmp_path / f"gauge_{mode}_{os.getpid()}.db"))
+                values.write_value(
+                    mmap_key(f"temp_{mode}", f"temp_{mode}", [], []), value
+                )
+                values.close()
+            os._exit(0)
+        os.waitpid(pid, 0)
+    before = encoder.as_text()
+    assert b'latency_bucket{le="+Inf"} 2.0' in before
+    assert b'feature_0_value_total{bin="3.0"} 2.0' in before
+    assert b"temp_min 0.0" in before and b"temp_max 2.0" in before
+
+    assert compact() == 8
+    archived = sorted(p.name for p in tmp_path.glob("*.db"))
+    # Gauges of all mode are exported by pid, so they are kept
+    assert [name for name in archived if not name.startswith("gauge_all_")] == [
+        "gauge_max_archive.db",
+        "gauge_min_archive.db",
+        "histogram_archive.db",
+    ]
+    assert len(archived) == 5
+    assert len(list(tmp_path.glob("boxkite_live_*.npy"))) == 2
+    # Archived metrics may be read in another order
+    assert sorted(encoder.as_text().splitlines()) == sorted(before.splitlines())
+    assert compact() == 0
+
+
+def test_compaction_interval(monkeypatch, tmp_path):
+    monkeypatch.setenv("PROMETHEUS_MULTIPROC_DIR", str(tmp_path))
+    with NamedTemporaryFile() as temp:
+        temp.writelines(line.encode() + b"\n" for line in BASELINE_HISTOGRAM)
+        temp.flush()
+        service = ModelMonitoringService(
+            baseline_collector=BaselineMetricCollector(path=temp.name),
+            compaction_interval=0.05,
+        )
+        pid = os.fork()
+        if pid == 0:
+            for feature, inference in SAMPLE_SERVING_DATA:
+                service.log_prediction(
+                    request_body="test", features=feature, output=inference
+                )
+            os._exit(0)
+        os.waitpid(pid, 0)
+        before, _ = service.export_http()
+        assert b"feature_0_value_count 3.0" in before
+
+        # The worker's files are archived by the compaction thread
+        deadline = time.time() + 5
+        while list(tmp_path.glob(f"*_{pid}_*")) and time.time() < deadline:
+            time.sleep(0.05)
+        assert not list(tmp_path.glob(f"*_{pid}_*"))
+        assert list(tmp_path.glob("boxkite_live_archive_*.npy"))
+
+        after, _ = service.export_http()
+        service.close()
+    assert sorted(after.splitlines()) == sorted(before.splitlines())
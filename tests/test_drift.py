@@ -0,0 +1,66 @@
+import math
+
+import numpy as np
+
+from boxkite.monitoring.collector.feature import FeatureDistribution
+from boxkite.monitoring.drift import DriftScores
+from boxkite.monitoring.registry import LiveMetricRegistry
+
+
+def test_drift_scores():
+    registry = LiveMetricRegistry(
+        metrics=[
+            FeatureDistribution.as_continuous(
+                index=0, name="first", bin_to_count={"3.0": 2, "5.5": 2}
+            ),
+            FeatureDistribution.as_discrete(
+                index=1, name="second", bin_to_count={"0.0": 6, "1.0": 2}
+            ),
+            FeatureDistribution.as_discrete(
+                index=2, name="third", bin_to_count={"0.0": 1}
+            ),
+        ],
+        drift_scores=True,
+    )
+    registry.observe_batch(features=[[1, 0], [9, 1], [9, 2], [9, 1]], outputs=[])
+
+    def smooth(counts):
+        counts = np.array(counts, dtype=float) + 1
+        return counts / counts.sum()
+
+    # Unseen bins of discrete metrics are pooled in one extra bin
+    expected = {
+        "feature_0_value": (smooth([2, 2, 0]), smooth([1, 0, 3])),
+        "feature_1_value": (smooth([6, 2, 0]), smooth([1, 2, 1])),
+    }
+    samples = {
+        (s.name, s.labels["metric_name"]): s.value
+        for m in registry.collect()
+        for s in m.samples
+        if "metric_name" in s.labels
+    }
+    for name, (baseline, live) in expected.items():
+        psi = np.sum((live - baseline) * np.log(live / baseline))
+        kl = np.sum(live * np.log(live / baseline))
+        assert math.isclose(samples[("live_metrics_psi", name)], psi)
+        assert math.isclose(samples[("live_metrics_kl_divergence", name)], kl)
+    assert samples[("live_metrics_ks_statistic", "feature_0_value")] == 0.75
+    assert ("live_metrics_ks_statistic", "feature_1_value") not in samples
+    # No scores before the first observation
+    assert ("live_metrics_psi", "feature_2_value") not in samples
+
+    # Only metrics observed since the previous collection are scored again
+    scored = []
+    score_rows = registry._drift._score_rows
+    registry._drift._score_rows = lambda rows, live: (
+        scored.append(rows.tolist()) or score_rows(rows, live)
+    )
+    registry.observe_batch(features=[[9], [9]], outputs=[])
+    first = registry.collect()
+    assert registry.collect() == first
+    assert scored == [[0]]
+    fresh = DriftScores(metrics=registry._live, width=registry._table.shape[1])
+    counts, unseen = registry._table.matrix()[0], [1, 0]
+    np.testing.assert_array_equal(
+        registry._drift.score(counts, unseen), fresh.score(counts, unseen)
+    )
@@ -1,7 +1,11 @@
+import asyncio
 from os import environ
 
 from boxkite.monitoring.exporter.fluentd_exporter import BEDROCK_FLUENTD_ADDR
-from boxkite.monitoring.service import ModelMonitoringService
+from boxkite.monitoring.service import (
+    AsyncModelMonitoringService,
+    ModelMonitoringService,
+)
 from tests.mockserver import MockRecvServer
 
 
@@ -18,3 +22,48 @@ def test_fluent_sender():
     item = server.get_received()[0]
     assert item[1] == item[2]["created_at"]
     server.close()
+
+
+def test_fluent_sender_batch():
+    server = MockRecvServer(port=24224)
+    environ[BEDROCK_FLUENTD_ADDR] = "localhost"
+    service = ModelMonitoringService()
+
+    pids = service.log_predictions(
+        request_body="test",
+        features=[[2.0, 1.2, 0.8], [1.0, 0.4, 0.2]],
+        output=["dog", "cat"],
+    )
+    service._log_exporter._sender.close()
+
+    tag, entries = server.get_received()[0]
+    assert len(entries) == len(pids)
+    for timestamp, record in entries:
+        assert timestamp == record["created_at"]
+    server.close()
+
+
+def test_asyncio_fluent_sender():
+    server = MockRecvServer(port=24224)
+    environ[BEDROCK_FLUENTD_ADDR] = "localhost"
+    service = AsyncModelMonitoringService()
+
+    async def run():
+        pids = [
+            await service.alog_prediction(
+                request_body="test", features=[2.0, 1.2, 0.8], output=output
+            )
+            for output in ["dog", "cat", {"unserializable"}]
+        ]
+        await service.aclose()
+        return pids
+
+    pids = asyncio.get_event_loop().run_until_complete(run())
+
+    tag, entries = server.get_received()[0]
+    assert len(entries) == len(pids)
+    for timestamp, record in entries[:-1]:
+        assert timestamp == record["created_at"]
+    # The unserializable record is replaced instead of dropping the batch
+    assert entries[-1][1]["level"] == "CRITICAL"
+    server.close()
@@ -1,7 +1,33 @@
-from boxkite.utils.histogram import get_bins
+import numpy as np
+
+from boxkite.utils.histogram import get_bins, get_sketch_bins
+from boxkite.utils.sketch import QuantileSketch
 
 
 def test_large_sample():
     samples = [i for i in range(1_000_000)]
     edges = get_bins(samples)
     assert len(edges) == 50
+
+
+def test_merged_sketch_bins():
+    samples = np.random.lognormal(size=100_000)
+    sketch = QuantileSketch()
+    for shard in np.array_split(samples, 8):
+        sketch.merge(QuantileSketch().update(shard))
+    assert sketch.size == len(samples)
+    assert list(sketch.quantiles([0, 1])) == [samples.min(), samples.max()]
+
+    q = np.linspace(0.05, 0.95, 19)
+    ranks = np.searchsorted(np.sort(samples), sketch.quantiles(q))
+    assert np.max(np.abs(ranks / len(samples) - q)) <= sketch.rank_error
+
+    expected = get_bins(samples)
+    actual = get_sketch_bins(sketch)
+    assert len(actual) == len(expected)
+    assert actual[0] == expected[0] and actual[-1] == expected[-1]
+
+
+def test_small_sketch_bins():
+    samples = [3.0, 3.0, 4.0, 5.0, 8.0, 10.0, 13.0, 13.0]
+    assert get_sketch_bins(QuantileSketch().update(samples)) == get_bins(samples)
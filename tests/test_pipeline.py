@@ -0,0 +1,91 @@
+from collections import deque
+
+from boxkite.monitoring.context import PredictionContext
+from boxkite.monitoring.pipeline import ObservationPipeline
+from boxkite.monitoring.registry import LiveMetricRegistry
+
+
+def make_prediction(value: float) -> PredictionContext:
+    return PredictionContext(
+        entity_id=None,
+        features=[value],
+        request_body="test",
+        server_id="test",
+        output=value,
+        created_at=None,
+    )
+
+
+def test_drop_newest(discrete_baseline):
+    registry = LiveMetricRegistry(metrics=[discrete_baseline])
+    pipeline = ObservationPipeline(registry=registry, capacity=0)
+    assert not pipeline.submit(make_prediction(1.0))
+    assert pipeline.submit_batch([make_prediction(0.0), make_prediction(1.0)]) == 0
+    assert pipeline.dropped == 3
+    pipeline.close()
+
+    samples = registry.collect()[0].samples
+    assert all(s.value == 0 for s in samples if s.name.endswith("_total"))
+
+
+def test_flush(discrete_baseline):
+    registry = LiveMetricRegistry(metrics=[discrete_baseline])
+    pipeline = ObservationPipeline(
+        registry=registry, capacity=10, policy=ObservationPipeline.BLOCK
+    )
+    for i in range(1000):
+        pipeline.submit(make_prediction(i % 2))
+    assert pipeline.flush(timeout=5)
+    assert pipeline.depth == 0
+    pipeline.close()
+
+    totals = [
+        s.value for s in registry.collect()[0].samples if s.name.endswith("_total")
+    ]
+    assert totals == [500, 500]
+
+
+def test_drop_oldest(discrete_baseline):
+    registry = LiveMetricRegistry(metrics=[discrete_baseline])
+    pipeline = ObservationPipeline(
+        registry=registry, capacity=2, policy=ObservationPipeline.DROP_OLDEST
+    )
+    # Paused worker, so that the buffer fills up
+    pipeline._drain = lambda: 0
+    assert pipeline.submit(make_prediction(0.0))
+    assert pipeline.submit_batch([make_prediction(0.0), make_prediction(1.0)]) == 2
+    assert pipeline.submit(make_prediction(1.0))
+    assert pipeline.depth == 2 and pipeline.dropped == 2
+    assert [p.output for p in pipeline._queue] == [1.0, 1.0]
+
+    # Only the newest predictions of an oversized batch are kept
+    batch = [make_prediction(float(i)) for i in range(5)]
+    assert pipeline.submit_batch(batch) == 2
+    assert pipeline.depth == 2 and pipeline.dropped == 7
+    assert [p.output for p in pipeline._queue] == [3.0, 4.0]
+
+
+def test_oversized_batches(discrete_baseline):
+    batch = [make_prediction(i % 2) for i in range(25)]
+    for policy in ObservationPipeline.POLICIES:
+        registry = LiveMetricRegistry(metrics=[discrete_baseline])
+        pipeline = ObservationPipeline(registry=registry, capacity=10, policy=policy)
+        depths = []
+
+        class Buffer(deque):
+            def extend(self, items):
+                super().extend(items)
+                depths.append(len(self))
+
+        pipeline._queue = Buffer()
+        submitted = pipeline.submit_batch(batch)
+        assert pipeline.flush(timeout=5)
+        pipeline.close()
+        # The buffer never exceeds its capacity
+        assert submitted == (25 if policy == ObservationPipeline.BLOCK else 10)
+        assert submitted + pipeline.dropped == 25
+        assert depths and max(depths) <= 10
+        totals = [
+            s.value for s in registry.collect()[0].samples if s.name.endswith("_total")
+        ]
+        assert sum(totals) == submitted
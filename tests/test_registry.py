@@ -0,0 +1,102 @@
+import math
+
+import numpy as np
+from prometheus_client import generate_latest
+from prometheus_client.utils import INF
+
+from boxkite.monitoring.collector.feature import FeatureDistribution
+from boxkite.monitoring.context import PredictionContext
+from boxkite.monitoring.registry import LiveMetricRegistry
+from boxkite.monitoring.sampling import Sampler
+
+
+def test_sampled_observations_are_weighted(discrete_baseline):
+    np.random.seed(42)
+    registry = LiveMetricRegistry(
+        metrics=[discrete_baseline],
+        sampler=Sampler(rate=0.5),
+    )
+    registry.observe_batch(features=[[0]] * 1000, outputs=[])
+
+    count = registry.collect()[0].samples[0].value
+    # Each sampled observation counts twice
+    assert count % 2 == 0 and 900 <= count <= 1100
+    output = generate_latest(registry).decode()
+    assert "live_metrics_sampling_rate 0.5" in output
+
+
+def test_observe_feature_vector():
+    def make_registry():
+        return LiveMetricRegistry(
+            metrics=[
+                FeatureDistribution.as_continuous(
+                    index=0, name="first", bin_to_count={"-1.0": 1, "3.0": 2, "5.5": 2}
+                ),
+                FeatureDistribution.as_discrete(
+                    index=1, name="second", bin_to_count={"0.0": 5, "1.0": 3}
+                ),
+                FeatureDistribution.as_continuous(
+                    index=3, name="fourth", bin_to_count={"3.0": 2, "5.5": 2}
+                ),
+            ]
+        )
+
+    def render(registry):
+        output = generate_latest(registry).decode()
+        return [line for line in output.split("\n") if "_created" not in line]
+
+    rows = [[1.0, 0.0, 9.0, 6.0], [math.nan, 2.0, 0.0, INF], [-INF, 1.0, 0.0, -2.0]]
+    expected, vector, tensor = make_registry(), make_registry(), make_registry()
+    for row in rows:
+        for registry, features in [
+            (expected, row),
+            (vector, np.array(row)),
+            (tensor, np.array(row).reshape(2, 2).tolist()),
+        ]:
+            registry.observe(
+                PredictionContext(
+                    features=features, request_body="", server_id="", output=None
+                )
+            )
+    assert render(vector) == render(expected)
+    assert render(tensor) == render(expected)
+
+
+def test_collect_selected_metrics():
+    registry = LiveMetricRegistry(
+        metrics=[
+            FeatureDistribution.as_continuous(
+                index=0, name="first", bin_to_count={"-1.0": 1, "3.0": 2, "5.5": 2}
+            ),
+            FeatureDistribution.as_discrete(
+                index=1, name="second", bin_to_count={"0.0": 5, "1.0": 3}
+            ),
+        ],
+        sampler=Sampler(rate=1.0),
+        drift_scores=True,
+    )
+    assert [m.name for m in registry.collect()] == [
+        "feature_0_value",
+        "feature_1_value",
+        "live_metrics_psi",
+        "live_metrics_kl_divergence",
+        "live_metrics_ks_statistic",
+        "live_metrics_sampling_rate",
+    ]
+    assert [m.name for m in registry.collect(names={"feature_1_value_total"})] == [
+        "feature_1_value"
+    ]
+    assert [m.name for m in registry.collect(names={"live_metrics_psi"})] == [
+        "live_metrics_psi"
+    ]
+
+    # Unselected table backed metrics are skipped without reading the table
+    def fail():
+        raise AssertionError("table refreshed")
+
+    registry._table.refresh = fail
+    registry._discrete_overflow = fail
+    assert [m.name for m in registry.collect(names={"live_metrics_sampling_rate"})] == [
+        "live_metrics_sampling_rate"
+    ]
+    assert registry.collect(names={"unknown"}) == []
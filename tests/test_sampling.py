@@ -0,0 +1,81 @@
+import random
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from boxkite.monitoring import sampling
+from boxkite.monitoring.context import PredictionContext
+from boxkite.monitoring.registry import LiveMetricRegistry
+from boxkite.monitoring.sampling import AdaptiveSampler, Sampler
+
+
+def test_adaptive_rate(monkeypatch):
+    clock = SimpleNamespace(now=0.0)
+    monkeypatch.setattr(
+        sampling, "time", SimpleNamespace(perf_counter=lambda: clock.now)
+    )
+    sampler = AdaptiveSampler(budget=0.01, min_rate=0.001, interval=1.0)
+    assert sampler.rate == 1.0
+
+    # Rate is only adjusted at the end of each interval
+    clock.now = 0.5
+    sampler.record(0.1)
+    assert sampler.rate == 1.0
+    # Observing took 20% of wall time, so the rate is scaled down to meet the 1% budget
+    clock.now = 1.0
+    sampler.record(0.1)
+    assert sampler.rate == pytest.approx(0.05)
+    # Observing took half the budget, so the rate doubles
+    clock.now = 2.0
+    sampler.record(0.005)
+    assert sampler.rate == pytest.approx(0.1)
+    # Never exceeds 1
+    clock.now = 3.0
+    sampler.record(0.0)
+    assert sampler.rate == 1.0
+    clock.now = 4.0
+    sampler.record(0.0001)
+    assert sampler.rate == 1.0
+    # Clamped to min_rate when observing is too slow
+    clock.now = 5.0
+    sampler.record(1.0)
+    assert sampler.rate == pytest.approx(0.01)
+    clock.now = 6.0
+    sampler.record(1.0)
+    assert sampler.rate == 0.001
+
+
+def test_invalid_rate():
+    for rate in [0, -0.5, 1.5]:
+        with pytest.raises(ValueError):
+            Sampler(rate=rate)
+
+
+@pytest.mark.parametrize("batch", [False, True])
+def test_weighted_counts_are_unbiased(discrete_baseline, batch):
+    random.seed(42)
+    np.random.seed(42)
+    trials, size, rate = 200, 100, 0.2
+    counts = []
+    for _ in range(trials):
+        registry = LiveMetricRegistry(
+            metrics=[discrete_baseline], sampler=Sampler(rate=rate)
+        )
+        if batch:
+            registry.observe_batch(features=[[0]] * size, outputs=[])
+        else:
+            for _ in range(size):
+                registry.observe(
+                    PredictionContext(
+                        features=[0], request_body="", server_id="", output=None
+                    )
+                )
+        count = registry.collect()[0].samples[0].value
+        # Each sampled observation counts 1 / rate times
+        assert count % (1 / rate) == 0
+        counts.append(count)
+
+    # Standard error of the mean is 20 / sqrt(200), about 1.4
+    assert abs(np.mean(counts) - size) < 5
+    assert np.std(counts) > 0
@@ -1,10 +1,27 @@
-from datetime import datetime
+import asyncio
+import gzip
+import os
+import time
+from datetime import datetime, timezone
+from http.client import HTTPConnection
 from os import SEEK_SET
 from tempfile import NamedTemporaryFile
-from uuid import UUID
+from uuid import UUID, uuid4
+
+import numpy as np
+import pytest
 
 from boxkite.monitoring.collector import BaselineMetricCollector
-from boxkite.monitoring.service import ModelMonitoringService
+from boxkite.monitoring.compaction import Compactor
+from boxkite.monitoring.context import PredictionContext
+from boxkite.monitoring.encoder import MetricEncoder
+from boxkite.monitoring.exporter.type import LogExporter
+from boxkite.monitoring.identifier import TimeOrderedIdGenerator
+from boxkite.monitoring.sampling import Sampler
+from boxkite.monitoring.service import (
+    AsyncModelMonitoringService,
+    ModelMonitoringService,
+)
 
 BASELINE_HISTOGRAM = [
     "# HELP feature_0_value_baseline Baseline values for feature: first",
@@ -136,3 +153,385 @@ def test_log_prediction():
         if "_created" in expected:
             continue
         assert expected == parsed[i], f"Comparison failed at line {i + 1}"
+
+
+def test_log_predictions():
+    with NamedTemporaryFile() as temp:
+        temp.writelines(line.encode() + b"\n" for line in BASELINE_HISTOGRAM)
+        temp.seek(0, SEEK_SET)
+        service = ModelMonitoringService(
+            baseline_collector=BaselineMetricCollector(path=temp.name)
+        )
+
+        features, inference = zip(*SAMPLE_SERVING_DATA)
+        pids = service.log_predictions(
+            request_body="test", features=np.array(features), output=inference
+        )
+        assert len(set(pids)) == len(SAMPLE_SERVING_DATA)
+        # Mismatched rows are rejected before anything is observed
+        with pytest.raises(ValueError):
+            service.log_predictions(
+                request_body=["test"], features=np.array(features), output=inference
+            )
+        with pytest.raises(ValueError):
+            service.log_predictions(
+                request_body="test", features=np.array(features), output=inference[1:]
+            )
+
+        body, _ = service.export_http()
+
+    parsed = body.decode().strip().split("\n")
+    for i, expected in enumerate(
+        BASELINE_HISTOGRAM + OBSERVED_HISTOGRAM + METADATA_HISTOGRAM
+    ):
+        if "_created" in expected:
+            continue
+        assert expected == parsed[i], f"Comparison failed at line {i + 1}"
+
+
+def test_log_prediction_in_background():
+    with NamedTemporaryFile() as temp:
+        temp.writelines(line.encode() + b"\n" for line in BASELINE_HISTOGRAM)
+        temp.seek(0, SEEK_SET)
+        service = ModelMonitoringService(
+            baseline_collector=BaselineMetricCollector(path=temp.name),
+            observe_in_background=True,
+        )
+
+        for feature, inference in SAMPLE_SERVING_DATA:
+            service.log_prediction(
+                request_body="test", features=feature, output=inference
+            )
+        assert service.flush(timeout=5)
+
+        body, _ = service.export_http()
+        service.close()
+
+    parsed = body.decode().strip().split("\n")
+    for i, expected in enumerate(
+        BASELINE_HISTOGRAM + OBSERVED_HISTOGRAM + METADATA_HISTOGRAM
+    ):
+        if "_created" in expected:
+            continue
+        assert expected == parsed[i], f"Comparison failed at line {i + 1}"
+    assert "live_metrics_queue_depth 0.0" in parsed
+    assert "live_metrics_dropped_total 0.0" in parsed
+
+
+class RecordingExporter(LogExporter):
+    def __init__(self):
+        self.predictions = []
+
+    def emit(self, prediction):
+        self.predictions.append(prediction)
+
+
+class NeverSampler(Sampler):
+    def sample(self):
+        return False
+
+    def sample_batch(self, size):
+        return np.zeros(size, dtype=bool)
+
+
+@pytest.mark.parametrize("batch", [False, True])
+def test_sampled_out_predictions(batch):
+    def run(**kwargs):
+        exporter = RecordingExporter()
+        service = ModelMonitoringService(
+            log_exporter=exporter,
+            baseline_collector=BaselineMetricCollector(path=temp.name),
+            **kwargs,
+        )
+        if batch:
+            service.log_predictions(
+                request_body="test",
+                features=[f for f, _ in SAMPLE_SERVING_DATA],
+                output=[i for _, i in SAMPLE_SERVING_DATA],
+            )
+        else:
+            for feature, inference in SAMPLE_SERVING_DATA:
+                service.log_prediction(
+                    request_body="test", features=feature, output=inference
+                )
+        body, _ = service.export_http()
+        service.close()
+        return exporter.predictions, body.decode().split("\n")
+
+    with NamedTemporaryFile() as temp:
+        temp.writelines(line.encode() + b"\n" for line in BASELINE_HISTOGRAM)
+        temp.flush()
+
+        # Predictions skipped by live metrics are still logged
+        logged, parsed = run(metrics_sampler=NeverSampler(rate=0.5))
+        assert [p.features for p in logged] == [f for f, _ in SAMPLE_SERVING_DATA]
+        assert "feature_0_value_count 0.0" in parsed
+        assert "live_metrics_sampling_rate 0.5" in parsed
+
+        # Predictions skipped by the log exporter are still observed
+        logged, parsed = run(log_sampler=NeverSampler(rate=0.5))
+        assert logged == []
+        assert "feature_0_value_count 3.0" in parsed
+        assert "live_metrics_sampling_rate 0.5" not in parsed
+
+
+def test_alog_prediction():
+    async def run(service):
+        for feature, inference in SAMPLE_SERVING_DATA:
+            await service.alog_prediction(
+                request_body="test", features=feature, output=inference
+            )
+        body, _ = await service.aexport_http()
+        await service.aclose()
+        return body
+
+    with NamedTemporaryFile() as temp:
+        temp.writelines(line.encode() + b"\n" for line in BASELINE_HISTOGRAM)
+        temp.seek(0, SEEK_SET)
+        service = AsyncModelMonitoringService(
+            baseline_collector=BaselineMetricCollector(path=temp.name)
+        )
+        body = asyncio.get_event_loop().run_until_complete(run(service))
+
+    parsed = body.decode().strip().split("\n")
+    for i, expected in enumerate(
+        BASELINE_HISTOGRAM + OBSERVED_HISTOGRAM + METADATA_HISTOGRAM
+    ):
+        if "_created" in expected:
+            continue
+        assert expected == parsed[i], f"Comparison failed at line {i + 1}"
+
+
+def test_prediction_context():
+    created_at = datetime(2021, 3, 4, 5, 6, 7, 890000, tzinfo=timezone.utc)
+    entity_id = uuid4()
+    pred = PredictionContext(
+        features=[1.0, 2.0],
+        request_body="test",
+        server_id="server",
+        output=0.5,
+        entity_id=entity_id,
+        created_at=created_at,
+    )
+    assert pred.prediction_id == f"server/2021-03-04T05:06:07/{entity_id}"
+    record = pred.as_record()
+    assert record["entity_id"] == str(entity_id)
+    assert record["created_at"] == int(created_at.timestamp())
+    assert record["features"] is pred.features
+
+    lazy = PredictionContext(
+        features=[], request_body="test", server_id="server", output=0.5
+    )
+    assert lazy.entity_id.version == 4
+    assert int(lazy.created_at.timestamp()) == lazy.as_record()["created_at"]
+    other = PredictionContext(features=[], request_body="", server_id="", output=0)
+    assert lazy.entity_id != other.entity_id
+
+    fields = pred.to_dict()
+    assert list(fields) == list(PredictionContext.FIELDS)
+    assert fields["entity_id"] == entity_id and fields["created_at"] == created_at
+    assert dict(pred) == fields
+    with pytest.raises(TypeError):
+        PredictionContext(entity_id, [1.0], "test", "server", 0.5, created_at)
+
+
+def test_time_ordered_ids():
+    generator = TimeOrderedIdGenerator(server_id="server")
+    timestamp_ns = 1614834367890000000
+    ids = [generator.next_id(timestamp_ns) for _ in range(3)]
+    ids.append(generator.next_id(timestamp_ns - 1000000000))
+    ids.append(generator.next_id(timestamp_ns + 1000000))
+    assert ids == sorted(set(ids))
+    for i in ids:
+        assert UUID(int=i).version == 7
+    assert UUID(int=ids[0]).hex.startswith(f"{timestamp_ns // 1000000:012x}")
+
+    other = TimeOrderedIdGenerator(server_id="other")
+    assert other.node != generator.node
+
+
+def test_baseline_cache():
+    with NamedTemporaryFile() as temp:
+        temp.writelines(line.encode() + b"\n" for line in BASELINE_HISTOGRAM)
+        temp.flush()
+        collector = BaselineMetricCollector(path=temp.name)
+        first = collector.collect()
+        assert len(first) == 4
+        assert all(a is b for a, b in zip(first, collector.collect()))
+
+        temp.seek(0, SEEK_SET)
+        temp.truncate()
+        temp.writelines(line.encode() + b"\n" for line in BASELINE_HISTOGRAM[:10])
+        temp.flush()
+        # Coarse filesystem timestamps may not change within the same test
+        os.utime(temp.name, ns=(0, 0))
+        assert len(collector.collect()) == 1
+
+
+def test_cached_static_metrics():
+    with NamedTemporaryFile() as temp:
+        temp.writelines(line.encode() + b"\n" for line in BASELINE_HISTOGRAM)
+        temp.flush()
+        service = ModelMonitoringService(
+            baseline_collector=BaselineMetricCollector(path=temp.name)
+        )
+        for feature, inference in SAMPLE_SERVING_DATA:
+            service.log_prediction(
+                request_body="test", features=feature, output=inference
+            )
+        cached = service._metric_encoder
+        uncached = MetricEncoder(collectors=cached._collectors)
+
+        for encoder in [MetricEncoder.PROMETHEUS, MetricEncoder.OPEN_METRICS]:
+            for _ in range(2):
+                assert cached.as_text(encoder=encoder) == uncached.as_text(
+                    encoder=encoder
+                )
+            names = ["feature_1_value_baseline_bucket"]
+            assert cached.as_text(names=names, encoder=encoder) == uncached.as_text(
+                names=names, encoder=encoder
+            )
+
+        # Cached baseline fragments are filtered together with live metrics
+        names = ["feature_1_value_baseline_bucket", "feature_3_value_total"]
+        assert cached.as_text(names=names) == uncached.as_text(
+            names=names[:1]
+        ) + uncached.as_text(names=names[1:])
+
+
+def test_export_snapshot():
+    with NamedTemporaryFile() as temp:
+        temp.writelines(line.encode() + b"\n" for line in BASELINE_HISTOGRAM)
+        temp.flush()
+        service = ModelMonitoringService(
+            baseline_collector=BaselineMetricCollector(path=temp.name),
+            snapshot_ttl=0.05,
+        )
+        before, _ = service.export_http()
+        assert b"metrics_snapshot_age_seconds " in before
+        for feature, inference in SAMPLE_SERVING_DATA:
+            service.log_prediction(
+                request_body="test", features=feature, output=inference
+            )
+
+        # Stale snapshots are served while re-rendering in background
+        stale, _ = service.export_http()
+        assert (
+            stale.split(b"# HELP metrics_snapshot_age_seconds")[0]
+            == before.split(b"# HELP metrics_snapshot_age_seconds")[0]
+        )
+        deadline = time.monotonic() + 5
+        while b"feature_0_value_count 3.0" not in service.export_http()[0]:
+            assert time.monotonic() < deadline
+            time.sleep(0.01)
+        service.close()
+
+
+def strip_age(body: bytes) -> bytes:
+    return body.split(b"# HELP metrics_snapshot_age_seconds")[0]
+
+
+def test_export_gzip():
+    with NamedTemporaryFile() as temp:
+        temp.writelines(line.encode() + b"\n" for line in BASELINE_HISTOGRAM)
+        temp.flush()
+        for snapshot_ttl in [None, 60]:
+            service = ModelMonitoringService(
+                baseline_collector=BaselineMetricCollector(path=temp.name),
+                snapshot_ttl=snapshot_ttl,
+            )
+            for feature, inference in SAMPLE_SERVING_DATA:
+                service.log_prediction(
+                    request_body="test", features=feature, output=inference
+                )
+            for accept in ["text/plain", "application/openmetrics-text"]:
+                expected, content_type = service.export_http(headers={"Accept": accept})
+                body, headers = service.export_http_response(
+                    headers={"Accept": accept, "Accept-Encoding": "gzip, deflate"}
+                )
+                assert headers == {
+                    "Content-Type": content_type,
+                    "Content-Encoding": "gzip",
+                }
+                # The snapshot age is rendered on each request
+                assert strip_age(gzip.decompress(body)) == strip_age(expected)
+                eof = b"# EOF\n"
+                assert gzip.decompress(body).endswith(eof) == expected.endswith(eof)
+
+            body, headers = service.export_http_response(
+                headers={"Accept-Encoding": "gzip;q=0"}
+            )
+            assert "Content-Encoding" not in headers
+            service.close()
+
+
+def test_metrics_server():
+    with NamedTemporaryFile() as temp:
+        temp.writelines(line.encode() + b"\n" for line in BASELINE_HISTOGRAM)
+        temp.flush()
+        service = ModelMonitoringService(
+            baseline_collector=BaselineMetricCollector(path=temp.name),
+            metrics_port=0,
+            metrics_addr="127.0.0.1",
+        )
+        expected, _ = service.export_http()
+        conn = HTTPConnection("127.0.0.1", service.metrics_server.port, timeout=5)
+
+        conn.request("GET", "/metrics", headers={"Accept-Encoding": "gzip"})
+        response = conn.getresponse()
+        assert response.status == 200
+        assert response.getheader("Content-Encoding") == "gzip"
+        assert gzip.decompress(response.read()) == expected
+
+        # Reuses the same connection
+        conn.request("GET", "/metrics?name[]=feature_0_value_baseline_count")
+        response = conn.getresponse()
+        assert (
+            response.read()
+            == b"\n".join(
+                line.encode()
+                for line in BASELINE_HISTOGRAM[:2] + BASELINE_HISTOGRAM[8:9]
+            )
+            + b"\n"
+        )
+
+        conn.request("GET", "/predict")
+        assert conn.getresponse().status == 404
+        conn.close()
+        service.close()
+
+
+def test_background_threads_survive_fork(tmp_path):
+    with NamedTemporaryFile() as temp:
+        temp.writelines(line.encode() + b"\n" for line in BASELINE_HISTOGRAM)
+        temp.flush()
+        service = ModelMonitoringService(
+            baseline_collector=BaselineMetricCollector(path=temp.name),
+            observe_in_background=True,
+            snapshot_ttl=0.05,
+        )
+        compactor = Compactor(interval=60, path=str(tmp_path))
+        # Rendered before forking, as when gunicorn preloads the app
+        service.export_http()
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                for feature, inference in SAMPLE_SERVING_DATA:
+                    service.log_prediction(
+                        request_body="test", features=feature, output=inference
+                    )
+                observed = service.flush(timeout=5)
+                body, _ = service.export_http()
+                if (
+                    observed
+                    and b"feature_0_value_count 3.0" in body
+                    and compactor._worker.is_alive()
+                ):
+                    code = 0
+            finally:
+                os._exit(code)
+        _, status = os.waitpid(pid, 0)
+        assert os.WEXITSTATUS(status) == 0
+        compactor.close()
+        service.close()
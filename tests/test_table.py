@@ -0,0 +1,131 @@
+import itertools
+
+import numpy as np
+from prometheus_client import generate_latest
+from prometheus_client.utils import INF
+
+from boxkite.monitoring.collector.feature import FeatureDistribution
+from boxkite.monitoring.context import PredictionContext
+from boxkite.monitoring.registry import LiveMetricRegistry
+from boxkite.monitoring.table import (
+    ContinuousTableVariable,
+    DiscreteTableVariable,
+    FrequencyTable,
+    SharedFrequencyTable,
+)
+
+
+def test_locate_bucket():
+    metric = FeatureDistribution.as_continuous(
+        index=0, name="first", bin_to_count={"-1.0": 1, "3.0": 2, "5.5": 2}
+    )
+    variable = ContinuousTableVariable(metric)
+    values = [-2.0, -1.0, 0.0, 3.0, 3.5, 5.5, 6.0, float("nan"), INF, -INF]
+    expected = [0, 0, 1, 1, 2, 2, 3, 3, 3, 0]
+    assert [variable.locate(v) for v in values] == expected
+    assert variable.locate_batch(np.array(values)).tolist() == expected
+
+
+def test_unseen_bins_overflow(discrete_baseline):
+    registry = LiveMetricRegistry(
+        metrics=[discrete_baseline],
+        feature_max_unseen_bins={0: 1},
+    )
+    registry.observe_batch(features=[[0], [2], [3], [3], [4]], outputs=[])
+
+    output = generate_latest(registry).decode()
+    assert 'feature_0_value_total{bin="0.0"} 1.0' in output
+    assert 'feature_0_value_total{bin="2.0"} 1.0' in output
+    assert 'feature_0_value_total{bin="__other__"} 3.0' in output
+    assert 'live_metrics_overflow_total{metric_name="feature_0_value"} 3.0' in output
+    assert registry.overflow == 3
+
+
+def test_unseen_bins_batch_order(discrete_baseline):
+    values = [9, 0, 7, float("nan"), 9, 3, 2, 7, 5, 1, float("nan"), 4]
+    expected, batch = [DiscreteTableVariable(discrete_baseline) for _ in range(2)]
+    for variable in [expected, batch]:
+        FrequencyTable(metrics=[variable])
+        variable.max_unseen_bins = 3
+    for v in values:
+        expected.observe(v)
+    batch.observe_batch(values)
+
+    # The first unseen values are admitted, the rest overflow
+    assert batch.unseen_counts() == expected.unseen_counts()
+    assert list(batch.unseen_counts()) == ["9.0", "7.0", "nan", "__other__"]
+
+    def totals(variable):
+        samples = variable.collect()[0].samples
+        return [s[:3] for s in samples if s.name.endswith("_total")]
+
+    assert totals(batch) == totals(expected)
+
+
+def test_shared_table_aggregates_processes(monkeypatch, tmp_path):
+    monkeypatch.setenv("PROMETHEUS_MULTIPROC_DIR", str(tmp_path))
+    baseline = [
+        FeatureDistribution.as_continuous(
+            index=0, name="first", bin_to_count={"3.0": 2, "5.5": 2}
+        ),
+        FeatureDistribution.as_discrete(
+            index=1, name="second", bin_to_count={"0.0": 5, "1.0": 3}
+        ),
+    ]
+    # Each registry stands for a separate worker process
+    workers = [
+        LiveMetricRegistry(metrics=baseline, feature_max_unseen_bins={1: 1})
+        for _ in range(2)
+    ]
+    workers[0].observe_batch(features=[[1, 0], [4, 2], [9, 3]], outputs=[])
+    workers[1].observe(
+        PredictionContext(features=[2, 4], request_body="", server_id="", output=None)
+    )
+    assert len(list(tmp_path.glob("boxkite_live_*.npy"))) == 2
+
+    output = generate_latest(workers[1]).decode()
+    assert 'feature_0_value_bucket{le="3.0"} 2.0' in output
+    assert 'feature_0_value_bucket{le="5.5"} 3.0' in output
+    assert "feature_0_value_sum 16.0" in output
+    assert 'feature_1_value_total{bin="0.0"} 1.0' in output
+    # Each worker admitted a different unseen bin within its own budget
+    unseen = [
+        f'feature_1_value_total{{bin="{b}"}} 1.0' in output for b in ("2.0", "4.0")
+    ]
+    assert sorted(unseen) == [False, True]
+    assert 'feature_1_value_total{bin="__other__"} 2.0' in output
+    assert workers[0].overflow == 2
+
+
+def test_shared_table_never_reuses_files(monkeypatch, tmp_path, discrete_baseline):
+    monkeypatch.setenv("PROMETHEUS_MULTIPROC_DIR", str(tmp_path))
+    baseline = [discrete_baseline]
+    monkeypatch.setattr(SharedFrequencyTable, "_instances", itertools.count())
+    dead = LiveMetricRegistry(metrics=baseline)
+    dead.observe_batch(features=[[0], [2]], outputs=[])
+    # A recycled worker with the same pid starts numbering its tables from scratch
+    monkeypatch.setattr(SharedFrequencyTable, "_instances", itertools.count())
+    LiveMetricRegistry(metrics=baseline).observe_batch(features=[[1]], outputs=[])
+    assert len(list(tmp_path.glob("boxkite_live_*.npy"))) == 2
+
+    output = generate_latest(dead).decode()
+    assert 'feature_0_value_total{bin="0.0"} 1.0' in output
+    assert 'feature_0_value_total{bin="1.0"} 1.0' in output
+    assert 'feature_0_value_total{bin="2.0"} 1.0' in output
+
+
+def test_shared_tables_of_other_baselines(monkeypatch, tmp_path, discrete_baseline):
+    monkeypatch.setenv("PROMETHEUS_MULTIPROC_DIR", str(tmp_path))
+    other = FeatureDistribution.as_discrete(
+        index=0, name="first", bin_to_count={"1.0": 5, "2.0": 3}
+    )
+    # Both tables have the same shape
+    registry = LiveMetricRegistry(metrics=[discrete_baseline])
+    registry.observe_batch(features=[[0], [1]], outputs=[])
+    LiveMetricRegistry(metrics=[other]).observe_batch(features=[[1], [2]], outputs=[])
+    assert len(list(tmp_path.glob("boxkite_live_*.npy"))) == 2
+
+    output = generate_latest(registry).decode()
+    assert 'feature_0_value_total{bin="0.0"} 1.0' in output
+    assert 'feature_0_value_total{bin="1.0"} 1.0' in output
+    assert 'bin="2.0"' not in output
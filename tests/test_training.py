@@ -1,5 +1,13 @@
-from tempfile import NamedTemporaryFile
+import os
+from tempfile import NamedTemporaryFile, TemporaryDirectory
 
+import numpy as np
+
+from boxkite.monitoring.collector import (
+    FeatureHistogramCollector,
+    StreamingFeatureHistogramCollector,
+)
+from boxkite.monitoring.collector.feature import _init_worker, feature_columns
 from boxkite.monitoring.service import ModelMonitoringService
 
 SAMPLE_TRAINING_DATA = [
@@ -66,3 +74,186 @@ def test_export_text():
         assert (
             EXPECTED_HISTOGRAM_FILE[i] == line.decode()
         ), f"Comparison failed at line {i + 1}"
+
+
+def test_export_text_processes():
+    with NamedTemporaryFile() as temp:
+        ModelMonitoringService.export_text(
+            features=SAMPLE_TRAINING_DATA,
+            inference=SAMPLE_INFERENCE_DATA,
+            path=temp.name,
+            workers=2,
+            processes=True,
+        )
+        histogram_data = temp.readlines()
+
+    assert [line.decode() for line in histogram_data] == EXPECTED_HISTOGRAM_FILE
+
+
+def test_forked_workers_are_reseeded():
+    collector = FeatureHistogramCollector(data=SAMPLE_TRAINING_DATA)
+    np.random.seed(42)
+    inherited = np.random.random(4)
+    np.random.seed(42)
+    _init_worker(collector)
+    assert not np.array_equal(np.random.random(4), inherited)
+
+
+def test_streaming_matches_in_memory():
+    columns = [
+        ("continuous", np.random.normal(size=1000)),
+        ("discrete", np.random.randint(0, 4, size=1000).astype(float)),
+        ("missing", np.where(np.arange(1000) % 7, np.arange(1000.0), np.nan)),
+    ]
+    columns[2][1][3] = np.inf
+    data = np.column_stack([val for _, val in columns])
+
+    def chunks():
+        for start in range(0, len(data), 128):
+            yield data[start : start + 128]
+
+    expected = FeatureHistogramCollector(data=columns).collect()
+    actual = StreamingFeatureHistogramCollector(
+        chunks, names=[name for name, _ in columns]
+    ).collect()
+    for (_, val), e, a in zip(columns, expected, actual):
+        assert e.name == a.name
+        if "le" not in e.samples[0].labels:
+            assert e.samples == a.samples
+            continue
+        # Bins are chosen from a sketch, so they may differ slightly from the in-memory ones
+        bins = [s.labels["le"] for s in a.samples if "le" in s.labels]
+        assert bins[0] == str(np.nanmin(val[np.isfinite(val)]))
+        assert bins[-2] == str(np.nanmax(val[np.isfinite(val)]))
+        # But every row is counted exactly into them
+        counts = [s.value for s in a.samples if "le" in s.labels]
+        assert counts[:-1] == [np.sum(val <= float(le)) for le in bins[:-1]]
+        assert counts[-1] == len(val)
+
+
+def test_streaming_samples_bins_and_counts_all_rows():
+    columns = {"first": np.arange(10000.0), "second": np.arange(10000.0) % 3}
+
+    def chunks():
+        for start in range(0, 10000, 1000):
+            yield {k: v[start : start + 1000] for k, v in columns.items()}
+
+    first, second = StreamingFeatureHistogramCollector(
+        chunks, max_samples=500
+    ).collect()
+    buckets = {s.labels["le"]: s.value for s in first.samples if "le" in s.labels}
+    assert buckets["0.0"] == 1
+    assert buckets["9999.0"] == 10000
+    assert buckets["+Inf"] == 10000
+    assert [s.value for s in second.samples] == [3334, 3333, 3333]
+
+    # Chunks sketched and counted by worker threads give the same exact counts
+    np.random.seed(0)
+    threaded = StreamingFeatureHistogramCollector(chunks, workers=4).collect()
+    buckets = {
+        s.labels["le"]: s.value for s in next(threaded).samples if "le" in s.labels
+    }
+    assert buckets["0.0"] == 1
+    assert buckets["9999.0"] == buckets["+Inf"] == 10000
+    assert [s.value for s in next(threaded).samples] == [3334, 3333, 3333]
+
+
+def test_parallel_collector_order():
+    columns = [(f"feature_{i}", np.arange(float(i), 100.0)) for i in range(20)]
+    expected = list(FeatureHistogramCollector(data=columns).collect())
+    for processes in (False, True):
+        actual = FeatureHistogramCollector(
+            data=iter(columns), workers=4, processes=processes
+        ).collect()
+        assert list(actual) == expected
+
+
+def test_parallel_collector_reads_columns_lazily():
+    read = []
+
+    def columns():
+        for i in range(20):
+            read.append(i)
+            yield f"feature_{i}", np.arange(float(i), 100.0)
+
+    for processes in (False, True):
+        read.clear()
+        collected = FeatureHistogramCollector(
+            data=columns(), workers=2, processes=processes
+        ).collect()
+        next(collected)
+        # Only the columns in flight have been read
+        assert len(read) <= 4
+        assert len(list(collected)) == 19
+
+
+def test_tabular_features():
+    names = ["first", "second", "third"]
+    data = np.column_stack(
+        [np.arange(20.0), np.arange(20.0) % 2, np.linspace(-1, 1, 20)]
+    ).astype(np.float32)
+    columns = [(name, data[:, i].astype(float)) for i, name in enumerate(names)]
+    expected = list(FeatureHistogramCollector(data=columns).collect())
+
+    with TemporaryDirectory() as tmp:
+        npy = os.path.join(tmp, "features.npy")
+        np.save(npy, data)
+        npz = os.path.join(tmp, "features.npz")
+        np.savez(npz, **{name: data[:, i] for i, name in enumerate(names)})
+        for features in (
+            data,
+            npy,
+            npz,
+            {name: data[:, i] for i, name in enumerate(names)},
+        ):
+            collector = FeatureHistogramCollector(data=features, names=names)
+            assert list(collector.collect()) == expected
+            forked = FeatureHistogramCollector(
+                data=features, names=names, workers=2, processes=True
+            )
+            assert list(forked.collect()) == expected
+            # Array and file datasets can be collected again
+            assert list(collector.collect()) == expected
+
+
+def test_dataframe_features():
+    class Frame:
+        """Duck-typed DataFrame, since pandas is not a dependency."""
+
+        def __init__(self, columns):
+            self._columns = columns
+            self.columns = list(columns)
+
+        def items(self):
+            return iter(self._columns.items())
+
+    data = {0: np.arange(20.0), "second": np.arange(20.0) % 2}
+    columns = feature_columns(Frame(data))
+    # Column labels are named as strings, and numeric columns are not copied
+    assert [name for name, _ in columns] == ["0", "second"]
+    assert all(val is data[key] for (_, val), key in zip(columns, data))
+
+    expected = list(
+        FeatureHistogramCollector(data=[(str(k), v) for k, v in data.items()]).collect()
+    )
+    assert list(FeatureHistogramCollector(data=Frame(data)).collect()) == expected
+
+
+def test_streaming_constant_columns():
+    np.random.seed(0)
+    rare = np.full(1000, np.nan)
+    rare[500] = 5.0
+    data = np.column_stack([np.full(1000, 5.0), rare])
+
+    def chunks():
+        yield data[:500]
+        yield data[500:]
+
+    constant, missed = StreamingFeatureHistogramCollector(
+        chunks, names=["constant", "rare"], max_samples=10, discrete=set()
+    ).collect()
+    buckets = {s.labels["le"]: s.value for s in constant.samples if "le" in s.labels}
+    assert buckets == {"4.5": 0, "5.5": 1000, "+Inf": 1000}
+    # The sample has no finite values, but the sketch still spans the dataset
+    buckets = {s.labels["le"]: s.value for s in missed.samples if "le" in s.labels}
+    assert buckets == {"4.5": 0, "5.5": 1, "+Inf": 1000}
@@ -0,0 +1,111 @@
+from boxkite.monitoring import window
+from boxkite.monitoring.collector.feature import FeatureDistribution
+from boxkite.monitoring.registry import LiveMetricRegistry
+
+
+def test_sliding_window(monkeypatch):
+    clock = [100.0]
+    monkeypatch.setattr(window.time, "monotonic", lambda: clock[0])
+    registry = LiveMetricRegistry(
+        metrics=[
+            FeatureDistribution.as_continuous(
+                index=0, name="first", bin_to_count={"3.0": 2, "5.5": 2}
+            ),
+            FeatureDistribution.as_discrete(
+                index=1, name="second", bin_to_count={"0.0": 6}
+            ),
+        ],
+        window=3,
+        window_granularity=1,
+    )
+
+    def samples():
+        return {
+            (s.name, tuple(s.labels.values())): s.value
+            for m in registry.collect()
+            for s in m.samples
+        }
+
+    registry.observe_batch(features=[[1, 0], [4, 2]], outputs=[])
+    clock[0] = 101.5
+    registry.observe_batch(features=[[9, 2]], outputs=[])
+    current = samples()
+    assert current[("feature_0_value_window_gcount", ())] == 3
+    assert current[("feature_1_value_window", ("2.0",))] == 2
+    # Windowed metrics follow their cumulative metric
+    names = [m.name for m in registry.collect()]
+    assert names[:2] == ["feature_0_value", "feature_0_value_window"]
+
+    # Observations before the oldest slot slide out of the window
+    clock[0] = 103.2
+    current = samples()
+    assert current[("feature_0_value_window_bucket", ("3.0",))] == 0
+    assert current[("feature_0_value_window_bucket", ("+Inf",))] == 1
+    assert current[("feature_0_value_window_gsum", ())] == 9
+    assert current[("feature_1_value_window", ("0.0",))] == 0
+    assert current[("feature_1_value_window", ("2.0",))] == 1
+    assert current[("feature_0_value_count", ())] == 3
+
+    clock[0] = 110.0
+    assert samples()[("feature_0_value_window_gcount", ())] == 0
+
+
+def test_shared_sliding_window(monkeypatch, tmp_path, discrete_baseline):
+    monkeypatch.setenv("PROMETHEUS_MULTIPROC_DIR", str(tmp_path))
+    clock = [100.0]
+    monkeypatch.setattr(window.time, "monotonic", lambda: clock[0])
+    baseline = [discrete_baseline]
+    # Each registry stands for a separate worker process
+    busy, idle = [
+        LiveMetricRegistry(metrics=baseline, window=3, window_granularity=1)
+        for _ in range(2)
+    ]
+
+    def windowed(registry):
+        return {
+            s.labels["bin"]: s.value
+            for m in registry.collect()
+            for s in m.samples
+            if s.name == "feature_0_value_window"
+        }
+
+    busy.observe_batch(features=[[0], [0]], outputs=[])
+    clock[0] = 101.5
+    busy.observe_batch(features=[[1]], outputs=[])
+    clock[0] = 103.2
+    # The idle worker did not tick since the first slot, but reads the same ring
+    assert windowed(idle) == windowed(busy) == {"0.0": 0, "1.0": 1}
+    assert len(list(tmp_path.glob("boxkite_window_*.npz"))) == 2
+    # Windowed series can be selected by name, same as in a single process
+    selected = idle.collect(names={"feature_0_value_window"})
+    assert [m.name for m in selected] == ["feature_0_value", "feature_0_value_window"]
+
+
+def test_shared_windows_of_other_baselines(monkeypatch, tmp_path, discrete_baseline):
+    monkeypatch.setenv("PROMETHEUS_MULTIPROC_DIR", str(tmp_path))
+    clock = [100.0]
+    monkeypatch.setattr(window.time, "monotonic", lambda: clock[0])
+    other = FeatureDistribution.as_discrete(
+        index=0, name="first", bin_to_count={"1.0": 5, "2.0": 3}
+    )
+    # Both tables have the same shape
+    first, second = [
+        LiveMetricRegistry(metrics=[baseline], window=3, window_granularity=1)
+        for baseline in (discrete_baseline, other)
+    ]
+    first.observe_batch(features=[[0]], outputs=[])
+    second.observe_batch(features=[[1], [2]], outputs=[])
+    clock[0] = 101.5
+    # The second worker stores the slot first, which must not be read by the other baseline
+    second.observe_batch(features=[[1]], outputs=[])
+    first.observe_batch(features=[[1]], outputs=[])
+    clock[0] = 103.2
+    assert len(list(tmp_path.glob("boxkite_window_*.npz"))) == 4
+
+    windowed = {
+        s.labels["bin"]: s.value
+        for m in first.collect()
+        for s in m.samples
+        if s.name == "feature_0_value_window"
+    }
+    assert windowed == {"0.0": 0, "1.0": 1}